@@ -0,0 +1,309 @@
+import os
+import re
+import glob
+import bisect
+import obspy
+from fnmatch import fnmatch
+import numpy as np
+
+
+'''
+    This script reads seismic data back from local storage, so that the processing can run from disk without the FDSN
+    client:
+    1) index the archive by network, station, location, channel and time range from the file headers only
+       (SAC files as written by download_raw_data.download, an SDS tree, or an ASDF file)
+    2) read only the requested time window of the files that overlap it; evenly sampled SAC files are memory-mapped
+       and only the samples of the window are copied
+    3) return obspy streams in the same form as the FDSN client, so that check_sample_gaps and preprocess_raw can be
+       fed straight from local storage
+
+    Classes: WaveformArchive.
+'''
+
+
+# SDS file names: NET.STA.LOC.CHAN.TYPE.YEAR.DOY
+_SDS_NAME = re.compile(r'^([^.]*)\.([^.]*)\.([^.]*)\.([^.]*)\.([^.]*)\.(\d{4})\.(\d{3})$')
+
+# ASDF waveform names: NET.STA.LOC.CHAN__STARTTIME__ENDTIME__TAG
+_ASDF_NAME = re.compile(r'^([^.]*)\.([^.]*)\.([^.]*)\.([^.]*)__([^_]+)__([^_]+)__(.+)$')
+
+# length of the SAC header in bytes
+_SAC_HEADER = 632
+
+
+class WaveformArchive(object):
+    '''
+    This class indexes a local waveform archive and reads time windows from it. It has the get_waveforms and
+    get_stations methods of obspy Client, so it can replace the client in pipeline.run_station_day.
+    PARAMETERS:
+    ----------------
+    path: a string of the data folder (SAC), the root of the SDS tree (SDS) or the ASDF file (ASDF)
+    format: 'SAC' (default), 'SDS' or 'ASDF'
+    inventory: an optional obspy Inventory, or a glob pattern of StationXML files, used by get_stations.
+               For ASDF, the StationXML stored in the file is used by default.
+    pattern: a glob pattern of the SAC files relative to path. Default is '*.sac'.
+    ATTRIBUTES:
+    ----------------
+    index: a list of dictionaries with keys net, sta, location, chan, starttime, endtime and path, one per file
+           (one per waveform for ASDF). select looks them up by (net, sta, location, chan) and by starttime with
+           bisect, so a lookup does not scan the whole archive.
+    '''
+
+    def __init__(self,path,format='SAC',inventory=None,pattern='*.sac'):
+        if not os.path.exists(path):
+            raise ValueError('archive not found! abort!')
+        self.path = path
+        self.format = format.upper()
+        if isinstance(inventory,str):
+            inv = obspy.Inventory(networks=[],source='archive')
+            for ff in sorted(glob.glob(inventory)):
+                inv += obspy.read_inventory(ff)
+            inventory = inv
+        self.inventory = inventory
+        self._dataset = None
+
+        if self.format == 'SAC':
+            self.index = self._index_sac(pattern)
+        elif self.format == 'SDS':
+            self.index = self._index_sds()
+        elif self.format == 'ASDF':
+            self.index = self._index_asdf()
+        else:
+            raise ValueError('no such option for format! please double check!')
+        self._build_lookup()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getstate__(self):
+        # the ASDF file is opened again in every process
+        state = self.__dict__.copy()
+        state['_dataset'] = None
+        return state
+
+    def _index_sac(self,pattern):
+        '''index the SAC files from their headers only'''
+        index = []
+        for ff in sorted(glob.glob(os.path.join(self.path,pattern))):
+            for tr in obspy.read(ff,format='SAC',headonly=True):
+                stats = tr.stats
+                index.append({'net':stats.network,'sta':stats.station,'location':stats.location,'chan':stats.channel,
+                              'starttime':stats.starttime,'endtime':stats.endtime,'path':ff,
+                              'stats':stats,'byteorder':_sac_byteorder(ff)})
+        return index
+
+    def _index_sds(self):
+        '''index the SDS tree from the file names, every file holds one day'''
+        index = []
+        for ff in sorted(glob.glob(os.path.join(self.path,'*','*','*','*','*'))):
+            match = _SDS_NAME.match(os.path.basename(ff))
+            if match is None:
+                continue
+            net,sta,location,chan,dtype,year,doy = match.groups()
+            starttime = obspy.UTCDateTime(year=int(year),julday=int(doy))
+            index.append({'net':net,'sta':sta,'location':location,'chan':chan,
+                          'starttime':starttime,'endtime':starttime+86400,'path':ff})
+        return index
+
+    def _index_asdf(self):
+        '''index the ASDF file from the waveform names, without reading any data'''
+        index = []
+        ds = self._get_dataset()
+        for station in ds.waveforms.list():
+            for name in ds.waveforms[station].list():
+                match = _ASDF_NAME.match(name)
+                if match is None:
+                    continue
+                net,sta,location,chan,t1,t2,tag = match.groups()
+                index.append({'net':net,'sta':sta,'location':location,'chan':chan,'starttime':obspy.UTCDateTime(t1),
+                              'endtime':obspy.UTCDateTime(t2),'path':self.path,'tag':tag})
+        return index
+
+    def _build_lookup(self):
+        '''
+        group the entries of index by (net, sta, location, chan), sorted by starttime, with the starttimes as
+        timestamps for bisect and the longest duration of the channel to bound the files that start before a window
+        '''
+        self._lookup = {}
+        for entry in sorted(self.index,key=lambda entry: entry['starttime']):
+            key = (entry['net'],entry['sta'],entry['location'],entry['chan'])
+            starts,entries,duration = self._lookup.get(key,([],[],0.))
+            starts.append(entry['starttime'].timestamp)
+            entries.append(entry)
+            self._lookup[key] = (starts,entries,max(duration,entry['endtime']-entry['starttime']))
+
+    def _get_dataset(self):
+        if self._dataset is None:
+            import pyasdf
+            self._dataset = pyasdf.ASDFDataSet(self.path,mode='r')
+        return self._dataset
+
+    def select(self,network='*',station='*',location='*',channel='*',starttime=None,endtime=None):
+        '''
+        This function finds the files of the archive that overlap a time window.
+        PARAMETERS:
+        ----------------
+        network, station, location, channel: strings of codes, wildcards * and ? are allowed
+        starttime, endtime: obspy UTCDateTime of the window. Default is None (no limit).
+        RETURNS:
+        ----------------
+        entries: a list of the matching entries of index, sorted by starttime
+        '''
+        codes = (network,station,location,channel)
+        if any(_has_wildcard(code) for code in codes):
+            # match the channels of the archive, not every file
+            keys = [key for key in self._lookup if all(fnmatch(value,code) for value,code in zip(key,codes))]
+        else:
+            keys = [codes] if codes in self._lookup else []
+
+        entries = []
+        for key in keys:
+            starts,channel_entries,duration = self._lookup[key]
+            # the files that start between starttime minus the longest file and endtime
+            i0 = 0 if starttime is None else bisect.bisect_left(starts,starttime.timestamp-duration)
+            i1 = len(starts) if endtime is None else bisect.bisect_right(starts,endtime.timestamp)
+            for entry in channel_entries[i0:i1]:
+                if starttime is not None and entry['endtime'] < starttime:
+                    continue
+                entries.append(entry)
+        return sorted(entries,key=lambda entry: entry['starttime'])
+
+    def get_waveforms(self,network,station,location,channel,starttime,endtime):
+        '''
+        This function reads a time window of one or more channels from the archive, like obspy Client.get_waveforms.
+        Only the files that overlap the window are opened, and only the samples inside the window are read.
+        PARAMETERS:
+        ----------------
+        network, station, location, channel: strings of codes, wildcards * and ? are allowed
+        starttime, endtime: obspy UTCDateTime of the window
+        RETURNS:
+        ----------------
+        st: obspy stream of the window, adjacent pieces are merged and gaps are kept as separate traces
+        '''
+        entries = self.select(network,station,location,channel,starttime,endtime)
+
+        st = obspy.Stream()
+        if self.format == 'SAC':
+            for entry in entries:
+                st += _read_sac_window(entry,starttime,endtime)
+        elif self.format == 'SDS':
+            for entry in entries:
+                st += obspy.read(entry['path'],starttime=starttime,endtime=endtime)
+            st = st.select(network=network,station=station,location=location,channel=channel)
+        else:
+            ds = self._get_dataset()
+            for entry in entries:
+                st += ds.get_waveforms(network=entry['net'],station=entry['sta'],location=entry['location'],
+                                       channel=entry['chan'],starttime=starttime,endtime=endtime,tag=entry['tag'])
+
+        return _join(st)
+
+    def get_stations(self,network,station,location,starttime,endtime,level='response',channel='*'):
+        '''
+        This function returns the inventory of a station from the archive, like obspy Client.get_stations.
+        '''
+        inv = self.inventory
+        if inv is None and self.format == 'ASDF':
+            ds = self._get_dataset()
+            inv = obspy.Inventory(networks=[],source='archive')
+            for name in ds.waveforms.list():
+                if 'StationXML' in ds.waveforms[name]:
+                    inv += ds.waveforms[name].StationXML
+            self.inventory = inv
+        if inv is None:
+            raise ValueError('no inventory in the archive! please double check!')
+
+        inv = inv.select(network=network,station=station,location=location,channel=channel,
+                         starttime=starttime,endtime=endtime)
+        if len(inv) == 0:
+            raise ValueError('no inventory for %s.%s in the archive! please double check!' % (network,station))
+        return inv
+
+    def load(self,all_chunk,nsta,net,sta,location,chan):
+        '''
+        This function reads the waveforms and inventories of all stations and chunks from the archive in the same
+        form as download_raw_data.download. Stations without data in a chunk are skipped.
+        PARAMETERS:
+        ----------------
+        all_chunk: a list of events from download_raw_data.get_event_list
+        nsta: an integer of number of stations
+        net, sta, location, chan: lists of string that specify the stations, see download_raw_data.download
+        RETURNS:
+        ----------------
+        tr_list: a list of obspy streams
+        inv_list: a list of inventories, or None for every stream if the archive has no inventory
+        date_info: dict of starting and ending time of the last chunk
+        '''
+        tr_list = []
+        inv_list = []
+        for ick in range(len(all_chunk)-1):
+            s1=obspy.UTCDateTime(all_chunk[ick]) #start time
+            s2=obspy.UTCDateTime(all_chunk[ick+1]) #end time
+            date_info = {'starttime':s1,'endtime':s2}
+
+            for ista in range(nsta):
+                tr = self.get_waveforms(net[ista],sta[ista],location[ista],chan[ista],s1,s2)
+                if len(tr) == 0:
+                    continue
+                tr_list.append(tr)
+                if self.inventory is None and self.format != 'ASDF':
+                    inv_list.append(None)
+                else:
+                    inv_list.append(self.get_stations(net[ista],sta[ista],location[ista],s1,s2,channel=chan[ista]))
+
+        if len(tr_list) < 1:
+            raise ValueError("The raw waveform list cannot be empty.")
+
+        return tr_list, inv_list, date_info
+
+
+def _has_wildcard(code):
+    return any(c in code for c in '*?[')
+
+
+def _join(st):
+    '''join the pieces read from consecutive files: samples repeated at the file edges are read once, adjacent pieces
+    are merged and gaps are kept as separate traces'''
+    st.sort()
+    last = {}
+    pieces = obspy.Stream()
+    for tr in st:
+        end = last.get(tr.id)
+        if end is not None and tr.stats.starttime <= end:
+            # keep the samples after the end of the previous piece
+            tr = tr.slice(end+tr.stats.delta/2,nearest_sample=False)
+            if tr.stats.npts == 0:
+                continue
+        last[tr.id] = tr.stats.endtime if end is None else max(end,tr.stats.endtime)
+        pieces += tr
+    pieces.merge(method=-1)
+    pieces.sort()
+    return pieces
+
+
+def _sac_byteorder(ff):
+    '''byte order of a SAC file, from the header version number (nvhdr = 6)'''
+    with open(ff,'rb') as fp:
+        fp.seek(304)
+        nvhdr = fp.read(4)
+    return '<' if np.frombuffer(nvhdr,dtype='<i4')[0] == 6 else '>'
+
+
+def _read_sac_window(entry,starttime,endtime):
+    '''read the samples of a SAC file between starttime and endtime through a memory map'''
+    stats = entry['stats']
+    if stats.sac.get('leven',1) != 1 or stats.sac.get('iftype',1) != 1:
+        # not an evenly sampled time series, read the whole file
+        return obspy.read(entry['path'],format='SAC',starttime=starttime,endtime=endtime)
+
+    fs = stats.sampling_rate
+    i0 = max(int(round((starttime-stats.starttime)*fs)),0)
+    i1 = min(int(round((endtime-stats.starttime)*fs))+1,stats.npts)
+    if i1 <= i0:
+        return obspy.Stream()
+
+    data = np.memmap(entry['path'],dtype=entry['byteorder']+'f4',mode='r',offset=_SAC_HEADER,shape=(stats.npts,))
+    header = stats.copy()
+    header.starttime = stats.starttime+i0/fs
+    header.npts = i1-i0
+    return obspy.Stream([obspy.Trace(np.array(data[i0:i1],dtype=np.float32),header=header)])
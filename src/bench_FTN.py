@@ -0,0 +1,357 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+import tracemalloc
+import obspy
+import scipy
+import numpy as np
+import processing
+import normalisation
+
+
+'''
+    This script benchmarks the FTN pipeline on synthetic noise, without downloading data:
+    1) synthetic multi-station noise streams with controllable length, sampling rate, gaps and fragments at a wrong 
+       sampling rate
+    2) the time, throughput (samples per second) and peak memory of check_sample_gaps, preprocess_raw, 
+       normalisation_filtering and freq_time_normalisation over a grid of npts and numbers of frequency windows
+    3) the results are saved as JSON, and two JSON files (e.g. of two commits) can be compared for regressions
+    4) the cleanup of preprocess_raw with the fused kernel processing.clean_trace against the separate 
+       numpy/scipy/obspy passes it replaces
+    5) the import time of the modules in a fresh interpreter (python -X importtime) against a budget, since every
+       worker process of a parallel run pays it
+
+    Run it with e.g.
+        python bench_FTN.py --out bench_new.json --compare bench_old.json
+        python bench_FTN.py --quick
+        python bench_FTN.py --cleanup
+        python bench_FTN.py --imports
+
+    Functions: synthetic_trace, synthetic_stream, synthetic_windows, run_suite, save_results, compare_results, 
+               bench_cleanup, import_time.
+'''
+
+
+# budget in seconds of the cumulative import time of a module in a fresh interpreter. normalisation takes about 1.35 s
+# on the test machine (most of it scipy.signal), against 2.85 s when every module imported the shared block of
+# dependencies.py (pycwt, pandas, pyasdf, numba, the FDSN client).
+IMPORT_BUDGET = {'normalisation':2.0}
+
+
+def synthetic_trace(npts=8640000, samp_freq=100., nbad=100, seed=0):
+    '''
+    This function builds a float32 trace of white noise with a mean, a trend and some nan/inf values.
+    PARAMETERS:
+    ----------------
+    npts: number of points. Default is one day at 100 Hz.
+    samp_freq: sampling frequency
+    nbad: number of nan and of inf values
+    seed: seed of the random generator
+    RETURNS:
+    ----------------
+    tr: obspy trace
+    '''
+    rng = np.random.default_rng(seed)
+    data = (rng.standard_normal(npts)*100.+np.linspace(0., 1e3, npts)+50.).astype(np.float32)
+    data[rng.integers(0, npts, nbad)] = np.nan
+    data[rng.integers(0, npts, nbad)] = np.inf
+    return obspy.Trace(data, header={'sampling_rate':samp_freq, 'station':'SYN', 'channel':'HHZ'})
+
+
+def synthetic_stream(npts, samp_freq=1., ngaps=0, gap_len=10, rate_mismatch=0, station='SYN', 
+                     starttime=obspy.UTCDateTime(2021, 11, 1), seed=0):
+    '''
+    This function builds the stream of one station: white noise of npts points (gaps included) cut into fragments.
+    PARAMETERS:
+    ----------------
+    npts: number of points between the first and the last sample
+    samp_freq: sampling frequency
+    ngaps: number of gaps, evenly spread over the record
+    gap_len: length of each gap in points
+    rate_mismatch: number of extra short fragments at half the sampling rate (removed by check_sample_gaps)
+    station: station code
+    starttime: obspy UTCDateTime of the first sample
+    seed: seed of the random generator
+    RETURNS:
+    ----------------
+    st: obspy stream of ngaps+1+rate_mismatch traces
+    '''
+    rng = np.random.default_rng(seed)
+    header = {'network':'XX', 'station':station, 'channel':'BHZ', 'sampling_rate':samp_freq}
+    # fragment boundaries, the gaps are taken out of the record
+    bounds = np.linspace(0, npts, ngaps+2).astype(int)
+    st = obspy.Stream()
+    for ifrag in range(ngaps+1):
+        i0 = bounds[ifrag]+(gap_len if ifrag > 0 else 0)
+        i1 = bounds[ifrag+1]
+        if i1 <= i0:
+            continue
+        header['starttime'] = starttime+i0/samp_freq
+        st.append(obspy.Trace(rng.standard_normal(i1-i0).astype(np.float32), header=dict(header)))
+    for ifrag in range(rate_mismatch):
+        header['starttime'] = starttime+ifrag*100/samp_freq
+        st.append(obspy.Trace(rng.standard_normal(20).astype(np.float32), header=dict(header, sampling_rate=samp_freq/2)))
+    return st
+
+
+def synthetic_windows(nwin, freqmin=0.01, freqmax=0.07):
+    '''This function returns nwin adjacent frequency windows of equal width between freqmin and freqmax.'''
+    edges = np.linspace(freqmin, freqmax, nwin+1)
+    return [(edges[ii], edges[ii+1]) for ii in range(nwin)]
+
+
+def _measure(setup, func, repeat):
+    '''best wall time of func(*setup()) over repeat runs, and its peak memory (traced in a separate run)'''
+    args = setup()
+    tracemalloc.start()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    best = np.inf
+    for irep in range(repeat):
+        args = setup()
+        t0 = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter()-t0)
+    return best, peak
+
+
+def _metadata():
+    '''the commit and the versions of the run'''
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit':commit,
+            'date':obspy.UTCDateTime().isoformat(),
+            'python':platform.python_version(),
+            'numpy':np.__version__,
+            'scipy':scipy.__version__,
+            'obspy':obspy.__version__,
+            'machine':platform.machine(),
+            'cpus':os.cpu_count()}
+
+
+def run_suite(npts_grid=(86400, 345600), nwin_grid=(8, 32), nsta=1, samp_freq=1., ngaps=20, repeat=3):
+    '''
+    This function benchmarks the stages of the pipeline on synthetic streams.
+    PARAMETERS:
+    ----------------
+    npts_grid: numbers of points per station. Default is one and four days at 1 Hz.
+    nwin_grid: numbers of frequency windows of the normalisation
+    nsta: number of stations, processed one after the other
+    samp_freq: sampling frequency of the synthetic data (no resampling in preprocess_raw)
+    ngaps: number of gaps of each station
+    repeat: number of runs of each case, the best one is kept
+    RETURNS:
+    ----------------
+    suite: dict with 'meta' (commit, date and versions) and 'results', a list of dicts with keys stage, npts, nwin 
+           (None for the stages without frequency windows), nsta, time_s, samples_per_s and peak_mem_bytes
+    '''
+    results = []
+    prepro_para = {'rm_resp':'no', 'respdir':None, 'freqmin':0.01, 'freqmax':0.07, 'samp_freq':samp_freq}
+
+    def record(stage, npts, nwin, setup, func):
+        best, peak = _measure(setup, func, repeat)
+        results.append({'stage':stage, 'npts':npts, 'nwin':nwin, 'nsta':nsta, 'time_s':best,
+                        'samples_per_s':npts*nsta/best, 'peak_mem_bytes':peak})
+
+    for npts in npts_grid:
+        streams = [synthetic_stream(npts, samp_freq, ngaps=ngaps, rate_mismatch=2, station='S%03d' % ista, seed=ista)
+                   for ista in range(nsta)]
+        t0 = streams[0][0].stats.starttime
+        date_info = {'starttime':t0, 'endtime':t0+(npts-1)/samp_freq}
+
+        def gaps(streams):
+            for st in streams:
+                processing.check_sample_gaps(st, date_info)
+        record('check_sample_gaps', npts, None, lambda: ([st.copy() for st in streams],), gaps)
+
+        def prepro(streams):
+            return [processing.preprocess_raw(st, None, prepro_para, date_info) for st in streams]
+        record('preprocess_raw', npts, None, lambda: ([processing.check_sample_gaps(st.copy(), date_info) for st in streams],), prepro)
+
+        data = [tr.data for tr in prepro([processing.check_sample_gaps(st.copy(), date_info) for st in streams])]
+        for nwin in nwin_grid:
+            windows = synthetic_windows(nwin, prepro_para['freqmin'], prepro_para['freqmax'])
+            record('normalisation_filtering', npts, nwin, lambda: (data,),
+                   lambda data: [normalisation.normalisation_filtering(windows, samp_freq, dd) for dd in data])
+            record('freq_time_normalisation', npts, nwin, lambda: (data,),
+                   lambda data: [normalisation.freq_time_normalisation(windows, samp_freq, dd) for dd in data])
+
+    return {'meta':_metadata(), 'results':results}
+
+
+def save_results(suite, path):
+    '''This function writes the output of run_suite to a JSON file.'''
+    with open(path, 'w') as fp:
+        json.dump(suite, fp, indent=1)
+
+
+def compare_results(old, new, tolerance=0.1):
+    '''
+    This function compares two benchmark runs case by case.
+    PARAMETERS:
+    ----------------
+    old, new: outputs of run_suite, or paths of their JSON files
+    tolerance: the relative slowdown (time) or growth (peak memory) reported as a regression. Default is 10%.
+    RETURNS:
+    ----------------
+    rows: a list of dicts with keys stage, npts, nwin, time_ratio, mem_ratio and regression (new/old ratios) for the 
+          cases of both runs
+    '''
+    if isinstance(old, str):
+        with open(old) as fp:
+            old = json.load(fp)
+    if isinstance(new, str):
+        with open(new) as fp:
+            new = json.load(fp)
+
+    key = lambda res: (res['stage'], res['npts'], res['nwin'], res['nsta'])
+    before = {key(res):res for res in old['results']}
+    rows = []
+    for res in new['results']:
+        if key(res) not in before:
+            continue
+        ref = before[key(res)]
+        time_ratio = res['time_s']/ref['time_s']
+        mem_ratio = res['peak_mem_bytes']/max(ref['peak_mem_bytes'], 1)
+        rows.append({'stage':res['stage'], 'npts':res['npts'], 'nwin':res['nwin'], 'time_ratio':time_ratio, 
+                     'mem_ratio':mem_ratio, 'regression':time_ratio > 1+tolerance or mem_ratio > 1+tolerance})
+    return rows
+
+
+def _cleanup_separate(tr):
+    '''the cleanup of preprocess_raw as separate passes over the data'''
+    tttindx = np.where(np.isnan(tr.data))
+    if len(tttindx) > 0:tr.data[tttindx] = 0
+    tttindx = np.where(np.isinf(tr.data))
+    if len(tttindx) > 0:tr.data[tttindx] = 0
+    tr.data = np.float32(tr.data)
+    tr.data = scipy.signal.detrend(tr.data, type='constant')
+    tr.data = scipy.signal.detrend(tr.data, type='linear')
+    tr.taper(max_percentage=0.05, max_length=50)
+    return tr
+
+
+def _cleanup_fused(tr):
+    '''the cleanup of preprocess_raw with the fused kernel'''
+    processing.clean_trace(tr.data, *processing.taper_sides(tr.stats.npts, tr.stats.sampling_rate))
+    return tr
+
+
+def _best_time(func, tr, repeat):
+    '''best wall time of func on fresh copies of tr, and the last output'''
+    best = np.inf
+    for irep in range(repeat):
+        trc = tr.copy()
+        t0 = time.perf_counter()
+        out = func(trc)
+        best = min(best, time.perf_counter()-t0)
+    return best, out
+
+
+def bench_cleanup(npts=8640000, samp_freq=100., repeat=5):
+    '''
+    This function times the cleanup of a synthetic trace with the separate passes and with the fused kernel.
+    PARAMETERS:
+    ----------------
+    npts: number of points. Default is one day at 100 Hz.
+    samp_freq: sampling frequency
+    repeat: number of runs, the best one is kept
+    RETURNS:
+    ----------------
+    result: dict with the best wall times in seconds, the speedup and the maximum difference relative to the
+            maximum amplitude
+    '''
+    tr = synthetic_trace(npts, samp_freq)
+    # compile the kernel before timing
+    _cleanup_fused(synthetic_trace(100, samp_freq, nbad=1))
+
+    t_separate, out1 = _best_time(_cleanup_separate, tr, repeat)
+    t_fused, out2 = _best_time(_cleanup_fused, tr, repeat)
+    return {'npts':npts,
+            'separate':t_separate,
+            'fused':t_fused,
+            'speedup':t_separate/t_fused,
+            'max_rel_diff':float(np.abs(out1.data-out2.data).max()/np.abs(out1.data).max())}
+
+
+def import_time(module='normalisation', repeat=3):
+    '''
+    This function measures the import time of a module in a fresh interpreter with python -X importtime.
+    PARAMETERS:
+    ----------------
+    module: the name of the module
+    repeat: number of runs, the best one is kept
+    RETURNS:
+    ----------------
+    seconds: the best cumulative import time of the module in seconds
+    loaded: the list of the names of all modules imported with it
+    '''
+    best = np.inf
+    for irep in range(repeat):
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % module], 
+                              cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True)
+        loaded = []
+        cumulative = None
+        for line in proc.stderr.splitlines():
+            # import time: self [us] | cumulative | imported package
+            fields = line.split('|')
+            if len(fields) != 3 or not fields[1].strip().isdigit():
+                continue
+            loaded.append(fields[2].strip())
+            if fields[2].strip() == module:
+                cumulative = int(fields[1])/1e6
+        # e.g. a module already imported by the interpreter at startup
+        if cumulative is None:
+            raise ValueError('no import time of %s found! please double check!' % module)
+        best = min(best, cumulative)
+    return best, loaded
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark the FTN pipeline on synthetic data')
+    parser.add_argument('--out', help='JSON file to write the results to')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare with')
+    parser.add_argument('--quick', action='store_true', help='small grid for a quick check')
+    parser.add_argument('--cleanup', action='store_true', help='only benchmark the cleanup kernel')
+    parser.add_argument('--imports', action='store_true', help='only measure the import times against the budget')
+    args = parser.parse_args()
+
+    if args.imports:
+        over = False
+        for module in ['normalisation', 'processing', 'download_raw_data', 'pipeline']:
+            seconds, loaded = import_time(module)
+            budget = IMPORT_BUDGET.get(module)
+            over = over or (budget is not None and seconds > budget)
+            print('import %-18s %6.3f s  %4d modules  %s' % (module, seconds, len(loaded), 
+                  '' if budget is None else 'budget %.1f s %s' % (budget, 'OVER' if seconds > budget else 'ok')))
+        sys.exit(1 if over else 0)
+
+    if args.cleanup:
+        result = bench_cleanup()
+        print('cleanup of %d points: separate passes %.3f s, fused kernel %.3f s, speedup %.1fx, max rel. diff %.1e'
+              % (result['npts'], result['separate'], result['fused'], result['speedup'], result['max_rel_diff']))
+        sys.exit(0)
+
+    if args.quick:
+        suite = run_suite(npts_grid=(3600,), nwin_grid=(4,), repeat=1)
+    else:
+        suite = run_suite()
+    for res in suite['results']:
+        print('%-24s npts %8d nwin %4s  %8.4f s  %10.3g samples/s  %8.1f MB' % (res['stage'], res['npts'], res['nwin'], 
+              res['time_s'], res['samples_per_s'], res['peak_mem_bytes']/1e6))
+    if args.out:
+        save_results(suite, args.out)
+
+    if args.compare:
+        for row in compare_results(args.compare, suite):
+            print('%-24s npts %8d nwin %4s  time x%.2f  memory x%.2f  %s' % (row['stage'], row['npts'], row['nwin'], 
+                  row['time_ratio'], row['mem_ratio'], 'REGRESSION' if row['regression'] else ''))
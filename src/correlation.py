@@ -0,0 +1,133 @@
+import obspy
+import numpy as np
+from scipy.fft import rfft, irfft, next_fast_len
+
+
+'''
+    This script cross-correlates the frequency-time normalised waveforms of many stations in the frequency domain:
+    1) cut the waveform of every station into segments and Fourier transform every segment once
+    2) multiply the spectra of all station pairs at once on (n_pairs, nfreq) arrays and average over segments
+    3) transform back and keep the lags within the requested maximum lag
+
+    Every station spectrum is reused for all of its pairs, so N stations need N transforms instead of one per pair.
+
+    Functions: get_pair_list, station_spectra, cross_correlate, correlate.
+'''
+
+
+def get_pair_list(nsta, auto=False):
+    '''
+    This function lists the station pairs to correlate.
+    PARAMETERS:
+    ----------------
+    nsta: an integer of number of stations
+    auto: whether to include the auto-correlation of every station. Default is False.
+    RETURNS:
+    ----------------
+    pairs: a tuple of two integer arrays (ii, jj) with ii < jj (ii <= jj with auto) for every pair
+    '''
+    if nsta < 1:
+        raise ValueError('the number of stations should be positive! please double check!')
+    return np.triu_indices(nsta, k=0 if auto else 1)
+
+
+def station_spectra(data, samp_freq, cc_len=None, step=None):
+    '''
+    This function cuts the waveform of every station into segments and Fourier transforms every segment once.
+    The segments are zero-padded to at least twice their length, so that the products of the spectra give linear
+    (not circular) correlations.
+    PARAMETERS:
+    ----------------
+    data: a 2D array (n_sta, npts) of the normalised waveforms, e.g. from store.FTNStore.read
+    samp_freq: sampling frequency
+    cc_len: length of the segments in seconds. Default is None (one segment of the whole record).
+    step: step between the segments in seconds. Default is None (equal to cc_len, no overlap).
+    RETURNS:
+    ----------------
+    spec: a 3D complex array (n_sta, n_seg, nfft//2+1) of the spectra, complex64 for float32 data
+    nfft: the length of the transforms
+    nseg_pts: the number of points of a segment
+    '''
+    data = np.atleast_2d(data)
+    npts = data.shape[-1]
+    nseg_pts = npts if cc_len is None else int(round(cc_len*samp_freq))
+    nstep = nseg_pts if step is None else int(round(step*samp_freq))
+    if nseg_pts < 2 or nseg_pts > npts or nstep < 1:
+        raise ValueError('the segment length should be between 2 points and the record length! please double check!')
+
+    # segments as a view of data, no copy before the transform
+    nseg = (npts-nseg_pts)//nstep+1
+    segments = np.lib.stride_tricks.sliding_window_view(data, nseg_pts, axis=-1)[:, ::nstep][:, :nseg]
+
+    nfft = next_fast_len(2*nseg_pts-1,real=True)
+    spec = rfft(segments, nfft, axis=-1)
+    return spec, nfft, nseg_pts
+
+
+def cross_correlate(spec, nfft, samp_freq, maxlag, pairs=None, block_size=64):
+    '''
+    This function computes the cross-correlation C_ij(t) = sum a_i(s) a_j(s+t) of station pairs from their spectra,
+    averaged over the segments. A positive lag means that the signal arrives later at station j.
+    PARAMETERS:
+    ----------------
+    spec: the spectra from station_spectra
+    nfft: the length of the transforms from station_spectra
+    samp_freq: sampling frequency
+    maxlag: the maximum lag in seconds
+    pairs: a tuple of two integer arrays (ii, jj) from get_pair_list. Default is None (all pairs without auto).
+    block_size: the number of pairs multiplied at once, which bounds the memory to block_size*n_seg*nfreq
+    RETURNS:
+    ----------------
+    lags: a 1D array of the lags in seconds
+    ccf: a 2D array (n_pairs, n_lags) of the correlation functions, float32 for complex64 spectra
+    '''
+    if pairs is None:
+        pairs = get_pair_list(len(spec))
+    ii, jj = np.asarray(pairs[0]), np.asarray(pairs[1])
+    maxlag_pts = int(round(maxlag*samp_freq))
+    if maxlag_pts < 0 or 2*maxlag_pts+1 > nfft:
+        raise ValueError('the maximum lag is longer than the segments! please double check!')
+
+    lags = np.arange(-maxlag_pts, maxlag_pts+1)/samp_freq
+    ccf = np.empty((len(ii), len(lags)), dtype=np.float32 if spec.dtype == np.complex64 else np.float64)
+    for b0 in range(0, len(ii), block_size):
+        b1 = min(b0+block_size, len(ii))
+        # average the spectral products over segments before the single inverse transform of every pair
+        prod = (np.conj(spec[ii[b0:b1]])*spec[jj[b0:b1]]).mean(axis=1)
+        cc = irfft(prod, nfft, axis=-1)
+        # negative lags wrap around to the end of the inverse transform
+        ccf[b0:b1, :maxlag_pts] = cc[:, nfft-maxlag_pts:]
+        ccf[b0:b1, maxlag_pts:] = cc[:, :maxlag_pts+1]
+    return lags, ccf
+
+
+def correlate(traces, maxlag, samp_freq=None, cc_len=None, step=None, auto=False, block_size=64):
+    '''
+    This function cross-correlates all station pairs of the summed normalised waveforms.
+    PARAMETERS:
+    ----------------
+    traces: a list of obspy traces with the same sampling rate and length (e.g. sum_FTN_list), or a 2D array
+            (n_sta, npts)
+    maxlag: the maximum lag in seconds
+    samp_freq: sampling frequency, required for an array and taken from the traces otherwise
+    cc_len, step: length of and step between the segments in seconds, see station_spectra
+    auto: whether to include the auto-correlations. Default is False.
+    block_size: the number of pairs multiplied at once, see cross_correlate
+    RETURNS:
+    ----------------
+    pairs: a list of (i, j) station indices of the rows of ccf
+    lags: a 1D array of the lags in seconds
+    ccf: a 2D array (n_pairs, n_lags) of the correlation functions
+    '''
+    if isinstance(traces, (list, obspy.Stream)):
+        if len(set(tr.stats.sampling_rate for tr in traces)) != 1 or len(set(tr.stats.npts for tr in traces)) != 1:
+            raise ValueError('traces should have the same sampling rate and length! please double check!')
+        samp_freq = traces[0].stats.sampling_rate
+        traces = np.vstack([tr.data for tr in traces])
+    elif samp_freq is None:
+        raise ValueError('samp_freq is required for an array! please double check!')
+
+    pairs = get_pair_list(len(traces), auto=auto)
+    spec, nfft, nseg_pts = station_spectra(traces, samp_freq, cc_len, step)
+    lags, ccf = cross_correlate(spec, nfft, samp_freq, maxlag, pairs, block_size)
+    return list(zip(pairs[0].tolist(), pairs[1].tolist())), lags, ccf
@@ -1,24 +1,24 @@
 import os
 import glob
-import copy
 import obspy
 import scipy
 import time
-import pycwt
 import pyasdf
 import datetime
 import numpy as np
 import pandas as pd
 import sys
-from numba import jit
 from scipy.signal import hilbert
 from obspy.signal.util import _npts2nfft
 from obspy.signal.invsim import cosine_taper
 from scipy.fftpack import fft,ifft,next_fast_len
 from obspy.signal.filter import bandpass,lowpass
-from obspy.signal.regression import linear_regression
-from obspy.core.util.base import _get_function_from_entry_point
 from obspy.core.inventory import Inventory, Network, Station, Channel, Site
 from obspy.clients.fdsn import Client
 
 
+'''
+    This script imports the packages used interactively in the notebooks (FTN.ipynb, run_test_FTN.ipynb) and the
+    tests with `from dependencies import *`. The modules do not use it: each of them imports only what it needs, and
+    loads the heavy optional backends (FDSN client, ASDF, numba) on first use.
+'''
@@ -1,32 +1,24 @@
 import os
-import glob
-import copy
-import obspy
-import scipy
+import io
+import json
 import time
-import pycwt
-import pyasdf
+import hashlib
 import datetime
-import numpy as np
-import pandas as pd
-import sys
-from numba import jit
-from scipy.signal import hilbert
-from obspy.signal.util import _npts2nfft
-from obspy.signal.invsim import cosine_taper
-from scipy.fftpack import fft,ifft,next_fast_len
-from obspy.signal.filter import bandpass,lowpass
-from obspy.signal.regression import linear_regression
-from obspy.core.util.base import _get_function_from_entry_point
-from obspy.core.inventory import Inventory, Network, Station, Channel, Site
-from obspy.clients.fdsn import Client
+import threading
+import obspy
+from concurrent.futures import ThreadPoolExecutor
+import profiling
 
 
 '''
-    This script contains two functions: get_event_list and download.
+    This script contains four functions: get_event_list, download, download_concurrent and load_manifest, and the 
+    InventoryCache class.
     
     This script retrieves datetime information as requested and download seismic data and corresponding inventories that contains 
     information on network --> station --> channel. 
+    
+    Every downloaded station and chunk is recorded in a manifest in the data folder, so that a rerun skips the chunks 
+    that are already on disk and reads them back instead. 
 '''
 
 
@@ -66,7 +58,8 @@ def get_event_list(str1,str2,inc_hours):
     return event
 
 
-def download(all_chunk,nsta,net,sta,location,direc,chan,client,ncomp):
+@profiling.instrument('download')
+def download(all_chunk,nsta,net,sta,location,direc,chan,client,ncomp,inv_cache=None,resume=True):
     '''
     This function downloads the raw waveform for requested stations and times. 
     PARAMETERS:
@@ -79,7 +72,13 @@ def download(all_chunk,nsta,net,sta,location,direc,chan,client,ncomp):
     direc: a string of path to store the data
     chan: a list of string that specifies the channels of stations
     client: data centre of obspy.Client
-    ncomp: an interger of the number of cross-correlation component
+    ncomp: an interger of the number of cross-correlation component (unused, kept for the call signature)
+    inv_cache: an optional InventoryCache. If given, the inventory of each station is only downloaded when no cached
+               inventory covers the chunk, and inv_list refers to the cached objects instead of holding copies.
+    resume: whether to read the chunks recorded in the manifest of direc from disk instead of downloading them again.
+            Default is True. Files whose size or checksum do not match the manifest are downloaded again. Without
+            inv_cache, the inventory of every chunk is kept next to its waveform as a StationXML file, so that a
+            rerun on completed chunks sends no request at all (with inv_cache, the cache folder plays that part).
     
     RETURNS:
     ----------------
@@ -92,6 +91,9 @@ def download(all_chunk,nsta,net,sta,location,direc,chan,client,ncomp):
     inv_list = []
     tr_list = []
     
+    #chunks completed by a previous run
+    manifest = load_manifest(direc) if resume else {}
+    
     #loop through each event
     for ick in range(len(all_chunk)-1):
 
@@ -99,16 +101,20 @@ def download(all_chunk,nsta,net,sta,location,direc,chan,client,ncomp):
         s2=obspy.UTCDateTime(all_chunk[ick+1]) #end time 
         date_info = {'starttime':s1,'endtime':s2} 
     
-        # keep a track of the channels already exists
-        num_records = np.zeros(nsta,dtype=np.int16) #number of stations
-    # loop through each channel
+        # loop through each channel
         for ista in range(nsta):
-            # continue when there are alreay data for sta A at day X
-            if num_records[ista] == ncomp:
-                continue
+            # a chunk completed by a previous run is read from disk, with its inventory
+            key = _manifest_key(net[ista],sta[ista],location[ista],chan[ista],all_chunk[ick],all_chunk[ick+1])
+            tr = _read_chunk(manifest.get(key),direc)
+            inv = None if tr is None else _read_inventory(manifest.get(key),direc)
 
             # get inventory for specific station
-            inv = client.get_stations(network=net[ista],
+            if inv is not None:
+                pass
+            elif inv_cache is not None:
+                inv = inv_cache.get(client,net[ista],sta[ista],location[ista],chan[ista],s1,s2)
+            else:
+                inv = client.get_stations(network=net[ista],
                                             station=sta[ista],
                                             location=location[ista],
                                             starttime=s1,
@@ -123,21 +129,386 @@ def download(all_chunk,nsta,net,sta,location,direc,chan,client,ncomp):
 
  
             # get data
-            tr = client.get_waveforms(network=net[ista],
-                                        station=sta[ista],
-                                        channel=chan[ista],
-                                        location=location[ista],
-                                        starttime=s1,
-                                        endtime=s2)
-            # filename of the saved file
-            ff=os.path.join(direc,all_chunk[ick]+'T'+all_chunk[ick+1]+'.'+sta[ista]+'.'+chan[ista]+'.sac')
-            tr.write(ff, format="SAC") 
+            if tr is None:
+                tr = client.get_waveforms(network=net[ista],
+                                            station=sta[ista],
+                                            channel=chan[ista],
+                                            location=location[ista],
+                                            starttime=s1,
+                                            endtime=s2)
+                # filename of the saved file
+                ff=os.path.join(direc,all_chunk[ick]+'T'+all_chunk[ick+1]+'.'+sta[ista]+'.'+chan[ista]+'.sac')
+                _write_chunk(tr,ff,direc,key,None if inv_cache is not None else inv)
             tr_list.append(tr)
             
             if len(tr_list) < 1: 
                 raise ValueError("The raw waveform list cannot be empty.")
      
     return tr_list, inv_list, date_info
-                
 
 
+def _retry(func,retries,backoff,*args,**kwargs):
+    '''
+    This function calls func(*args,**kwargs) and retries it up to retries times with exponential backoff
+    (backoff, 2*backoff, 4*backoff... seconds) when the request fails. Missing data is not retried.
+    '''
+    from obspy.clients.fdsn.header import FDSNNoDataException
+    for attempt in range(retries+1):
+        try:
+            return func(*args,**kwargs)
+        except FDSNNoDataException:
+            raise
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(backoff*2**attempt)
+
+
+def _retry_or_none(func,retries,backoff,*args,**kwargs):
+    '''
+    This function calls func(*args,**kwargs) with _retry, but returns None instead of raising when the data centre
+    has no data for the request (FDSNNoDataException), so that one missing station or chunk does not abort a download.
+    '''
+    from obspy.clients.fdsn.header import FDSNNoDataException
+    try:
+        return _retry(func,retries,backoff,*args,**kwargs)
+    except FDSNNoDataException:
+        return None
+
+
+@profiling.instrument('download_chunk')
+def _download_chunk(ick,all_chunk,stations,direc,client,bulk,retries,backoff,inv_cache=None,manifest=None):
+    '''
+    This function downloads the waveforms and inventories of the (net,sta,location,chan) tuples in stations for
+    chunk ick, writes the waveforms to direc and returns a list of (ista,tr,inv) for the stations that have data.
+    Waveforms of chunks recorded in manifest are read from disk. Stations without waveforms or inventory at the
+    data centre are skipped.
+    '''
+    s1=obspy.UTCDateTime(all_chunk[ick]) #start time
+    s2=obspy.UTCDateTime(all_chunk[ick+1]) #end time
+
+    # waveforms and inventories completed by a previous run
+    done = {}
+    manifest = manifest or {}
+    for ista,(n,s,l,c) in stations:
+        record = manifest.get(_manifest_key(n,s,l,c,all_chunk[ick],all_chunk[ick+1]))
+        tr = _read_chunk(record,direc)
+        if tr is not None:
+            done[ista] = (tr,_read_inventory(record,direc))
+
+    inv_all = None
+    if bulk:
+        # one request for all stations, without the completed ones
+        request = [(n,s,l,c,s1,s2) for ista,(n,s,l,c) in stations if ista not in done or done[ista][1] is None]
+        missing = [(n,s,l,c,s1,s2) for ista,(n,s,l,c) in stations if ista not in done]
+        if inv_cache is None and len(request) > 0:
+            inv_all = _retry_or_none(client.get_stations_bulk,retries,backoff,request,level="response")
+        if len(missing) > 0:
+            st_all = _retry_or_none(client.get_waveforms_bulk,retries,backoff,missing)
+            # no data for any of the stations
+            if st_all is None:
+                st_all = obspy.Stream()
+
+    records = []
+    for ista,(n,s,l,c) in stations:
+        # get inventory for specific station
+        if ista in done and done[ista][1] is not None:
+            inv = done[ista][1]
+        elif inv_cache is not None:
+            inv = _retry_or_none(inv_cache.get,retries,backoff,client,n,s,l,c,s1,s2)
+        elif bulk:
+            inv = None if inv_all is None else inv_all.select(network=n,station=s,location=l)
+        else:
+            inv = _retry_or_none(client.get_stations,retries,backoff,network=n,station=s,location=l,
+                                 starttime=s1,endtime=s2,level="response")
+        if inv is None or len(inv.networks) == 0:
+            print('no inventory for %s.%s between %s and %s' % (n,s,s1,s2))
+            continue
+
+        # get data for specific station
+        if ista in done:
+            tr = done[ista][0]
+        elif bulk:
+            tr = st_all.select(network=n,station=s,location=l,channel=c)
+        else:
+            tr = _retry_or_none(client.get_waveforms,retries,backoff,network=n,station=s,channel=c,location=l,
+                                starttime=s1,endtime=s2)
+
+        if tr is None or len(tr) == 0:
+            print('no data for %s.%s between %s and %s' % (n,s,s1,s2))
+            continue
+
+        if ista not in done:
+            # filename of the saved file
+            ff=os.path.join(direc,all_chunk[ick]+'T'+all_chunk[ick+1]+'.'+s+'.'+c+'.sac')
+            _write_chunk(tr,ff,direc,_manifest_key(n,s,l,c,all_chunk[ick],all_chunk[ick+1]),
+                         None if inv_cache is not None else inv)
+        records.append((ista,tr,inv))
+
+    return records
+
+
+def _download_chunk_count(*args):
+    '''_download_chunk that returns the number of stations with data instead of their waveforms'''
+    return len(_download_chunk(*args))
+
+
+@profiling.instrument('download')
+def download_concurrent(all_chunk,nsta,net,sta,location,direc,chan,client,ncomp,max_workers=4,retries=3,backoff=1.,bulk=True,
+                        inv_cache=None,resume=True,keep=True):
+    '''
+    This function downloads the raw waveform for requested stations and times like download, but the requests are
+    sent concurrently from a bounded pool of max_workers threads and every request is retried with backoff.
+    With bulk=True, the stations of one chunk are requested together with the FDSN bulk requests
+    (get_stations_bulk/get_waveforms_bulk), i.e. two requests per chunk instead of two per station and chunk.
+    Stations and chunks for which the data centre has no data are skipped.
+    PARAMETERS:
+    ----------------
+    all_chunk: a numpy character list that contains events from get_event_list
+    nsta: an integer of number of stations
+    net: a list of string that specifies the networks of stations
+    sta: a list of string that specifies the station names
+    location: a list of string that specifies the locations of stations
+    direc: a string of path to store the data
+    chan: a list of string that specifies the channels of stations
+    client: data centre of obspy.Client (or any object with the same request methods)
+    ncomp: an interger of the number of cross-correlation component (unused, kept for the call signature)
+    max_workers: an integer of the maximum number of concurrent requests. Default is 4.
+    retries: an integer of the number of retries of a failed request. Default is 3.
+    backoff: a float of the waiting time in seconds before the first retry, doubled for every retry. Default is 1.
+    bulk: whether to use the FDSN bulk requests. Default is True.
+    inv_cache: an optional InventoryCache, see download.
+    resume: whether to read the chunks recorded in the manifest of direc from disk, see download. Default is True.
+    keep: whether to return the waveforms and inventories. Default is True. With keep=False they are only written to
+          direc and released as soon as their job is finished, so that the memory is bounded by max_workers jobs
+          whatever the length of all_chunk, and a date range without any data is not an error.
+
+    RETURNS:
+    ----------------
+    tr_list: a list of obspy Stream traces that contain the raw waveform, in the same order as download (empty with
+             keep=False)
+    inv_list: a list of metedata of the donwloaded waveform, one per element of tr_list (empty with keep=False)
+    date_info: a dictionary of start and end time of downloaded waveform (the last chunk)
+    '''
+    stations = [(ista,(net[ista],sta[ista],location[ista],chan[ista])) for ista in range(nsta)]
+    manifest = load_manifest(direc) if resume else {}
+
+    # one job per chunk (bulk) or per station and chunk
+    jobs = []
+    for ick in range(len(all_chunk)-1):
+        if bulk:
+            jobs.append((ick,stations))
+        else:
+            jobs.extend([(ick,[station]) for station in stations])
+
+    date_info = {'starttime':obspy.UTCDateTime(all_chunk[-2]),'endtime':obspy.UTCDateTime(all_chunk[-1])}
+    # only the number of downloaded stations of a job is kept, its waveforms are released when it is finished
+    job = _download_chunk if keep else _download_chunk_count
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(job,ick,all_chunk,job_stations,direc,client,bulk,retries,backoff,inv_cache,manifest)
+                   for ick,job_stations in jobs]
+        if not keep:
+            for future in futures:
+                future.result()
+            return [], [], date_info
+        # collect in submission order, which is the order of download
+        records = [record for future in futures for record in future.result()]
+
+    tr_list = [tr for ista,tr,inv in records]
+    inv_list = [inv for ista,tr,inv in records]
+    if len(tr_list) < 1:
+        raise ValueError("The raw waveform list cannot be empty.")
+
+    return tr_list, inv_list, date_info
+
+
+class InventoryCache:
+    '''
+    This class caches the station inventories (with instrument responses) of (net,sta,location,chan), so that the
+    response metadata are downloaded once per station instead of once per chunk. A cached inventory is reused
+    whenever the epoch of one of its channels covers the requested time range; otherwise the inventory of the
+    requested time range is downloaded and merged into the cache. With a cachedir, the inventories are also kept on
+    disk as StationXML files and are reused by later runs.
+    PARAMETERS:
+    ----------------
+    cachedir: a string of path to store the StationXML files. Default is None (in memory only).
+    ATTRIBUTES:
+    ----------------
+    hits, misses: integers of the number of requests served from the cache and from the client
+    '''
+
+    def __init__(self,cachedir=None):
+        if cachedir is not None and not os.path.isdir(cachedir):
+            raise ValueError('inventory cache folder not found! abort!')
+        self.cachedir = cachedir
+        self.hits = 0
+        self.misses = 0
+        self._inventories = {}
+        self._lock = threading.Lock()
+
+    def _filename(self,key):
+        # wildcards are not safe in filenames
+        return os.path.join(self.cachedir,'.'.join(key).replace('*','_').replace('?','_')+'.xml')
+
+    def _lookup(self,key):
+        inv = self._inventories.get(key)
+        if inv is None and self.cachedir is not None and os.path.isfile(self._filename(key)):
+            inv = obspy.read_inventory(self._filename(key),format='STATIONXML')
+            self._inventories[key] = inv
+        return inv
+
+    def get(self,client,net,sta,location,chan,starttime,endtime):
+        '''
+        This function returns the inventory of (net,sta,location,chan) valid between starttime and endtime, from the
+        cache if possible and otherwise from client.get_stations.
+        PARAMETERS:
+        ----------------
+        client: data centre of obspy.Client
+        net, sta, location, chan: strings of the network, station, location and channel
+        starttime, endtime: obspy UTCDateTime of the requested time range
+        RETURNS:
+        ----------------
+        inv: obspy Inventory of all the cached epochs of this channel
+        '''
+        key = (net,sta,location,chan)
+        with self._lock:
+            inv = self._lookup(key)
+            if inv is not None and _epoch_covers(inv,starttime,endtime):
+                self.hits += 1
+                return inv
+            self.misses += 1
+
+        new = client.get_stations(network=net,
+                                  station=sta,
+                                  location=location,
+                                  channel=chan,
+                                  starttime=starttime,
+                                  endtime=endtime,
+                                  level="response")
+        with self._lock:
+            inv = self._lookup(key)
+            inv = new if inv is None else inv+new
+            self._inventories[key] = inv
+            if self.cachedir is not None:
+                inv.write(self._filename(key),format='STATIONXML')
+        return inv
+
+
+def _epoch_covers(inv,starttime,endtime):
+    '''whether the epoch of one channel of inv covers starttime to endtime'''
+    for network in inv:
+        for station in network:
+            for channel in station:
+                if channel.start_date is not None and channel.start_date > starttime:
+                    continue
+                if channel.end_date is not None and channel.end_date < endtime:
+                    continue
+                return True
+    return False
+
+
+MANIFEST = 'manifest.jsonl'
+_manifest_lock = threading.Lock()
+
+
+def load_manifest(direc):
+    '''
+    This function reads the manifest of completed chunks in direc (a JSON-lines file written by download and
+    download_concurrent, one line per downloaded station and chunk).
+    PARAMETERS:
+    ----------------
+    direc: a string of path where the data are stored
+    RETURNS:
+    ----------------
+    manifest: a dictionary of records keyed by (net,sta,location,chan,starttime,endtime). Each record lists the SAC
+              files of the chunk with their size in bytes and sha256 checksum, and the StationXML file of its
+              inventory if it was downloaded without an InventoryCache.
+    '''
+    manifest = {}
+    ff = os.path.join(direc,MANIFEST)
+    if not os.path.isfile(ff):
+        return manifest
+    with open(ff) as fp:
+        for line in fp:
+            # skip a line cut short by a crash
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            manifest[_manifest_key(record['net'],record['sta'],record['location'],record['chan'],
+                                   record['starttime'],record['endtime'])] = record
+    return manifest
+
+
+def _manifest_key(net,sta,location,chan,starttime,endtime):
+    return (net,sta,location,chan,starttime,endtime)
+
+
+def _file_record(filename):
+    '''the manifest entry of a written file: its name, size in bytes and sha256 checksum'''
+    with open(filename,'rb') as fp:
+        content = fp.read()
+    return {'file':os.path.basename(filename),'size':len(content),'sha256':hashlib.sha256(content).hexdigest()}
+
+
+def _read_file(item,direc):
+    '''the content of the file of a manifest entry, or None if it is missing or does not match the manifest'''
+    filename = os.path.join(direc,item['file'])
+    if not os.path.isfile(filename) or os.path.getsize(filename) != item['size']:
+        return None
+    with open(filename,'rb') as fp:
+        content = fp.read()
+    if hashlib.sha256(content).hexdigest() != item['sha256']:
+        return None
+    return content
+
+
+def _write_chunk(tr,ff,direc,key,inv=None):
+    '''
+    write the stream tr to the SAC file(s) ff, and the inventory inv (if given) to a StationXML file next to it, and
+    append the completed chunk to the manifest of direc
+    '''
+    tr.write(ff, format="SAC")
+
+    # obspy numbers the files when the stream has more than one trace
+    if len(tr) == 1:
+        filenames = [ff]
+    else:
+        base, ext = os.path.splitext(ff)
+        filenames = ["%s%02d%s" % (base,i+1,ext) for i in range(len(tr))]
+
+    files = [_file_record(filename) for filename in filenames]
+
+    net,sta,location,chan,starttime,endtime = key
+    record = {'net':net,'sta':sta,'location':location,'chan':chan,'starttime':starttime,'endtime':endtime,'files':files}
+    if inv is not None:
+        filename = os.path.splitext(ff)[0]+'.xml'
+        inv.write(filename,format='STATIONXML')
+        record['inventory'] = _file_record(filename)
+    with _manifest_lock:
+        with open(os.path.join(direc,MANIFEST),'a') as fp:
+            fp.write(json.dumps(record)+'\n')
+
+
+def _read_chunk(record,direc):
+    '''read back the stream of a completed chunk, or None if a file is missing or does not match the manifest'''
+    if record is None:
+        return None
+    tr = obspy.Stream()
+    for item in record['files']:
+        content = _read_file(item,direc)
+        if content is None:
+            return None
+        tr += obspy.read(io.BytesIO(content),format='SAC')
+    return tr
+
+
+def _read_inventory(record,direc):
+    '''read back the inventory of a completed chunk, or None if it was not kept or does not match the manifest'''
+    if record is None or 'inventory' not in record:
+        return None
+    content = _read_file(record['inventory'],direc)
+    if content is None:
+        return None
+    return obspy.read_inventory(io.BytesIO(content),format='STATIONXML')
@@ -0,0 +1,382 @@
+import os
+import csv
+import sys
+import argparse
+import numpy as np
+import download_raw_data
+import pipeline
+import normalisation
+import profiling
+from shared import TraceArray
+
+
+'''
+    This script runs the frequency-time normalisation from the command line, e.g. on a headless compute node, with
+    the parameters of the parameter section of FTN.ipynb in a TOML or YAML config file:
+    1) read the config and the station list (the same csv as FTN.ipynb: network,station,channel[,location],...)
+    2) plan the run: one task per (station, time chunk) of the date range, and which of them are already done
+    3) run the selected stages in order:
+        download   -> download the raw waveforms and inventories concurrently into direc (resumed from its manifest)
+        preprocess -> check gaps and pre-process the downloaded waveforms, in parallel over workers processes
+        normalise  -> frequency-time normalise the pre-processed waveforms and write them to outdir (and store)
+
+    Run it with e.g.
+        python ftn.py config.toml --dry-run
+        python ftn.py config.toml --workers 8
+        python ftn.py config.toml --stages download
+        python ftn.py config.toml --stages preprocess,normalise --workers 8
+
+    An example config (TOML), relative paths are relative to rootpath (or to the folder of the config):
+        rootpath   = '/data/FTN'
+        direc      = 'DATA_NZ'                  # downloaded raw waveforms
+        dlist      = 'stations.txt'             # station list
+        outdir     = 'FTN'                      # normalised waveforms
+        shared     = false                      # true: one memory-mapped (station, sample) array per chunk in outdir
+        client     = 'IRIS'
+        samp_freq  = 1
+        rm_resp    = 'inv'
+        freqmin    = 0.005
+        freqmax    = 0.1
+        window_spacing = 'linear'               # or 'constant-q'/'log' for fewer frequency windows
+        start_date = '2021_11_01_0_0_0'
+        end_date   = '2021_11_08_0_0_0'
+        inc_hours  = 24
+        workers    = 8
+
+    Functions: load_config, check_config, read_station_list, plan, run, main.
+'''
+
+
+STAGES = ('download',)+pipeline.STAGES
+
+# parameters of a config and their default values (None: required)
+DEFAULTS = {'rootpath':None,
+            'direc':'DATA',
+            'dlist':None,
+            'outdir':'FTN',
+            'store':None,
+            'client':'IRIS',
+            'samp_freq':1,
+            'rm_resp':'inv',
+            'rm_resp_out':'VEL',
+            'respdir':'resp',
+            'freqmin':0.005,
+            'freqmax':0.1,
+            'dtype':None,
+            'window_spacing':'linear',
+            'start_date':None,
+            'end_date':None,
+            'inc_hours':1,
+            'stages':list(STAGES),
+            'workers':1,
+            'backend':'process',
+            'download_workers':4,
+            'bulk':True,
+            'overwrite':False,
+            'shared':False}
+
+_PATHS = ['direc','dlist','outdir','store','respdir']
+
+
+def load_config(path):
+    '''
+    This function reads a config file.
+    PARAMETERS:
+    ----------------
+    path: a string of the config file, .toml or .yaml/.yml (requires PyYAML)
+    RETURNS:
+    ----------------
+    config: a dict of all the parameters, see check_config
+    '''
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.toml':
+        try:
+            import tomllib
+        except ImportError:
+            # python < 3.11
+            import tomli as tomllib
+        with open(path,'rb') as fp:
+            config = tomllib.load(fp)
+    elif ext in ['.yaml','.yml']:
+        import yaml
+        with open(path) as fp:
+            config = yaml.safe_load(fp) or {}
+    else:
+        raise ValueError('no such option for config format! please double check!')
+    return check_config(config,os.path.dirname(os.path.abspath(path)))
+
+
+def check_config(config,base='.'):
+    '''
+    This function checks the parameters of a config and fills in the defaults.
+    PARAMETERS:
+    ----------------
+    config: a dict of parameters, with the keys of DEFAULTS
+    base: the folder of relative paths when rootpath is not given. Default is the current folder.
+    RETURNS:
+    ----------------
+    config: a new dict of all the parameters, with absolute paths, start_date and end_date as strings and stages
+            as a tuple in processing order
+    '''
+    for key in config:
+        if key not in DEFAULTS:
+            raise ValueError('no such option for %s in the config! please double check!' % key)
+    config = dict(DEFAULTS,**config)
+    for key in ['dlist','start_date','end_date']:
+        if config[key] is None:
+            raise ValueError('%s is required in the config! please double check!' % key)
+
+    # paths relative to rootpath, or to the folder of the config
+    root = base if config['rootpath'] is None else os.path.join(base,config['rootpath'])
+    for key in _PATHS:
+        if config[key] is not None:
+            config[key] = os.path.abspath(os.path.join(root,config[key]))
+    if config['outdir'] == config['direc']:
+        raise ValueError('outdir and direc should be different folders! please double check!')
+
+    # dates as in FTN.ipynb, where they are lists of one string
+    for key in ['start_date','end_date']:
+        if isinstance(config[key],(list,tuple)):
+            config[key] = config[key][0]
+        config[key] = str(config[key])
+        # YAML reads an unquoted 2021_11_01_0_0_0 as the integer 202111010
+        if len(config[key].split('_')) != 6:
+            raise ValueError('%s should be a quoted string of year_month_day_hour_minute_second! please double check!' % key)
+
+    if isinstance(config['stages'],str):
+        config['stages'] = config['stages'].split(',')
+    stages = [stage.strip() for stage in config['stages']]
+    if len(stages) == 0 or any(stage not in STAGES for stage in stages):
+        raise ValueError('no such option for stages! please double check!')
+    istages = sorted(STAGES.index(stage) for stage in set(stages))
+    if istages != list(range(istages[0],istages[-1]+1)):
+        raise ValueError('stages should be consecutive (e.g. download,preprocess)! please double check!')
+    config['stages'] = tuple(STAGES[ii] for ii in istages)
+
+    if config['rm_resp'] not in ['no','inv','RESP','polozeros']:
+        raise ValueError('no such option for rm_resp! please double check!')
+    if config['window_spacing'] not in normalisation.SPACINGS:
+        raise ValueError('no such option for window_spacing! please double check!')
+    if config['dtype'] not in [None,'float32','float64']:
+        raise ValueError('no such option for dtype! please double check!')
+    if config['backend'] not in ['process','mpi']:
+        raise ValueError('no such option for backend! please double check!')
+    if config['freqmin'] >= config['freqmax'] or config['freqmax'] > 0.5*config['samp_freq']:
+        raise ValueError('freqmax should be above freqmin and not exceed the Nyquist frequency! please double check!')
+    if int(config['workers']) < 1 or int(config['download_workers']) < 1:
+        raise ValueError('the number of workers should be positive! please double check!')
+    if config['store'] is not None and 'normalise' not in config['stages']:
+        raise ValueError('only normalised waveforms can be stored! please double check!')
+    return config
+
+
+def read_station_list(path):
+    '''
+    This function reads the station list.
+    PARAMETERS:
+    ----------------
+    path: a string of the csv file with the columns network, station, channel and optionally location
+    RETURNS:
+    ----------------
+    net, sta, location, chan: lists of strings of the stations (location '*' if not given)
+    '''
+    net, sta, location, chan = [], [], [], []
+    with open(path, newline='') as fp:
+        for row in csv.DictReader(fp):
+            row = {key.strip():value.strip() for key,value in row.items() if key is not None and value is not None}
+            if not all(row.get(key) for key in ['network','station','channel']):
+                raise ValueError('the station list needs network, station and channel! please double check!')
+            net.append(row['network'])
+            sta.append(row['station'])
+            location.append(row.get('location') or '*')
+            chan.append(row['channel'])
+    if len(sta) < 1:
+        raise ValueError('the station list is empty! please double check!')
+    return net, sta, location, chan
+
+
+def _prepro_para(config):
+    '''pre-processing parameters of processing.preprocess_raw from the config'''
+    para = {key:config[key] for key in ['rm_resp','rm_resp_out','respdir','freqmin','freqmax','samp_freq','inc_hours',
+                                        'window_spacing']}
+    para['start_date'] = [config['start_date']]
+    para['end_date'] = [config['end_date']]
+    if config['dtype'] is not None:
+        para['dtype'] = np.dtype(config['dtype']).type
+    return para
+
+
+def _task_done(task,config,stages):
+    '''whether the output of a task is already in outdir'''
+    ff = pipeline.task_output(task,config['outdir'],stages,config['shared'])
+    if not os.path.isfile(ff):
+        return False
+    if config['shared']:
+        arr = TraceArray(ff)
+        seed_id = pipeline.task_id(task)
+        return seed_id in arr.ids and arr.filled[arr.row(seed_id)]
+    return True
+
+
+def plan(config):
+    '''
+    This function plans a run without downloading or writing anything.
+    PARAMETERS:
+    ----------------
+    config: a dict from load_config or check_config
+    RETURNS:
+    ----------------
+    plan: a dict with the station list (net, sta, location, chan), the chunks (all_chunk), the tasks, the tasks still
+          to run (todo), the number of station-chunks already downloaded into direc (raw_chunks), and the number of points and bytes of the output
+          of every task
+    '''
+    net, sta, location, chan = read_station_list(config['dlist'])
+    all_chunk = download_raw_data.get_event_list(config['start_date'],config['end_date'],config['inc_hours'])
+    if len(all_chunk) < 2:
+        raise ValueError('the date range is shorter than inc_hours! please double check!')
+    tasks = pipeline.get_task_list(all_chunk,net,sta,location,chan)
+
+    processing_stages = [stage for stage in config['stages'] if stage in pipeline.STAGES]
+    if len(processing_stages) == 0 or config['overwrite']:
+        todo = list(tasks) if len(processing_stages) > 0 else []
+    else:
+        todo = [task for task in tasks if not _task_done(task,config,processing_stages)]
+
+    raw = download_raw_data.load_manifest(config['direc']) if os.path.isdir(config['direc']) else {}
+    npts = int(round(config['inc_hours']*3600*config['samp_freq']))
+    return {'net':net,'sta':sta,'location':location,'chan':chan,
+            'all_chunk':all_chunk,
+            'tasks':tasks,
+            'todo':todo,
+            'raw_chunks':len(raw),
+            'npts':npts,
+            # 4-byte samples, and a 632-byte header for a SAC file
+            'task_bytes':4*npts+(0 if config['shared'] else 632)}
+
+
+def _print_plan(config,run_plan):
+    print('stations      %d (%s)' % (len(run_plan['sta']),', '.join('.'.join(ss) for ss in zip(run_plan['net'],run_plan['sta'],run_plan['chan']))))
+    print('date range    %s -> %s, %d chunks of %g hours' % (config['start_date'],config['end_date'],
+          len(run_plan['all_chunk'])-1,config['inc_hours']))
+    print('stages        %s' % ' -> '.join(config['stages']))
+    if 'download' in config['stages']:
+        print('download      %d station-chunks from %s into %s (%d already downloaded)' % (len(run_plan['tasks']),
+              config['client'],config['direc'],run_plan['raw_chunks']))
+    if any(stage in pipeline.STAGES for stage in config['stages']):
+        print('tasks         %d of %d to run (%d already done), %d workers (%s)' % (len(run_plan['todo']),
+              len(run_plan['tasks']),len(run_plan['tasks'])-len(run_plan['todo']),int(config['workers']),config['backend']))
+        print('output        %s, %d points and %.1f MB per task, %.1f MB in total' % (config['outdir'],run_plan['npts'],
+              run_plan['task_bytes']/1e6,len(run_plan['todo'])*run_plan['task_bytes']/1e6))
+    if config['store'] is not None:
+        print('store         %s' % config['store'])
+
+
+def _inventory_dir(config):
+    return os.path.join(config['direc'],'inventory')
+
+
+def _download(config,run_plan,client=None):
+    '''
+    download the raw waveforms and inventories of the plan into direc. Every chunk is written and released as soon
+    as it is downloaded, so that the memory is bounded by download_workers chunks whatever the date range.
+    '''
+    if client is None:
+        from obspy.clients.fdsn import Client
+        client = Client(config['client'])
+    inv_cache = download_raw_data.InventoryCache(_inventory_dir(config))
+    net, sta, location, chan = run_plan['net'], run_plan['sta'], run_plan['location'], run_plan['chan']
+    download_raw_data.download_concurrent(run_plan['all_chunk'],len(sta),net,sta,location,config['direc'],chan,client,1,
+                                          max_workers=int(config['download_workers']),bulk=config['bulk'],
+                                          inv_cache=inv_cache,keep=False)
+
+
+def run(config,dry_run=False):
+    '''
+    This function runs the selected stages of a config.
+    PARAMETERS:
+    ----------------
+    config: a dict from load_config or check_config
+    dry_run: whether to only print the plan. Default is False.
+    RETURNS:
+    ----------------
+    nfailed: the number of tasks that did not write an output (0 for a dry run or a download-only run)
+    '''
+    run_plan = plan(config)
+    _print_plan(config,run_plan)
+    if dry_run:
+        return 0
+
+    rank = 0
+    if config['backend'] == 'mpi':
+        from mpi4py import MPI
+        rank = MPI.COMM_WORLD.Get_rank()
+
+    if 'download' in config['stages']:
+        if rank == 0:
+            os.makedirs(_inventory_dir(config),exist_ok=True)
+            _download(config,run_plan)
+        if config['backend'] == 'mpi':
+            MPI.COMM_WORLD.Barrier()
+
+    stages = tuple(stage for stage in config['stages'] if stage in pipeline.STAGES)
+    if len(stages) == 0 or len(run_plan['todo']) == 0:
+        return 0
+
+    os.makedirs(config['outdir'],exist_ok=True)
+    if 'preprocess' in stages:
+        if not os.path.isdir(config['direc']):
+            raise ValueError('raw data folder not found, run the download stage first! abort!')
+        # the archive is opened once per process by the pipeline rather than sent with every task
+        source = (config['direc'],'SAC',os.path.join(_inventory_dir(config),'*.xml'))
+    else:
+        source = None
+    results = pipeline.run_pipeline(run_plan['todo'],source,_prepro_para(config),config['outdir'],
+                                    workers=int(config['workers']),backend=config['backend'],store=config['store'],
+                                    stages=stages,shared=config['shared'])
+    if results is None:
+        # MPI ranks other than 0
+        return 0
+    nfailed = sum(ff is None for ff in results)
+    print('finished      %d of %d tasks, %d without output' % (len(results)-nfailed,len(results),nfailed))
+    return nfailed
+
+
+def main(argv=None):
+    '''
+    This function is the command-line entry point, see the description of this script.
+    RETURNS:
+    ----------------
+    status: 0 if every task wrote its output, 1 otherwise
+    '''
+    parser = argparse.ArgumentParser(description='frequency-time normalisation of a date range of station data')
+    parser.add_argument('config', help='TOML or YAML config file')
+    parser.add_argument('--stages', help='comma-separated stages to run among %s (default: the config)' % ','.join(STAGES))
+    parser.add_argument('--workers', type=int, help='number of processes (default: the config)')
+    parser.add_argument('--backend', choices=['process','mpi'], help='process pool or MPI ranks (default: the config)')
+    parser.add_argument('--overwrite', action='store_true', help='run the tasks whose output already exists')
+    parser.add_argument('--dry-run', action='store_true', help='only print the plan of the run')
+    parser.add_argument('--profile', help='JSON file to write the per-stage timings to, with the cProfile statistics of '
+                        'the slowest tasks in a folder of the same name, see profiling.py')
+    args = parser.parse_args(argv)
+
+    config = load_config(args.config)
+    overrides = {'stages':args.stages,'workers':args.workers,'backend':args.backend}
+    overrides = {key:value for key,value in overrides.items() if value is not None}
+    if args.overwrite:
+        overrides['overwrite'] = True
+    if overrides:
+        config = check_config(dict(config,**overrides))
+
+    if args.profile:
+        profiling.enable(cprofile=True)
+    nfailed = run(config,dry_run=args.dry_run)
+    if args.profile:
+        profiling.write_json(args.profile)
+        profdir = os.path.splitext(args.profile)[0]
+        os.makedirs(profdir,exist_ok=True)
+        profiling.dump_profiles(profdir)
+    return 1 if nfailed > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
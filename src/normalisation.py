@@ -1,39 +1,36 @@
-import os
-import glob
-import copy
 import obspy
-import scipy
-import time
-import pycwt
-import pyasdf
-import datetime
 import numpy as np
-import pandas as pd
-import sys
-from numba import jit
-from scipy.signal import hilbert
-from obspy.signal.util import _npts2nfft
-from obspy.signal.invsim import cosine_taper
-from scipy.fftpack import fft,ifft,next_fast_len
-from obspy.signal.filter import bandpass,lowpass
-from obspy.signal.regression import linear_regression
-from obspy.core.util.base import _get_function_from_entry_point
-from obspy.core.inventory import Inventory, Network, Station, Channel, Site
-from obspy.clients.fdsn import Client
-from scipy.signal import butter, lfilter
+from functools import lru_cache
+from scipy.signal import butter, lfilter, sosfilt
+from scipy.fft import rfft, ifft, next_fast_len
+import profiling
 
 
 '''
     This script implements the frequency-time normalisation to pre-proccessed data: 
     1) compute the target frequency range according to their instrument type 
-    2) slice this frequency range into small frequency windows with a fixed interval 
+    2) slice this frequency range into small frequency windows with a fixed interval (or a constant relative width),
+       planned once per type of instrument
     3) construct butterworth bandpass filter at requested frequencies
     4) calculate the Hilbert transformed data and returns normalised arrays 
     
-    Functions: target_frequency, target_frequency_window, butter_bandpass, butter_bandpass_filter, normalisation. 
+    Functions: target_frequency, frequency_windows, window_plan, window_plan_cache_info, target_frequency_window, 
+               butter_bandpass, butter_bandpass_filter, get_filter_bank, filter_bank, filter_bank_cache_info, clear_filter_bank_cache, normalisation_filtering, analytic_filtering_fft, 
+               freq_time_normalisation, freq_time_normalise_sum, freq_time_normalise_batch, 
+               iter_freq_time_normalise_sum, freq_time_normalise_sum_chunked. 
+    Classes: FilterBank. 
 '''
 
 
+# expected filtering range (lowest, highest frequency) of every type of instrument
+TARGET_BANDS = {'HHZ':(0.00167, 0.07),   #very broad band
+                'BHZ':(0.0033, 0.07),    #all other band width
+                'LHZ':(0.0033, 0.07)}
+
+# spacings of the frequency windows, see frequency_windows
+SPACINGS = ('linear', 'log', 'constant-q')
+
+
 def target_frequency (chan, freqmin, freqmax):
     '''This function returns the target frequency range for FTN dependent on the type of instrument.
        
@@ -47,55 +44,108 @@ def target_frequency (chan, freqmin, freqmax):
        -------------------------
        (freq_low, freq_high): a tuple of targeted frequency range to do FTN. 
     '''
+    if chan not in TARGET_BANDS:
+        raise ValueError("no such option for chan! please double check!")
+    target_low, target_high = TARGET_BANDS[chan]
     
-    #expected frequency range for different types of instrument
+    #if the lowest DOWNLOAD frequency is less than the EXPECTED lowest frequency
+    #the FILTERING lowest frequency should be the EXPECTED lowest frequency
+    #otherwise, FILTERING frequency will be the lowest DOWNLOAD frequency
+    freq_low = target_low if freqmin < target_low else freqmin
     
-    target_hh_low = 0.00167 #very broad band
-    target_hh_high = 0.07   #very borad band 
-    target_bh_low = 0.0033  #all other band width
-    target_bh_high = 0.07   #all other band width
-
+    #if the highest DOWNLOAD frequency is more than the EXPECTED highest frequency
+    #the FILTERING highest frequency should be the EXPECTED highest frequency
+    #otherwise, FILTERING frequency will be the highest DOWNLOAD frequency
+    freq_high = target_high if freqmax > target_high else freqmax
     
-    if chan == 'HHZ':
-        
-        #if the lowest DOWNLOAD frequency is less than the EXPECTED lowest frequency
-        #the FILTERING lowest frequency should be the EXPECTED lowest frequency
-        #otherwise, FILTERING frequency will be the lowest DOWNLOAD frequency
-        
-        if freqmin < target_hh_low:
-            freq_low = target_hh_low
-        else: 
-            freq_low = freqmin
-        
-        if freqmax > target_hh_high:
-            
-        #if the highest DOWNLOAD frequency is more than the EXPECTED highest frequency
-        #the FILTERING highest frequency should be the EXPECTED highest frequency
-        #otherwise, FILTERING frequency will be the highest DOWNLOAD frequency
-        
-            freq_high = target_hh_high
-        else: 
-            freq_high = freqmax
-        
-    elif chan == 'BHZ' or 'LHZ':
-        
-        if freqmin < target_bh_low:
-            freq_low = target_bh_low
-        else: 
-            freq_low = freqmin
-        
-        if freqmax > target_bh_high:
-            freq_high = target_bh_high
-        else: 
-            freq_high = freqmax  
+    return freq_low, freq_high
     
 
-
+def frequency_windows(freq_low, freq_high, spacing='linear', q=4, num=None):
+    '''This function slices a frequency range into frequency windows. 
+       
+       PARAMETERS:
+       -------------------------
+       freq_low, freq_high (float): the FILTERING frequency range, e.g. from target_frequency
+       spacing (string): how the windows are laid out, all of them start from freq_low:
+            "linear"     -> windows of the same width freq_low/q, as many as fit below freq_high (Default).
+            "constant-q" -> contiguous windows of the same relative width 1/q, i.e. (f, f*(1+1/q)), as many as fit below freq_high. 
+                            Their number grows with log(freq_high/freq_low) instead of freq_high/freq_low. 
+            "log"        -> num contiguous windows with log-spaced edges from freq_low to exactly freq_high, i.e. of the 
+                            same relative width (freq_high/freq_low)**(1/num)-1. q is only used for the default num. 
+       q (float): the ratio of freq_low to the width of the first window of the "linear" and "constant-q" spacings. Default is 4. 
+       num (int): the number of windows of the "log" spacing. Default is None, the number of "constant-q" windows 
+                  needed to cover freq_low to freq_high (rounded up), so that the "log" windows are at most 1/q wide 
+                  relative to their lower edge. 
+       
+       RETURNS:
+       --------------------------
+       windows (numpy ndarray): lowest & highest frequencies of each frequency window, of shape (n_windows, 2). 
+    '''
+    if spacing not in SPACINGS:
+        raise ValueError("no such option for spacing! please double check!")
+    if freq_low <= 0 or q <= 0:
+        raise ValueError("The frequencies and q should be positive.")
     
-    return freq_low, freq_high
+    #the small tolerance keeps a window that ends at freq_high up to rounding
+    if spacing == 'linear':
+        df = freq_low/q
+        lows = freq_low + df*np.arange(max(int(np.floor((freq_high-freq_low)/df+1e-9)), 0))
+        windows = np.stack([lows, lows+df], axis=-1)
+    else:
+        ratio = 1+1./q
+        nwin = max(int(np.floor(np.log(freq_high/freq_low)/np.log(ratio)+1e-9)), 0) if freq_high > freq_low else 0
+        if spacing == 'constant-q':
+            edges = freq_low*ratio**np.arange(nwin+1)
+        else:
+            if num is None:
+                num = nwin if np.isclose(freq_low*ratio**nwin, freq_high) else nwin+1
+            edges = np.geomspace(freq_low, freq_high, int(num)+1) if freq_high > freq_low and num >= 1 else np.empty(0)
+        windows = np.stack([edges[:-1], edges[1:]], axis=-1) if len(edges) > 1 else np.empty((0, 2))
     
+    if len(windows) < 1:
+        raise ValueError("The output list should not be empty.")
+    
+    return windows
+
 
-def target_frequency_window(chan, freqmin, freqmax):
+@lru_cache(maxsize=256)
+def _cached_window_plan(chan, freqmin, freqmax, samp_freq, spacing, q, num):
+    freq_low, freq_high = target_frequency(chan, freqmin, freqmax)
+    windows = frequency_windows(freq_low, freq_high, spacing=spacing, q=q, num=num)
+    if samp_freq is not None and windows[-1, 1] >= 0.5*samp_freq:
+        raise ValueError("The frequency windows should be below the Nyquist frequency.")
+    windows.flags.writeable = False
+    return windows
+
+
+def window_plan(chan, freqmin, freqmax, samp_freq=None, spacing='linear', q=4, num=None):
+    '''This function returns the frequency windows of a type of instrument. Plans are memoised in an LRU cache per 
+       (chan, freqmin, freqmax, samp_freq, spacing), so the windows are only computed once per channel. 
+       
+       PARAMETERS:
+       -------------------------
+       chan (string): the type of instrument. 'HHZ' 'BHZ' or 'LHZ'. 
+       freqmin: the minimum frequency used to DOWNLOAD raw data.
+       freqmax: the maximum frequency used to DOWNLOAD raw data.
+       samp_freq (float): sampling frequency, to check the windows against the Nyquist frequency. Default is None (no check).
+       spacing, q, num: the layout of the windows, see frequency_windows. Default is the linear spacing of 
+                        target_frequency_window. 
+       
+       RETURNS:
+       -------------------------
+       windows (numpy ndarray): the (shared, read-only) lowest & highest frequencies of each window, of shape (n_windows, 2). 
+    '''
+    return _cached_window_plan(chan, float(freqmin), float(freqmax), None if samp_freq is None else float(samp_freq), 
+                               spacing, float(q), None if num is None else int(num))
+
+
+def window_plan_cache_info():
+    '''This function returns the hits, misses, maxsize and currsize counters of the window plan cache.'''
+    return _cached_window_plan.cache_info()
+
+
+def target_frequency_window(chan, freqmin, freqmax, spacing='linear', q=4, num=None):
     '''This function slices the target frequency range for each frequency window.
        
        PARAMETERS:
@@ -103,30 +153,19 @@ def target_frequency_window(chan, freqmin, freqmax):
        chan (list): the type of instrument. 'HHZ' 'BHZ' or 'LHZ'. (Only vertical component is considered in this project)
        freqmin: the minimum frequency used to DOWNLOAD raw data.
        freqmax: the maximum frequency used to DOWNLOAD raw data.
+       spacing, q, num: the layout of the windows, see frequency_windows. Default is windows of the same width 
+                        (a quarter of the lowest frequency). 
        
        RETURNS:
        --------------------------
        frange (list of tuples): a list of lowest & highest frequencies for each frequency window. 
     '''
-    
-    target_freq = target_frequency (chan, freqmin, freqmax) #call the previous function to return the targeted FILTERING range
-    freq_low = target_freq[0] 
-    freq_high = target_freq[1]
-    
-    df = freq_low/4
-    fstart = freq_low #start from the lowest frequency 
-
-    frange = [] 
+    return list(_cached_window_tuples(chan, float(freqmin), float(freqmax), spacing, float(q), None if num is None else int(num)))
 
-    while fstart <= freq_high-df:
-        frange_tuple = (fstart, fstart+df)
-        frange.append(frange_tuple)
-        fstart = fstart + df 
-    
-    if len(frange) < 1:
-        raise ValueError("The output list should not be empty.")
 
-    return frange
+@lru_cache(maxsize=256)
+def _cached_window_tuples(chan, freqmin, freqmax, spacing, q, num):
+    return tuple(tuple(window) for window in window_plan(chan, freqmin, freqmax, spacing=spacing, q=q, num=num).tolist())
 
 
 def butter_bandpass(lowcut, highcut, fs, order=2):
@@ -152,7 +191,7 @@ def butter_bandpass(lowcut, highcut, fs, order=2):
     return b, a #numerator and denominator polynomials of IIR filter 
 
 
-def butter_bandpass_filter(data, lowcut, highcut, fs, order=2):
+def butter_bandpass_filter(data, lowcut, highcut, fs, order=2, dtype=np.float64):
     '''This function returns the butterworth-filtered data. 
     
        PARAMETERS:
@@ -162,6 +201,7 @@ def butter_bandpass_filter(data, lowcut, highcut, fs, order=2):
        highcut (float): the highest frequency of a butterworth filter
        fs (float/int): sample frequency 
        order (float/int): the order of a butterworth filter. Default is 2 which gives the best normalisation results. 
+       dtype (numpy dtype): the precision of the output, np.float64 (default) or np.float32. 
        
        RETURNS:
        ----------------------
@@ -170,6 +210,8 @@ def butter_bandpass_filter(data, lowcut, highcut, fs, order=2):
     '''
     b, a = butter_bandpass(lowcut, highcut, fs, order=order)
     y = lfilter(b, a, data) #filter data along one dimension
+    #the recursion itself stays in double precision: it is unstable in single precision for narrow bands
+    y = np.asarray(y, dtype=dtype)
     
     if len(y)<1:
         raise ValueError("The output cannot be empty.")
@@ -178,69 +220,520 @@ def butter_bandpass_filter(data, lowcut, highcut, fs, order=2):
 
 
 
-def normalisation_filtering(target_frequency_window, samp_freq, ntr):
-    '''This function performs filtering for normalisation. 
+class FilterBank:
+    '''This class holds the butterworth bandpass filters of all frequency windows, designed once as second-order 
+       sections (SOS), which are numerically more stable than the numerator/denominator form for narrow bands at low 
+       frequencies. A filter bank only depends on the frequency windows, the sampling frequency and the filter order, 
+       so the same object is reused for every trace with these parameters (see get_filter_bank). 
+       
+       PARAMETERS:
+       -------------------------
+       target_frequency_window (list): all the possiible frequency windows for filtering within the desired range
+       samp_freq (float): sampling frequency
+       order (float): the order of a butterworth filter. Default is 2 which gives the best normalisation results. 
+       
+       ATTRIBUTES:
+       -------------------------
+       windows (tuple): the frequency windows as a tuple of (lowcut, highcut) tuples
+       sos (numpy ndarray): the second-order sections of all filters, of shape (n_windows, n_sections, 6)
+    '''
+    
+    def __init__(self, target_frequency_window, samp_freq, order=2):
+        if len(target_frequency_window)<1:
+            raise ValueError("The frequency window list should not be empty.")
+        
+        self.windows = tuple((float(lowcut), float(highcut)) for lowcut, highcut in target_frequency_window)
+        self.samp_freq = float(samp_freq)
+        self.order = order
+        
+        nyq = 0.5 * self.samp_freq
+        self.sos = np.array([butter(order, [lowcut/nyq, highcut/nyq], btype='band', output='sos') 
+                             for lowcut, highcut in self.windows])
+    
+    def __len__(self):
+        return len(self.windows)
+    
+    def filter(self, data, istart=0, istop=None, zi=None):
+        '''This function filters the data with the filters istart:istop of the bank. 
+        
+           PARAMETERS:
+           ---------------------
+           data (numpy ndarray): data to be filtered along the last axis, of shape (npts,) or (n_stations, npts)
+           istart, istop (int): the range of frequency windows to filter with. Default is all of them.
+           zi (numpy ndarray): optional filter state from initial_state, used to filter a long trace chunk by chunk. 
+                               It is updated in place with the state at the end of data. 
+           
+           RETURNS:
+           ---------------------
+           filtered (numpy ndarray): the filtered data, of shape (istop-istart,) + data.shape, float32 if data is float32
+        '''
+        sos = self.sos[istart:istop]
+        #filter every frequency window into its row of the output block, all stations at once. 
+        #the output keeps the precision of float32 data, the recursion runs in double precision
+        dtype = np.float32 if np.asarray(data).dtype == np.float32 else np.float64
+        filtered = np.empty((len(sos),) + np.shape(data), dtype=dtype)
+        for iwin in range(len(sos)):
+            if zi is None:
+                filtered[iwin] = sosfilt(sos[iwin], data, axis=-1)
+            else:
+                filtered[iwin], zi[iwin] = sosfilt(sos[iwin], data, axis=-1, zi=zi[iwin])
+        return filtered
+    
+    def initial_state(self, shape=()):
+        '''This function returns the zero (rest) state of all filters for data of shape + (npts,), to be used with filter.'''
+        return np.zeros((len(self), self.sos.shape[1]) + tuple(shape) + (2,), dtype=np.float64)
+    
+    def response(self, nfft, istart=0, istop=None, dtype=np.complex128):
+        '''This function returns the one-sided frequency responses of the filters istart:istop of the bank, evaluated 
+           on the rfft frequency grid of length nfft//2+1.
+        
+           PARAMETERS:
+           ---------------------
+           nfft (int): the FFT length of the data the responses are applied to
+           istart, istop (int): the range of frequency windows. Default is all of them.
+           dtype (numpy dtype): the precision of the responses, np.complex128 (default) or np.complex64
+           
+           RETURNS:
+           ---------------------
+           resp (numpy ndarray): complex frequency responses of shape (istop-istart, nfft//2+1)
+        '''
+        sos = self.sos[istart:istop]
+        #H(f) is the product of b(f)/a(f) of all sections: the quadratics of all windows are evaluated with one 
+        #matrix product per section
+        powers = np.exp(-2j*np.pi*np.outer(np.arange(3), np.arange(nfft//2+1)/nfft))
+        resp = np.ones((len(sos), nfft//2+1), dtype=np.complex128)
+        for isec in range(sos.shape[1]):
+            resp *= np.matmul(sos[:, isec, :3], powers)
+            resp /= np.matmul(sos[:, isec, 3:], powers)
+        return resp.astype(dtype, copy=False)
+
+
+@lru_cache(maxsize=128)
+def _cached_filter_bank(windows, samp_freq, order):
+    return FilterBank(windows, samp_freq, order=order)
+
+
+def get_filter_bank(target_frequency_window, samp_freq, order=2):
+    '''This function returns the FilterBank of the frequency windows. Filter banks are memoised in an LRU cache, so the 
+       filters are only designed for the first trace with a given set of frequency windows and sampling frequency. 
+       
+       PARAMETERS:
+       -------------------------
+       target_frequency_window (list): all the possiible frequency windows for filtering within the desired range
+       samp_freq (float): sampling frequency
+       order (float): the order of a butterworth filter. Default is 2 which gives the best normalisation results. 
+       
+       RETURNS:
+       -------------------------
+       bank (FilterBank): the (possibly shared) filter bank. It should not be modified. 
+    '''
+    if len(target_frequency_window)<1:
+        raise ValueError("The frequency window list should not be empty.")
+    
+    windows = tuple((float(lowcut), float(highcut)) for lowcut, highcut in target_frequency_window)
+    return _cached_filter_bank(windows, float(samp_freq), order)
+
+
+def filter_bank(chan, freqmin, freqmax, samp_freq, order=2, spacing='linear'):
+    '''This function returns the FilterBank for a type of instrument, i.e. the filters of the frequency windows returned by
+       target_frequency_window. Channels with the same frequency windows and sampling frequency share one filter bank.
+       
+       PARAMETERS:
+       -------------------------
+       chan (string): the type of instrument. 'HHZ' 'BHZ' or 'LHZ'. 
+       freqmin: the minimum frequency used to DOWNLOAD raw data.
+       freqmax: the maximum frequency used to DOWNLOAD raw data.
+       samp_freq (float): sampling frequency
+       order (float): the order of a butterworth filter. Default is 2 which gives the best normalisation results. 
+       spacing (string): the spacing of the frequency windows, see frequency_windows. Default is 'linear'.
+       
+       RETURNS:
+       -------------------------
+       bank (FilterBank): the (possibly shared) filter bank.
+    '''
+    return get_filter_bank(window_plan(chan, freqmin, freqmax, samp_freq, spacing=spacing), samp_freq, order=order)
+
+
+def filter_bank_cache_info():
+    '''This function returns the hits, misses, maxsize and currsize counters of the filter bank cache.'''
+    return _cached_filter_bank.cache_info()
+
+
+def clear_filter_bank_cache():
+    '''This function empties the filter bank cache and resets its counters.'''
+    _cached_filter_bank.cache_clear()
+
+
+@profiling.instrument('normalisation_filtering')
+def normalisation_filtering(target_frequency_window, samp_freq, ntr, dtype=np.float64):
+    '''This function performs filtering for normalisation. The filters of all frequency windows are taken from the 
+       shared filter bank and the filtered waveforms are written into one contiguous 2-D array.
     
        PARAMETERS:
        --------------------------
        target_frequency_window (list): all the possiible frequency windows for filtering within the desired range
        samp_freq (float): sampling frequency
-       ntr (numpy ndarray): the pre-proccessed data
+       ntr (numpy ndarray or obspy trace): the pre-proccessed data. For a trace, its own sampling rate is used.
+       dtype (numpy dtype): the precision of the output, np.float64 (default) or np.float32. 
        
        RETURNS:
        --------------------------
-       filtered_list (list): filtered waveform for each frequency window. 
+       filtered (numpy ndarray): filtered waveform for each frequency window, of shape (n_windows, npts). 
        
     '''
     
-    filtered_list = []
-    for freq_range in target_frequency_window: 
-        #the lowest and highest frequencies in each frquency window
-        lowcut = freq_range[0]
-        highcut = freq_range[1]    
-        #filtering 
-        butter_bandpass(lowcut, highcut, samp_freq)
-        filtered_ntr = butter_bandpass_filter(ntr, lowcut, highcut, samp_freq)
-        filtered_list.append(filtered_ntr)
-    
-    if len(filtered_list)<1:
+    data, samp_freq = _trace_data(ntr, samp_freq, dtype)
+    if data.size<1:
         raise ValueError ("The output of this function should not be empty.")
         
-    return filtered_list
+    return get_filter_bank(target_frequency_window, samp_freq).filter(data)
+    
+
+def analytic_filtering_fft(target_frequency_window, samp_freq, ntr, zerophase=False, dtype=np.float64):
+    '''This function returns the analytic signal of the filtered data for each frequency window, computed in the frequency 
+       domain. The data are transformed once, multiplied by the one-sided filter response of each frequency window and 
+       transformed back with one batched inverse FFT. This replaces one lfilter and two FFTs (Hilbert transform) per window.
+       
+       PARAMETERS:
+       ------------------------
+       target_frequency_window (list): all the possiible frequency windows for filtering within the desired range
+       samp_freq (float): sampling frequency
+       ntr (numpy ndarray or obspy trace): the pre-proccessed data. For a trace, its own sampling rate is used.
+       zerophase (bool): if True, only the butterworth magnitude is applied (zero-phase filtering). 
+                         Default is False which keeps the phase of the causal filter used by butter_bandpass_filter.
+       dtype (numpy dtype): the precision of the data, np.float64 (default) or np.float32 (complex64 output). 
+       
+       RETURNS:
+       -------------------------
+       analytic (numpy ndarray): complex analytic signals of shape (n_windows, npts). 
+    '''
+    data, samp_freq = _trace_data(ntr, samp_freq, dtype)
+    npts = data.size
+    if npts<1:
+        raise ValueError ("The output of this function should not be empty.")
+    
+    nfft = next_fast_len(npts, real=True)
+    resp = get_filter_bank(target_frequency_window, samp_freq).response(nfft, dtype=_complex_dtype(data))
+    if zerophase:
+        resp = np.abs(resp)
     
+    return _analytic_from_spectrum(resp, _analytic_spectrum(data, nfft), npts)
+
+
+def _trace_data(ntr, samp_freq, dtype=None):
+    '''data array and sampling frequency of ntr: the sampling rate of a trace overrides samp_freq'''
+    if isinstance(ntr, obspy.Trace):
+        samp_freq = ntr.stats.sampling_rate
+        ntr = ntr.data
+    return np.asarray(ntr, dtype=dtype), samp_freq
+
+
+def _complex_dtype(data):
+    '''complex64 for float32 data, complex128 otherwise'''
+    return np.complex64 if data.dtype == np.float32 else np.complex128
+
+
+def _hilbert(filtered, nfft=None):
+    '''analytic signal along the last axis as scipy.signal.hilbert, but complex64 for float32 data'''
+    npts = filtered.shape[-1]
+    if nfft is None:
+        nfft = npts
+    spec = _analytic_spectrum(filtered, nfft)
+    analytic = np.zeros(filtered.shape[:-1] + (nfft,), dtype=spec.dtype)
+    analytic[..., :nfft//2+1] = spec
+    analytic = ifft(analytic, axis=-1, overwrite_x=True)
+    return analytic[..., :npts]
+
+
+def _analytic_spectrum(data, nfft):
+    '''one-sided spectrum of data weighted for the analytic signal: 1 for DC (and Nyquist), 2 for positive frequencies'''
+    spec = rfft(data, nfft, axis=-1)
+    weights = np.full(nfft//2+1, 2.0, dtype=data.dtype)
+    weights[0] = 1.0
+    if nfft%2 == 0:
+        weights[-1] = 1.0
+    spec *= weights
+    return spec
+
+
+def _analytic_from_spectrum(resp, spec, npts):
+    '''analytic signals of shape (n_windows,) + data.shape from filter responses and the output of _analytic_spectrum'''
+    nfft = next_fast_len(npts, real=True)
+    #line up the responses with the leading (station) axes of the spectrum
+    resp = resp.reshape((len(resp),) + (1,)*(spec.ndim-1) + (-1,))
+    #negative frequencies of the analytic signal are zero
+    analytic = np.zeros((len(resp),) + spec.shape[:-1] + (nfft,), dtype=spec.dtype)
+    np.multiply(resp, spec, out=analytic[..., :nfft//2+1])
+    analytic = ifft(analytic, axis=-1, overwrite_x=True)
+    return analytic[..., :npts]
 
-def freq_time_normalisation(target_frequency_window, samp_freq, ntr):
+
+@profiling.instrument('freq_time_normalisation')
+def freq_time_normalisation(target_frequency_window, samp_freq, ntr, method='iir', zerophase=False, dtype=np.float64):
     '''This function returns the frequency-time normalised data using Hilbert transform. The filtered data is divided by its
        envelope function after Hilbert transform for each target_frequency_window. The formula can be referred to 
        https://pubs.geoscienceworld.org/ssa/bssa/article/102/4/1872/325525/an-improved-method-to-extract-very-broadband.
        
+       Two engines are available:
+            "iir" -> filter each window with butterworth filter and compute the analytic signals with one batched FFT;
+            "fft" -> transform the data once and apply the filter responses in the frequency domain (analytic_filtering_fft).
+       The "fft" engine agrees with the "iir" engine away from the first samples of the trace, where the causal filter 
+       is still starting up. See report.md for the accuracy comparison. 
+       
        PARAMETERS:
        ------------------------
        target_frequency_window (list): all the possiible frequency windows for filtering within the desired range
        samp_freq (float): sampling frequency
-       ntr (numpy ndarray): the pre-proccessed data
+       ntr (numpy ndarray or obspy trace): the pre-proccessed data. For a trace, its own sampling rate is used.
+       method (string): the normalisation engine, 'iir' or 'fft'. Default is 'iir'.
+       zerophase (bool): only used by the 'fft' engine, see analytic_filtering_fft. 
+       dtype (numpy dtype): the precision of the computation, np.float64 (default) or np.float32. In single precision 
+                            the arrays and FFTs are float32/complex64, which halves memory; see report.md for the 
+                            precision against the double precision path.
        
        RETURNS:
        -------------------------
-       ntr_list (list): contains all the normalised segments for each frequency window. 
+       ntr_list (numpy ndarray): contains all the normalised segments for each frequency window, of shape (n_windows, npts). 
     '''
-    #call the previous function to obtain filtered waveform
-    filtered_list = normalisation_filtering(target_frequency_window, samp_freq, ntr)
-    
-    #create an empty list to store FT normalised waveform
-    ntr_list = []
+    data, samp_freq = _trace_data(ntr, samp_freq, dtype)
+    if data.size<1:
+        raise ValueError ("The output of this function should not be empty.")
     
-    #Hilbert transform
-    for filt in filtered_list:
-        analytical_qrz = hilbert(filt)
-    #the absolute value of hilbert transform
-        amplitude_envelope = np.abs(analytical_qrz)
-    #normalisation
-        FTN = filt/amplitude_envelope
-        ntr_list.append(FTN)
+    bank = get_filter_bank(target_frequency_window, samp_freq)
+    spec = _engine_spectrum(data, method)
+    ntr_list = _normalise_windows(bank, data, method, zerophase, spec)
         
-    if len(ntr_list)<1:
+    if ntr_list.size<1:
         raise ValueError ("The output of this function should not be empty.")
         
     return ntr_list
+
+
+@profiling.instrument('freq_time_normalise_sum')
+def freq_time_normalise_sum(target_frequency_window, samp_freq, ntr, method='iir', zerophase=False, block_size=8, out=None, 
+                            dtype=np.float64):
+    '''This function returns the sum of the frequency-time normalised data over all frequency windows, i.e. the same 
+       result as summing the output of freq_time_normalisation. The frequency windows are processed block_size at a time 
+       and accumulated into a single float32 array, so the normalised segments of all windows are never held in memory 
+       at the same time. Peak memory grows with block_size*npts instead of n_windows*npts. 
+       
+       PARAMETERS:
+       ------------------------
+       target_frequency_window (list): all the possiible frequency windows for filtering within the desired range
+       samp_freq (float): sampling frequency
+       ntr (numpy ndarray): the pre-proccessed data, or several traces with the same npts stacked as (n_stations, npts)
+                            , or an obspy trace (its own sampling rate is used)
+       method (string): the normalisation engine, 'iir' or 'fft'. Default is 'iir'.
+       zerophase (bool): only used by the 'fft' engine, see analytic_filtering_fft. 
+       block_size (int): the number of frequency windows processed at a time. Default is 8.
+       out (numpy ndarray): optional array of the same shape as ntr to write the result into. It is overwritten. 
+       dtype (numpy dtype): the precision of the computation, np.float64 (default) or np.float32. 
+       
+       RETURNS:
+       -------------------------
+       sum_FTN (numpy ndarray): the normalised waveform summed over all frequency windows (out if it is given). 
+    '''
+    data, samp_freq = _trace_data(ntr, samp_freq, dtype)
+    if data.size<1:
+        raise ValueError ("The output of this function should not be empty.")
+    if len(target_frequency_window)<1:
+        raise ValueError("The frequency window list should not be empty.")
+    if block_size<1:
+        raise ValueError("block_size should be a positive integer.")
+    
+    if out is None:
+        out = np.zeros(data.shape, dtype=np.float32)
+    else:
+        if out.shape != data.shape:
+            raise ValueError("The output buffer should have the same shape as the data.")
+        out[:] = 0
+    
+    #the filter bank and the spectrum of the data are shared by all blocks
+    bank = get_filter_bank(target_frequency_window, samp_freq)
+    spec = _engine_spectrum(data, method)
+    for istart in range(0, len(bank), block_size):
+        out += np.sum(_normalise_windows(bank, data, method, zerophase, spec, istart, istart+block_size), axis=0)
+    
+    return out
+
+
+def _engine_spectrum(data, method):
+    '''the analytic spectrum needed by the 'fft' engine (None for the 'iir' engine)'''
+    if method == 'iir':
+        return None
+    elif method == 'fft':
+        if data.size<1:
+            raise ValueError ("The output of this function should not be empty.")
+        return _analytic_spectrum(data, next_fast_len(data.shape[-1], real=True))
+    else:
+        raise ValueError('no such option for method! please double check!')
+
+
+def _normalise_windows(bank, data, method, zerophase, spec, istart=0, istop=None):
+    '''normalised segments of shape (n_windows,) + data.shape of the frequency windows istart:istop of the filter bank'''
+    if method == 'iir':
+        #filtered waveform of the frequency windows
+        filtered = bank.filter(data, istart, istop)
+        #Hilbert transform of all frequency windows at once
+        analytical_qrz = _hilbert(filtered)
+    else:
+        resp = bank.response(next_fast_len(data.shape[-1], real=True), istart, istop, dtype=_complex_dtype(data))
+        if zerophase:
+            resp = np.abs(resp)
+        analytical_qrz = _analytic_from_spectrum(resp, spec, data.shape[-1])
+        #the filtered waveform is the real part of the analytic signal
+        filtered = np.ascontiguousarray(analytical_qrz.real)
+    
+    #the absolute value of hilbert transform
+    amplitude_envelope = np.abs(analytical_qrz)
+    del analytical_qrz
+    #normalisation, reusing the filtered block as output
+    return np.divide(filtered, amplitude_envelope, out=filtered)
+
+
+def freq_time_normalise_batch(traces, freqmin, freqmax, method='iir', zerophase=False, block_size=1, dtype=np.float64):
+    '''This function returns the summed frequency-time normalised data of many stations. Traces that share the same 
+       frequency windows (i.e. the same type of instrument), sampling frequency and length are stacked into a 
+       (n_stations, npts) array and normalised together, so each filter and Hilbert transform runs once over all 
+       stations of the group instead of once per station. 
+       
+       Memory grows with block_size*n_stations*npts per group, hence the default of one frequency window per block.
+       
+       PARAMETERS:
+       ------------------------
+       traces (list): obspy trace objects of pre-processed data, e.g. the outputs of processing.preprocess_raw
+       freqmin (float): the minimum frequency used to DOWNLOAD raw data.
+       freqmax (float): the maximum frequency used to DOWNLOAD raw data.
+       method (string): the normalisation engine, 'iir' or 'fft'. Default is 'iir'.
+       zerophase (bool): only used by the 'fft' engine, see analytic_filtering_fft. 
+       block_size (int): the number of frequency windows processed at a time. Default is 1.
+       dtype (numpy dtype): the precision of the computation, np.float64 (default) or np.float32. 
+       
+       RETURNS:
+       -------------------------
+       sum_FTN_list (list): the normalised waveform of each trace summed over all its frequency windows (float32), 
+                            in the same order as traces.
+    '''
+    if len(traces)<1:
+        raise ValueError("The input trace list should not be empty.")
+    
+    #group the traces by frequency windows, sampling frequency and length. 
+    #the frequency windows are only computed once per channel
+    windows_by_chan = {}
+    groups = {}
+    for itr, tr in enumerate(traces):
+        chan = tr.stats.channel
+        if chan not in windows_by_chan:
+            windows_by_chan[chan] = tuple(target_frequency_window(chan, freqmin, freqmax))
+        key = (windows_by_chan[chan], float(tr.stats.sampling_rate), tr.stats.npts)
+        groups.setdefault(key, []).append(itr)
+    
+    sum_FTN_list = [None]*len(traces)
+    for (windows, samp_freq, npts), index in groups.items():
+        stack = np.empty((len(index), npts), dtype=dtype)
+        for ista, itr in enumerate(index):
+            stack[ista] = traces[itr].data
+        sum_FTN = freq_time_normalise_sum(windows, samp_freq, stack, method=method, zerophase=zerophase, 
+                                          block_size=block_size, dtype=dtype)
+        for ista, itr in enumerate(index):
+            sum_FTN_list[itr] = sum_FTN[ista]
+    
+    return sum_FTN_list
+
+
+def iter_freq_time_normalise_sum(target_frequency_window, samp_freq, chunks, overlap=None, dtype=np.float64):
+    '''This function normalises a long continuous trace chunk by chunk and yields the normalised waveform summed over all 
+       frequency windows, so memory is bounded by the chunk length instead of the record length. The chunks may come 
+       from an iterator that reads the data from disk, so processing can overlap with I/O. 
+       
+       The butterworth filters run with their state carried across chunk boundaries, so the filtered data are identical 
+       to filtering the whole record. The envelope of each sample is computed from a Hilbert transform that extends 
+       overlap samples beyond the chunk on both sides (the next chunk is waited for before a chunk is yielded). Away 
+       from the record ends the result agrees with freq_time_normalise_sum of the whole record to within the edge 
+       effect of the Hilbert transform, which decays with overlap. 
+       
+       PARAMETERS:
+       ------------------------
+       target_frequency_window (list): all the possiible frequency windows for filtering within the desired range
+       samp_freq (float): sampling frequency
+       chunks (iterable): consecutive 1-D arrays of the pre-proccessed data
+       overlap (int): the number of samples of context on each side of a chunk. Default is 10 periods of the lowest 
+                      frequency of target_frequency_window.
+       dtype (numpy dtype): the precision of the computation, np.float64 (default) or np.float32. 
+       
+       YIELDS:
+       -------------------------
+       sum_FTN (numpy ndarray): float32 pieces of the summed normalised waveform. Their lengths may differ from the 
+                                chunk lengths, but together they cover the record sample by sample. 
+    '''
+    bank = get_filter_bank(target_frequency_window, samp_freq)
+    if overlap is None:
+        overlap = int(np.ceil(10*bank.samp_freq/bank.windows[0][0]))
+    if overlap<0:
+        raise ValueError("overlap should not be negative.")
+    
+    zi = bank.initial_state()
+    #filtered data not yet normalised, preceded by nleft samples of already normalised context
+    buffered = np.empty((len(bank), 0), dtype=dtype)
+    nleft = 0
+    for chunk in chunks:
+        chunk = np.asarray(chunk, dtype=dtype)
+        buffered = np.concatenate([buffered, bank.filter(chunk, zi=zi)], axis=1)
         
+        #samples that have overlap samples of context to their right
+        nready = buffered.shape[1] - nleft - overlap
+        if nready > 0:
+            yield _normalise_buffered(buffered, nleft, nleft+nready)
+            #keep overlap samples of context to the left of the pending samples
+            ikeep = max(0, nleft+nready-overlap)
+            buffered = buffered[:, ikeep:]
+            nleft = nleft + nready - ikeep
+    
+    #the last samples have no context to their right
+    if buffered.shape[1] > nleft:
+        yield _normalise_buffered(buffered, nleft, buffered.shape[1])
+
+
+def freq_time_normalise_sum_chunked(target_frequency_window, samp_freq, ntr, chunk_npts, overlap=None, out=None, 
+                                    dtype=np.float64):
+    '''This function returns the same result as freq_time_normalise_sum, but the trace is processed in chunks of 
+       chunk_npts samples with iter_freq_time_normalise_sum, which bounds the memory for multi-day records. 
+       
+       PARAMETERS:
+       ------------------------
+       target_frequency_window (list): all the possiible frequency windows for filtering within the desired range
+       samp_freq (float): sampling frequency
+       ntr (numpy ndarray or obspy trace): the pre-proccessed data. For a trace, its own sampling rate is used.
+       chunk_npts (int): the number of samples in each chunk
+       overlap (int): the number of samples of context on each side of a chunk, see iter_freq_time_normalise_sum.
+       out (numpy ndarray): optional 1-D array of length npts to write the result into. It is overwritten. 
+       dtype (numpy dtype): the precision of the computation, np.float64 (default) or np.float32. 
+       
+       RETURNS:
+       -------------------------
+       sum_FTN (numpy ndarray): the normalised waveform summed over all frequency windows (out if it is given). 
+    '''
+    data, samp_freq = _trace_data(ntr, samp_freq)
+    if data.size<1:
+        raise ValueError ("The output of this function should not be empty.")
+    if chunk_npts<1:
+        raise ValueError("chunk_npts should be a positive integer.")
+    
+    if out is None:
+        out = np.zeros(data.size, dtype=np.float32)
+    elif out.shape != data.shape:
+        raise ValueError("The output buffer should have the same shape as the data.")
+    
+    chunks = (data[istart:istart+chunk_npts] for istart in range(0, data.size, chunk_npts))
+    istart = 0
+    for sum_FTN in iter_freq_time_normalise_sum(target_frequency_window, samp_freq, chunks, overlap=overlap, dtype=dtype):
+        out[istart:istart+sum_FTN.size] = sum_FTN
+        istart += sum_FTN.size
+    
+    return out
+
+
+def _normalise_buffered(filtered, istart, istop):
+    '''normalised samples istart:istop of a block of filtered data, summed over the frequency windows'''
+    amplitude_envelope = np.abs(_hilbert(filtered, next_fast_len(filtered.shape[1], real=True))[:, istart:istop])
+    return np.sum(filtered[:, istart:istop]/amplitude_envelope, axis=0).astype(np.float32)
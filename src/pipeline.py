@@ -0,0 +1,376 @@
+import os
+import obspy
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import processing
+import normalisation
+import profiling
+from store import FTNStore
+from archive import WaveformArchive
+from shared import TraceArray
+
+
+'''
+    This script runs the download -> pre-process -> normalisation workflow for many stations and time chunks:
+    1) build one independent task for each (station, time chunk)
+    2) run the tasks in parallel on a pool of processes, or over MPI ranks for multi-node runs
+    3) write the summed frequency-time normalised waveform of each task to disk as soon as it is finished, and
+       optionally append it to an HDF5 store (see store.FTNStore)
+
+    The processing can also be split into two runs with stages: ('preprocess',) writes the pre-processed waveform
+    of each task, and ('normalise',) normalises it later without downloading again. With shared=True the waveforms
+    of all stations of a time chunk go into one memory-mapped (station, sample) array (see shared.TraceArray)
+    instead of one SAC file per task, which the workers write and read in place.
+
+    Functions: get_task_list, task_id, task_output, run_station_day, run_pipeline.
+'''
+
+
+def get_task_list(all_chunk,net,sta,location,chan):
+    '''
+    This function builds the list of (station, time chunk) tasks of a run.
+    PARAMETERS:
+    ----------------
+    all_chunk: a list of events from download_raw_data.get_event_list
+    net: a list of string that specifies the networks of stations
+    sta: a list of string that specifies the station names
+    location: a list of string that specifies the locations of stations
+    chan: a list of string that specifies the channels of stations
+    RETURNS:
+    ----------------
+    tasks: a list of dictionaries with keys net, sta, location, chan, starttime and endtime (strings of all_chunk)
+    '''
+    tasks = []
+    for ick in range(len(all_chunk)-1):
+        for ista in range(len(sta)):
+            tasks.append({'net':net[ista],
+                          'sta':sta[ista],
+                          'location':location[ista],
+                          'chan':chan[ista],
+                          'starttime':all_chunk[ick],
+                          'endtime':all_chunk[ick+1]})
+
+    if len(tasks) < 1:
+        raise ValueError('output task list is empty.')
+
+    return tasks
+
+
+# clients of this process, created on first use when the client is given by name or by archive arguments
+_clients = {}
+
+def _get_client(client):
+    '''
+    return the client object, creating an obspy FDSN client once per process if client is the name of a data centre,
+    or a WaveformArchive once per process if client is a tuple of its arguments (path, format, inventory)
+    '''
+    if not isinstance(client,(str,tuple)):
+        return client
+    if client not in _clients:
+        if isinstance(client,tuple):
+            _clients[client] = WaveformArchive(*client)
+        else:
+            from obspy.clients.fdsn import Client
+            _clients[client] = Client(client)
+    return _clients[client]
+
+
+def _open_client(client):
+    '''return the client object for a run in this process, reading a local archive afresh (it may have grown)'''
+    if isinstance(client,tuple):
+        return WaveformArchive(*client)
+    return _get_client(client)
+
+
+# processing stages of a task, in order, and the suffix of the file written by the last stage of a run
+STAGES = ('preprocess','normalise')
+_SUFFIX = {'preprocess':'PRE','normalise':'FTN'}
+
+def _check_stages(stages):
+    stages = tuple(stages)
+    if len(stages) == 0 or any(stage not in STAGES for stage in stages):
+        raise ValueError('no such option for stages! please double check!')
+    return tuple(stage for stage in STAGES if stage in stages)
+
+
+def task_id(task):
+    '''return the station id NET.STA.LOC.CHAN of a task, the row name of the task in a shared array'''
+    return '.'.join([task['net'],task['sta'],task['location'],task['chan']])
+
+
+def task_output(task,outdir,stages=STAGES,shared=False):
+    '''
+    This function returns the filename that run_station_day writes for a task: the pre-processed waveform
+    (...PRE.sac) if the last stage is preprocess, and the normalised waveform (...FTN.sac) otherwise. With shared,
+    it is the array file of the time chunk of the task (...PRE.npy or ...FTN.npy).
+    '''
+    stage = _check_stages(stages)[-1]
+    if shared:
+        return os.path.join(outdir,task['starttime']+'T'+task['endtime']+'.'+_SUFFIX[stage]+'.npy')
+    return os.path.join(outdir,task['starttime']+'T'+task['endtime']+'.'+task['sta']+'.'+task['chan']+'.'+
+                        _SUFFIX[stage]+'.sac')
+
+
+def run_station_day(task,client,prepro_para,outdir,stages=STAGES,shared=False):
+    '''
+    This function processes one task: it downloads the waveform and inventory, checks gaps, pre-processes, normalises
+    and writes the normalised waveform summed over all frequency windows to outdir in SAC format.
+    PARAMETERS:
+    ----------------
+    task: a dictionary from get_task_list
+    client: name of the data centre (e.g. 'IRIS'), a tuple of the arguments of archive.WaveformArchive
+            (path, format, inventory), or an object with the get_stations/get_waveforms methods of obspy Client
+    prepro_para: dict of pre-processing parameters, see processing.preprocess_raw. The optional key 'window_spacing'
+                 sets the spacing of the frequency windows, see normalisation.frequency_windows.
+    outdir: a string of path to store the normalised waveforms
+    stages: the processing stages to run. Default is ('preprocess','normalise'). ('preprocess',) writes the
+            pre-processed waveform instead, and ('normalise',) normalises the pre-processed waveform in outdir
+            (the client is not used).
+    shared: whether to write the waveform into the row of the task in the shared array of its time chunk (and to
+            read the pre-processed waveform from there), see run_pipeline. Default is False (SAC files).
+    RETURNS:
+    ----------------
+    ff: the filename of the written waveform (see task_output), or None if the station has no usable data for this
+        chunk
+    '''
+    stages = _check_stages(stages)
+    if 'preprocess' in stages:
+        client = _get_client(client)
+        s1 = obspy.UTCDateTime(task['starttime'])
+        s2 = obspy.UTCDateTime(task['endtime'])
+        date_info = {'starttime':s1,'endtime':s2}
+
+        with profiling.stage('download'):
+            inv = client.get_stations(network=task['net'],
+                                      station=task['sta'],
+                                      location=task['location'],
+                                      starttime=s1,
+                                      endtime=s2,
+                                      level="response")
+            st = client.get_waveforms(network=task['net'],
+                                      station=task['sta'],
+                                      channel=task['chan'],
+                                      location=task['location'],
+                                      starttime=s1,
+                                      endtime=s2)
+
+        st = processing.check_sample_gaps(st,date_info)
+        ntr = processing.preprocess_raw(st,inv,prepro_para,date_info)
+        if len(ntr) == 0:
+            return None
+    else:
+        pre = task_output(task,outdir,('preprocess',),shared)
+        if not os.path.isfile(pre):
+            return None
+        if shared:
+            # a view of the mapped row, nothing is copied until the normalisation
+            arr = TraceArray(pre)
+            if not arr.filled[arr.row(task_id(task))]:
+                return None
+            ntr = arr.trace(task_id(task))
+        else:
+            ntr = obspy.read(pre,format='SAC')[0]
+
+    if 'normalise' in stages:
+        target_freq_window = normalisation.window_plan(task['chan'],prepro_para['freqmin'],prepro_para['freqmax'],
+                                                       ntr.stats.sampling_rate,
+                                                       spacing=prepro_para.get('window_spacing','linear'))
+        # the precision of preprocess_raw, float64 unless prepro_para sets dtype
+        dtype = prepro_para['dtype'] if 'dtype' in prepro_para else 'float64'
+        ntr.data = normalisation.freq_time_normalise_sum(target_freq_window,ntr.stats.sampling_rate,ntr.data,
+                                                         dtype=dtype)
+
+    # filename of the saved file
+    ff = task_output(task,outdir,stages,shared)
+    if shared:
+        with TraceArray(ff,mode='r+') as arr:
+            arr.write(task_id(task),ntr)
+    else:
+        ntr.write(ff,format='SAC')
+
+    return ff
+
+
+def _station_order(tasks):
+    '''
+    the indices of tasks grouped by station (in time order within a station), the order in which the tasks are run:
+    a process then runs the station-days of one station after each other and reuses the cached deconvolution
+    operator of its response (see processing.ResponseCache) instead of cycling through all the stations
+    '''
+    stations = {}
+    for itask,task in enumerate(tasks):
+        stations.setdefault(task_id(task),[]).append(itask)
+    return [itask for itasks in stations.values() for itask in itasks]
+
+
+def _run_task(task,client,prepro_para,outdir,stages=STAGES,shared=False):
+    '''run_station_day that reports failures instead of stopping the whole run'''
+    try:
+        with profiling.task('%s.%s %s' % (task['net'],task['sta'],task['starttime'])):
+            return run_station_day(task,client,prepro_para,outdir,stages,shared)
+    except Exception as err:
+        print('skip %s.%s %s: %s' % (task['net'],task['sta'],task['starttime'],err))
+        return None
+
+
+def _run_task_worker(task,client,prepro_para,outdir,stages=STAGES,shared=False,profile=None):
+    '''
+    _run_task in a worker process, returning the profiling records and cProfile statistics of the task with its
+    result. profile is None (no profiling) or the settings of profiling.enable of the main process.
+    '''
+    if profile is None:
+        return _run_task(task,client,prepro_para,outdir,stages,shared),[],[]
+    # a forked worker starts with a copy of the records of the main process
+    profiling.enable(**profile)
+    profiling.reset()
+    ff = _run_task(task,client,prepro_para,outdir,stages,shared)
+    return ff,profiling.take_records(),profiling.take_profiles()
+
+
+def _store_result(ftn_store,ff,task,shared=False):
+    '''append the normalised waveform of a task in the SAC file (or shared array) ff to the store'''
+    if ftn_store is None or ff is None:
+        return
+    if shared:
+        ftn_store.append(TraceArray(ff).trace(task_id(task)))
+    else:
+        ftn_store.append(obspy.read(ff,format='SAC')[0])
+
+
+def _create_arrays(tasks,outdir,prepro_para,stages):
+    '''create the shared array of every time chunk of tasks, with one row per station, before the workers start'''
+    chunks = {}
+    for task in tasks:
+        chunks.setdefault(task_output(task,outdir,stages,True),(task,[]))[1].append(task_id(task))
+    for ff,(task,ids) in chunks.items():
+        if os.path.isfile(ff):
+            # reuse the array of an earlier run (e.g. with other tasks of the chunk) if it has all the stations
+            arr = TraceArray(ff)
+            if set(ids) <= set(arr.ids):
+                continue
+        s1 = obspy.UTCDateTime(task['starttime'])
+        s2 = obspy.UTCDateTime(task['endtime'])
+        npts = int(round((s2-s1)*prepro_para['samp_freq']))+1
+        TraceArray.create(ff,ids,s1,prepro_para['samp_freq'],npts).close()
+
+
+def _mark_filled(tasks,results):
+    '''record in the sidecars of the shared arrays which rows the tasks have written'''
+    filled = {}
+    for task,ff in zip(tasks,results):
+        if ff is not None:
+            filled.setdefault(ff,[]).append(task_id(task))
+    for ff,ids in filled.items():
+        TraceArray(ff).mark_filled(ids)
+
+
+def run_pipeline(tasks,client,prepro_para,outdir,workers=1,backend='process',store=None,stages=STAGES,shared=False):
+    '''
+    This function runs run_station_day for every task. Tasks are independent, so they are distributed over a pool of
+    workers processes, or over the ranks of an MPI job with backend='mpi' (requires mpi4py, run with e.g.
+    mpirun -n 4 python script.py). Every task writes its own output file, so only the filenames are gathered.
+    The tasks are run station by station, so that the cached response of a station is reused by its next
+    station-days (see processing.ResponseCache). A task that fails is reported and skipped. With store, every finished task is appended to an HDF5 store by the
+    main process (rank 0 for MPI) as it comes in. If profiling is enabled (see profiling.enable), every task is
+    recorded with its stages, and the records and cProfile profiles of the worker processes (or MPI ranks) are
+    gathered in the main process (rank 0).
+    With shared=True, the main process creates one memory-mapped array per time chunk in outdir (see
+    shared.TraceArray), every worker writes the waveform of its task into its own row in place, and the main process
+    records the written rows in the sidecars at the end, so no waveform is sent between the processes. The
+    normalise stage then maps the pre-processed array of the preprocess stage instead of reading SAC files, and the
+    normalised array of a chunk is an input of correlation.correlate as it is.
+    PARAMETERS:
+    ----------------
+    tasks: a list of tasks from get_task_list
+    client: name of the data centre (e.g. 'IRIS'), a tuple of the arguments of archive.WaveformArchive
+            (path, format, inventory), or a picklable object with the methods of obspy Client. Names and archive
+            arguments are sent to the worker processes as they are, and every worker opens its client once.
+    prepro_para: dict of pre-processing parameters, see processing.preprocess_raw
+    outdir: a string of path to store the normalised waveforms
+    workers: an integer of the number of processes. Default is 1, which runs the tasks in this process.
+    backend: 'process' (default) for a process pool on this machine or 'mpi' for MPI ranks
+    store: an optional string of path of the HDF5 file to append the normalised waveforms to. Default is None.
+    stages: the processing stages of every task, see run_station_day. Default is ('preprocess','normalise').
+    shared: whether to write the waveforms into shared arrays instead of SAC files. Default is False.
+    RETURNS:
+    ----------------
+    results: a list of filenames (None for failed tasks) in the same order as tasks, with shared the array file of
+             the chunk of every task.
+             With backend='mpi' only rank 0 gets the full list, other ranks get None.
+    '''
+    if not os.path.isdir(outdir):
+        raise ValueError('output folder not found! abort!')
+
+    stages = _check_stages(stages)
+    if store is not None and 'normalise' not in stages:
+        raise ValueError('only normalised waveforms can be stored! please double check!')
+    if backend == 'mpi' or workers <= 1:
+        client = _open_client(client)
+    run = partial(_run_task,client=client,prepro_para=prepro_para,outdir=outdir,stages=stages,shared=shared)
+
+    if backend == 'process':
+        if shared:
+            _create_arrays(tasks,outdir,prepro_para,stages)
+        ftn_store = None if store is None else FTNStore(store)
+        results = [None]*len(tasks)
+        try:
+            if workers <= 1:
+                for itask in _station_order(tasks):
+                    results[itask] = run(tasks[itask])
+                    _store_result(ftn_store,results[itask],tasks[itask],shared)
+            else:
+                run_worker = partial(_run_task_worker,client=client,prepro_para=prepro_para,outdir=outdir,
+                                     stages=stages,shared=shared,
+                                     profile=profiling.settings() if profiling.is_enabled() else None)
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    futures = {executor.submit(run_worker,tasks[itask]):itask for itask in _station_order(tasks)}
+                    for future in as_completed(futures):
+                        itask = futures[future]
+                        ff,records,profiles = future.result()
+                        profiling.add_records(records)
+                        profiling.add_profiles(profiles)
+                        results[itask] = ff
+                        _store_result(ftn_store,ff,tasks[itask],shared)
+        finally:
+            if shared:
+                _mark_filled(tasks,results)
+            if ftn_store is not None:
+                ftn_store.close()
+        return results
+
+    elif backend == 'mpi':
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+        rank = comm.Get_rank()
+        size = comm.Get_size()
+        if shared:
+            if rank == 0:
+                _create_arrays(tasks,outdir,prepro_para,stages)
+            comm.Barrier()
+
+        # round-robin distribution of the tasks over the ranks, station by station
+        order = _station_order(tasks)
+        local = [(itask,run(tasks[itask])) for itask in order[rank::size]]
+        # the profiling of the other ranks is sent to rank 0 with the results
+        if rank != 0 and profiling.is_enabled():
+            gathered = comm.gather((local,profiling.take_records(),profiling.take_profiles()),root=0)
+        else:
+            gathered = comm.gather((local,[],[]),root=0)
+        if rank != 0:
+            return None
+        results = [None]*len(tasks)
+        for local,records,profiles in gathered:
+            profiling.add_records(records)
+            profiling.add_profiles(profiles)
+            for itask,ff in local:
+                results[itask] = ff
+        if shared:
+            _mark_filled(tasks,results)
+        if store is not None:
+            with FTNStore(store) as ftn_store:
+                for task,ff in zip(tasks,results):
+                    _store_result(ftn_store,ff,task,shared)
+        return results
+
+    else:
+        raise ValueError('no such option for backend! please double check!')
@@ -1,25 +1,16 @@
 import os
 import glob
-import copy
+import warnings
+import functools
 import obspy
-import scipy
-import time
-import pycwt
-import pyasdf
-import datetime
+import scipy.signal
 import numpy as np
-import pandas as pd
-import sys
-from numba import jit
-from scipy.signal import hilbert
+from fractions import Fraction
 from obspy.signal.util import _npts2nfft
-from obspy.signal.invsim import cosine_taper
-from scipy.fftpack import fft,ifft,next_fast_len
-from obspy.signal.filter import bandpass,lowpass
-from obspy.signal.regression import linear_regression
-from obspy.core.util.base import _get_function_from_entry_point
-from obspy.core.inventory import Inventory, Network, Station, Channel, Site
-from obspy.clients.fdsn import Client
+from obspy.signal.filter import bandpass
+from obspy.signal.invsim import cosine_taper, cosine_sac_taper, invert_spectrum, paz_to_freq_resp
+from obspy.io.sac import attach_paz
+import profiling
 
 
 '''
@@ -29,13 +20,16 @@ from obspy.clients.fdsn import Client
     3) remove nan/inf, mean and trend of each trace
     4) remove instrument response
     
-    Functions: portion_gaps, check_sample_gaps, segment_interpolate, preprocess_raw. 
+    Functions: portion_gaps, gap_report, check_sample_gaps, segment_interpolate, taper_sides, clean_trace, taper_edges, 
+               remove_response_cached, response_cache_info, clear_response_cache, decimation_stages, decimate_trace, 
+               preprocess_raw. 
+    Classes: ResponseCache. 
 '''
 
 def portion_gaps(stream,date_info):
     '''
-    this function tracks the gaps (npts) from the accumulated difference between starttime and endtime
-    of each stream trace. it removes trace with gap length > 30% of trace size.
+    this function tracks the gaps (npts) between the traces of the stream, sorted by starttime, relative to the
+    ideal number of points between starttime and endtime. overlapping traces do not cancel gaps.
     PARAMETERS:
     -------------------
     stream: obspy stream object
@@ -44,52 +38,98 @@ def portion_gaps(stream,date_info):
     -----------------
     pgaps: proportion of gaps/all_pts in stream
     '''
-    # ideal duration of data
-    starttime = date_info['starttime']
-    endtime   = date_info['endtime']
-    npts      = (endtime-starttime)*stream[0].stats.sampling_rate
+    return gap_report(stream,date_info)['gap_fraction']
+
 
-    pgaps=0
-    #loop through all trace to accumulate gaps
-    for ii in range(len(stream)-1):
-        pgaps += (stream[ii+1].stats.starttime-stream[ii].stats.endtime)*stream[ii].stats.sampling_rate
-    if npts!=0:pgaps=pgaps/npts
-    if npts==0:pgaps=1
-    return pgaps
+def _trace_arrays(stream):
+    '''start/end timestamps, sampling rates and number of points of all traces in one pass over the stream'''
+    stats = [tr.stats for tr in stream]
+    starts = np.array([st.starttime.timestamp for st in stats],dtype=np.float64)
+    rates  = np.array([st.sampling_rate for st in stats],dtype=np.float64)
+    npts   = np.array([st.npts for st in stats],dtype=np.int64)
+    ends   = starts+np.maximum(npts-1,0)/rates
+    return starts,ends,rates,npts
 
 
+def gap_report(stream,date_info):
+    '''
+    this function analyses the gaps, overlaps and sampling rates of all traces in stream at once.
+    PARAMETERS:
+    -------------------
+    stream: obspy stream object
+    date_info: dict of starting and ending time of the stream
+    RETURNS:
+    -----------------
+    report: dict with
+        ntraces: number of traces
+        sampling_rate: the highest (integer) sampling rate, used as the rate of the stream
+        gap_fraction: proportion of missing points between traces/all_pts (1 if the ideal duration is zero)
+        overlap_fraction: proportion of points recorded twice by overlapping traces/all_pts
+        gaps: structured array of the gaps with fields starttime (POSIX timestamp) and duration (seconds)
+        rate_mismatch: boolean array, True for traces with a different sampling rate
+        short: boolean array, True for traces with less than 10 points
+    '''
+    if len(stream)==0:
+        raise ValueError("The input stream should not be empty.")
+    starts,ends,rates,npts = _trace_arrays(stream)
+    freq = int(rates.astype(np.int64).max())
 
-def check_sample_gaps(stream,date_info):
+    # ideal duration of data
+    nideal = (date_info['endtime']-date_info['starttime'])*rates[0]
+
+    # sort by starttime, a trace can end before a previous (longer) one
+    order   = np.argsort(starts,kind='stable')
+    last    = np.maximum.accumulate(ends[order])[:-1]
+    nextt   = starts[order][1:]
+    # missing (>0) or repeated (<0) samples between each trace and all traces before it
+    delta   = 1/rates[order][:-1]
+    nmiss   = (nextt-last)/delta-1
+    gaps    = nmiss>0.5
+
+    report = {'ntraces':len(stream),
+              'sampling_rate':freq,
+              'gap_fraction':1.,
+              'overlap_fraction':0.,
+              'gaps':np.array(list(zip(last[gaps]+delta[gaps],nmiss[gaps]*delta[gaps])),
+                              dtype=[('starttime',np.float64),('duration',np.float64)]),
+              'rate_mismatch':rates.astype(np.int64)!=freq,
+              'short':npts<10}
+    if nideal!=0:
+        report['gap_fraction'] = float(np.sum(nmiss[gaps])/nideal)
+        report['overlap_fraction'] = float(-np.sum(nmiss[nmiss<-0.5])/nideal)
+    return report
+
+
+@profiling.instrument('check_sample_gaps')
+def check_sample_gaps(stream,date_info,return_report=False):
     """
     this function checks sampling rate and find gaps of all traces in stream.
     PARAMETERS:
     -----------------
     stream: obspy stream object.
     date_info: dict of starting and ending time of the stream
+    return_report: whether to return the gap report as well, see gap_report. Default is False.
     RETURENS:
     -----------------
-    stream: List of good traces in the stream
+    stream: List of good traces in the stream, without the traces of a different sampling rate or less than 10 points
+    (report: dict of the gap report, if return_report is True)
     """
-    # remove empty/big traces
-    if len(stream)==0 or len(stream)>100:
+    # remove empty traces
+    if len(stream)==0:
         stream = []
         raise ValueError("The output stream should not be empty.")
 
     # remove traces with big gaps
-    if portion_gaps(stream,date_info)>0.3:
+    report = gap_report(stream,date_info)
+    if report['gap_fraction']>0.3:
         stream = []
         raise ValueError("The output stream should not be empty.")
 
-    freqs = []
-    for tr in stream:
-        freqs.append(int(tr.stats.sampling_rate))
-    freq = max(freqs)
-    for tr in stream:
-        if int(tr.stats.sampling_rate) != freq:
-            stream.remove(tr)
-        if tr.stats.npts < 10:
-            stream.remove(tr)
+    keep   = ~(report['rate_mismatch'] | report['short'])
+    stream = obspy.Stream([tr for tr,good in zip(stream,keep) if good])
 
+    if return_report:
+        return stream,report
     return stream
 
 
@@ -125,15 +165,332 @@ def check_sample_gaps(stream,date_info):
 
 
 
+def taper_sides(npts,samp_freq,max_percentage=0.05,max_length=50):
+    '''
+    this function computes the sides of the hann taper of obspy Trace.taper(max_percentage,max_length=max_length).
+    PARAMETERS:
+    -----------------------
+    npts: number of points of the trace
+    samp_freq: sampling frequency
+    max_percentage: maximum length of each side as a fraction of the trace
+    max_length: maximum length of each side in seconds
+    RETURNS:
+    -----------------------
+    left, right: 1D arrays of the taper of the first and last wlen points
+    '''
+    wlen = min(int(max_percentage*npts),int(max_length*samp_freq),int(npts/2))
+    sides = scipy.signal.windows.hann(2*wlen if 2*wlen==npts else 2*wlen+1)
+    return sides[:wlen],sides[len(sides)-wlen:]
+
+
+def _lazy_jit(func):
+    '''compile func with numba in nopython mode on its first call, so that numba is only imported when needed'''
+    compiled = []
+    @functools.wraps(func)
+    def wrapper(*args):
+        if not compiled:
+            from numba import jit
+            compiled.append(jit(nopython=True,cache=True)(func))
+        return compiled[0](*args)
+    return wrapper
+
+
+@_lazy_jit
+def clean_trace(data,left=np.empty(0),right=np.empty(0)):
+    '''
+    this function cleans a float32 trace in place in two passes over the data:
+        1) set nan/inf to zero and accumulate the sums of the least-squares line
+        2) remove the mean and trend (closed-form least-squares line) and taper the edges with left and right
+    PARAMETERS:
+    -----------------------
+    data:  1D float32 array, modified in place
+    left, right: optional taper of the first and last points, e.g. from taper_sides
+    '''
+    npts = data.shape[0]
+    if npts==0:
+        return
+    # time relative to the middle of the trace, so that the slope and the mean are independent
+    tmid = (npts-1)/2.
+    sy  = 0.
+    sty = 0.
+    for ii in range(npts):
+        value = data[ii]
+        if not np.isfinite(value):
+            data[ii] = 0
+            value = 0.
+        sy  += value
+        sty += (ii-tmid)*value
+    stt   = npts*(npts*npts-1.)/12.
+    mean  = sy/npts
+    slope = sty/stt if stt>0 else 0.
+
+    nleft  = left.shape[0]
+    nright = right.shape[0]
+    for ii in range(npts):
+        value = data[ii]-mean-slope*(ii-tmid)
+        if ii<nleft:
+            value *= left[ii]
+        elif ii>=npts-nright:
+            value *= right[ii-npts+nright]
+        data[ii] = value
+
+
+@_lazy_jit
+def taper_edges(data,left,right):
+    '''this function multiplies the first and last points of data in place by the taper sides left and right'''
+    npts = data.shape[0]
+    for ii in range(left.shape[0]):
+        data[ii] *= left[ii]
+    for ii in range(right.shape[0]):
+        data[npts-right.shape[0]+ii] *= right[ii]
+
+
+class ResponseCache:
+    '''
+    This class caches the deconvolution operators of instrument responses: the inverted response (with water level)
+    times the pre_filt taper on the frequency grid of the FFT, and the edges of the time-domain taper. The key is
+    (response epoch, npts, sampling rate, pre_filt, water_level, output), so station-days of the same instrument and
+    length only need an FFT, a multiplication and an inverse FFT.
+    PARAMETERS:
+    ----------------
+    maxsize: the maximum number of operators kept, the least recently used one is dropped first. Default is 8
+             (the response is removed at samp_freq, where the operator of a day takes about 2 MB at 1 Hz and 34 MB at
+             20 Hz). A process of pipeline.run_pipeline runs the station-days of one station after each other, so it
+             only needs the operators of a few stations at a time. The same number of parsed RESP files is kept.
+    '''
+
+    def __init__(self,maxsize=8):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._operators = {}
+        self._inventories = {}
+
+    def __len__(self):
+        return len(self._operators)
+
+    def clear(self):
+        self._operators.clear()
+        self._inventories.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def inventory(self,source):
+        '''return the inventory of the RESP file source, parsed again only when the file is modified'''
+        key = (source,os.path.getmtime(source))
+        if key in self._inventories:
+            inv = self._inventories.pop(key)
+        else:
+            inv = obspy.read_inventory(source,format='RESP')
+            if len(self._inventories)>=self.maxsize:
+                self._inventories.pop(next(iter(self._inventories)))
+        self._inventories[key] = inv
+        return inv
+
+    def get(self,key,evaluate,npts,delta,pre_filt,water_level):
+        '''
+        This function returns (nfft, operator, left, right) for key, computing the operator on a miss.
+        evaluate(nfft) returns the complex response and frequencies on the rfft grid of length nfft.
+        '''
+        key = key+(npts,1./delta,None if pre_filt is None else tuple(pre_filt),water_level)
+        if key in self._operators:
+            self.hits += 1
+            # move to the end, the most recently used
+            entry = self._operators.pop(key)
+            self._operators[key] = entry
+            return entry
+        self.misses += 1
+
+        nfft = _npts2nfft(npts)
+        freq_response, freqs = evaluate(nfft)
+        if water_level is None:
+            freq_response[0] = 0.0
+            freq_response[1:] = 1.0/freq_response[1:]
+        else:
+            invert_spectrum(freq_response,water_level)
+        if pre_filt is not None:
+            freq_response *= cosine_sac_taper(freqs,flimit=pre_filt)
+
+        # only the tapered edges of the time-domain taper of obspy remove_response
+        taper = cosine_taper(npts,0.05,sactaper=True,halfcosine=False)
+        flat = np.flatnonzero(taper==1.)
+        if len(flat)==0:
+            left,right = taper,np.empty(0)
+        else:
+            left,right = taper[:flat[0]].copy(),taper[flat[-1]+1:].copy()
+
+        entry = (nfft,freq_response,left,right)
+        if len(self._operators)>=self.maxsize:
+            self._operators.pop(next(iter(self._operators)))
+        self._operators[key] = entry
+        return entry
+
+
+# operators shared by all calls of preprocess_raw in this process
+_response_cache = ResponseCache()
+
+
+def response_cache_info():
+    '''return (hits, misses, size) of the response cache of preprocess_raw'''
+    return _response_cache.hits,_response_cache.misses,len(_response_cache)
+
+
+def clear_response_cache():
+    '''empty the response cache of preprocess_raw'''
+    _response_cache.clear()
+
+
+def remove_response_cached(tr,source,pre_filt=None,water_level=60,output='VEL',kind='inv',cache=None):
+    '''
+    this function removes the instrument response of a trace like obspy Trace.remove_response (zero mean, 5% cosine
+    taper, rfft, multiplication with the inverted response and pre_filt taper, irfft), with the operator taken from
+    a ResponseCache.
+    PARAMETERS:
+    -----------------------
+    tr: obspy trace, its data is replaced by the corrected float64 data
+    source: obspy inventory for kind='inv', path of a RESP file for kind='RESP' or of a SAC pole-zero file for
+            kind='polozeros'
+    pre_filt: list of 4 corner frequencies of the frequency-domain taper, or None
+    water_level: water level in dB for the inversion of the response, or None
+    output: 'DISP', 'VEL' or 'ACC' (ignored for polozeros, which are used as they are)
+    kind: 'inv' (default), 'RESP' or 'polozeros'
+    cache: a ResponseCache. Default is None (the cache of preprocess_raw).
+    RETURNS:
+    -----------------------
+    tr: the corrected trace
+    '''
+    if cache is None:
+        cache = _response_cache
+    delta = tr.stats.delta
+
+    if kind in ['inv','RESP']:
+        if kind=='RESP':
+            key = ('RESP',source,os.path.getmtime(source),output)
+            inv = cache.inventory(source)
+        else:
+            inv = source
+        # the channel epoch of the trace identifies the response
+        sel = inv.select(network=tr.stats.network,station=tr.stats.station,location=tr.stats.location,
+                         channel=tr.stats.channel,time=tr.stats.starttime)
+        if len(sel)==0:
+            raise ValueError('no response found for %s! abort!' % tr.id)
+        cha = sel[0][0][0]
+        response = cha.response
+        if kind=='inv':
+            key = ('inv',tr.id,str(cha.start_date),str(cha.end_date),output)
+        evaluate = lambda nfft: response.get_evalresp_response(delta,nfft,output=output)
+
+    elif kind=='polozeros':
+        key = ('polozeros',source,os.path.getmtime(source))
+        paz_tr = obspy.Trace()
+        attach_paz(paz_tr,source)
+        paz = paz_tr.stats.paz
+        def evaluate(nfft):
+            freq_response, freqs = paz_to_freq_resp(paz.poles,paz.zeros,paz.gain*paz.sensitivity,delta,nfft,freq=True)
+            return freq_response, freqs
+
+    else:
+        raise ValueError('no such option for kind! please double check!')
+
+    nfft,operator,left,right = cache.get(key,evaluate,tr.stats.npts,delta,pre_filt,water_level)
+
+    data = tr.data.astype(np.float64)
+    data -= data.mean()
+    taper_edges(data,left,right)
+    spec = np.fft.rfft(data,n=nfft)
+    spec *= operator
+    spec[-1] = abs(spec[-1])+0.0j
+    tr.data = np.fft.irfft(spec,n=nfft)[0:tr.stats.npts]
+    return tr
+
+
+def decimation_stages(factor,max_stage=10):
+    '''
+    this function splits an integer decimation factor into stages of at most max_stage (a prime factor larger than
+    max_stage is a stage of its own), largest stage first.
+    PARAMETERS:
+    -----------------------
+    factor: integer decimation factor
+    max_stage: maximum factor of a stage. Default is 10.
+    RETURNS:
+    -----------------------
+    stages: list of integer factors whose product is factor
+    '''
+    primes = []
+    nn = int(factor)
+    pp = 2
+    while pp*pp <= nn:
+        while nn%pp == 0:
+            primes.append(pp)
+            nn //= pp
+        pp += 1
+    if nn > 1:
+        primes.append(nn)
+
+    # first-fit decreasing packing of the prime factors into stages
+    stages = []
+    for pp in sorted(primes,reverse=True):
+        for ii in range(len(stages)):
+            if stages[ii]*pp <= max_stage:
+                stages[ii] *= pp
+                break
+        else:
+            stages.append(pp)
+    return sorted(stages,reverse=True)
+
+
+# kaiser window of the anti-alias filters: about 100 dB stopband attenuation instead of about 55 dB for the default
+_DECIMATION_WINDOW = ('kaiser',10.0)
+
+
+def decimate_trace(tr,samp_freq):
+    '''
+    this function resamples a trace to samp_freq with anti-aliased polyphase filters (scipy resample_poly). an integer
+    factor is applied in stages of at most 10, any other ratio as one rational up/down step. a trace whose sampling
+    rate is below samp_freq (e.g. a 1 Hz LHZ channel with samp_freq=20) is not upsampled: it is kept at its own
+    sampling rate with a warning, as preprocess_raw did before resampling.
+    PARAMETERS:
+    -----------------------
+    tr: obspy trace, modified in place
+    samp_freq: the target sampling frequency
+    RETURNS:
+    -----------------------
+    tr: the resampled trace
+    '''
+    ratio = (Fraction(samp_freq).limit_denominator(10000)/
+             Fraction(tr.stats.sampling_rate).limit_denominator(10000)).limit_denominator(10000)
+    if ratio == 1:
+        return tr
+    if ratio > 1:
+        warnings.warn('samp_freq is larger than the sampling rate of %s, keep %g Hz' % (tr.id,tr.stats.sampling_rate))
+        return tr
+
+    dtype = tr.data.dtype
+    data = tr.data
+    if ratio.numerator == 1:
+        for qq in decimation_stages(ratio.denominator):
+            data = scipy.signal.resample_poly(data,1,qq,window=_DECIMATION_WINDOW)
+    else:
+        data = scipy.signal.resample_poly(data,ratio.numerator,ratio.denominator,window=_DECIMATION_WINDOW)
+
+    tr.data = data.astype(dtype,copy=False)
+    tr.stats.sampling_rate = samp_freq
+    return tr
+
+
+@profiling.instrument('preprocess_raw')
 def preprocess_raw(st,inv,prepro_para,date_info):
     '''
     this function pre-processes the raw data stream by:
         1) remove sigularity, trend and mean of each trace
-        2) filter and correct the time if integer time are between sampling points
+        2) resample to samp_freq (anti-aliased, see decimate_trace), filter and correct the time if integer time are 
+           between sampling points
         3) remove instrument responses with selected methods including:
             "inv"   -> using inventory information to remove_response;
             "RESP_files" -> use the raw download RESP files;
             "polezeros"  -> use pole/zero info for a crude correction of response
+           the deconvolution operators are cached (see ResponseCache), so later station-days of the same
+           instrument and length only need an FFT, a multiplication and an inverse FFT
         4) trim data to a day-long sequence and interpolate it to ensure starting at 00:00:00.000
     
     PARAMETERS:
@@ -141,6 +498,7 @@ def preprocess_raw(st,inv,prepro_para,date_info):
     st:  obspy stream object, containing noise data to be processed
     inv: obspy inventory object, containing stations info
     prepro_para: dict containing fft parameters, such as frequency bands and selection for instrument response removal etc.
+                 the optional key 'dtype' (e.g. np.float32) sets the precision of the output trace.
     date_info:   dict of start and end time of the stream data
     RETURNS:
     -----------------------
@@ -156,6 +514,10 @@ def preprocess_raw(st,inv,prepro_para,date_info):
     freqmin       = prepro_para['freqmin']
     freqmax       = prepro_para['freqmax']
     samp_freq     = prepro_para['samp_freq']
+    if 'dtype' in prepro_para.keys():
+        dtype     = prepro_para['dtype']
+    else:
+        dtype     = None
 
     # parameters for butterworth filter
     f1 = 0.9*freqmin;f2=freqmin
@@ -168,27 +530,25 @@ def preprocess_raw(st,inv,prepro_para,date_info):
     pre_filt  = [f1,f2,f3,f4]
 
 
-    sps = int(st[0].stats.sampling_rate)
     station = st[0].stats.station
 
-    # remove nan/inf, mean and trend of each trace before merging
+    # remove nan/inf, mean and trend of each trace before merging (and taper a single trace in the same pass)
     for ii in range(len(st)):
-
-        #-----set nan/inf values to zeros (it does happens!)-----
-        tttindx = np.where(np.isnan(st[ii].data))
-        if len(tttindx) >0:st[ii].data[tttindx]=0
-        tttindx = np.where(np.isinf(st[ii].data))
-        if len(tttindx) >0:st[ii].data[tttindx]=0
-        
-        #remove trend in data
-        st[ii].data = np.float32(st[ii].data)
-        st[ii].data = scipy.signal.detrend(st[ii].data,type='constant') 
-        st[ii].data = scipy.signal.detrend(st[ii].data,type='linear')
+        st[ii].data = np.require(st[ii].data,dtype=np.float32,requirements=['C','W'])
+        if len(st)==1:
+            clean_trace(st[ii].data,*taper_sides(st[ii].stats.npts,st[ii].stats.sampling_rate))
+        else:
+            clean_trace(st[ii].data)
 
     # merge, taper and filter the data
-    if len(st)>1:st.merge(method=1,fill_value=0)
-    st[0].taper(max_percentage=0.05,max_length=50)	# taper window
-    st[0].data = np.float32(bandpass(st[0].data,pre_filt[0],pre_filt[-1],df=sps,corners=4,zerophase=True)) #filtered with butterworth filter
+    if len(st)>1:
+        st.merge(method=1,fill_value=0)
+        st[0].data = np.require(st[0].data,dtype=np.float32,requirements=['C','W'])
+        taper_edges(st[0].data,*taper_sides(st[0].stats.npts,st[0].stats.sampling_rate))	# taper window
+
+    # resample to samp_freq before the filter, the response removal and the normalisation
+    decimate_trace(st[0],samp_freq)
+    st[0].data = np.float32(bandpass(st[0].data,pre_filt[0],pre_filt[-1],df=st[0].stats.sampling_rate,corners=4,zerophase=True)) #filtered with butterworth filter
 
     
     
@@ -205,8 +565,7 @@ def preprocess_raw(st,inv,prepro_para,date_info):
             else:
                 try:
                     print('removing response for %s using inv'%st[0])
-                    st[0].attach_response(inv)
-                    st[0].remove_response(output=rm_resp_out,pre_filt=pre_filt,water_level=60)
+                    remove_response_cached(st[0],inv,pre_filt=pre_filt,water_level=60,output=rm_resp_out)
                 except Exception:
                     st = []
                     return st
@@ -216,15 +575,14 @@ def preprocess_raw(st,inv,prepro_para,date_info):
             resp = glob.glob(os.path.join(respdir,'RESP.'+station+'*'))
             if len(resp)==0:
                 raise ValueError('no RESP files found for %s' % station)
-            seedresp = {'filename':resp[0],'date':date_info['starttime'],'units':'DIS'}
-            st.simulate(paz_remove=None,pre_filt=pre_filt,seedresp=seedresp[0])
+            remove_response_cached(st[0],resp[0],pre_filt=pre_filt,water_level=600,output='DISP',kind='RESP')
 
         elif rm_resp == 'polozeros':
             print('remove response using polos and zeros')
             paz_sts = glob.glob(os.path.join(respdir,'*'+station+'*'))
             if len(paz_sts)==0:
                 raise ValueError('no polozeros found for %s' % station)
-            st.simulate(paz_remove=paz_sts[0],pre_filt=pre_filt)
+            remove_response_cached(st[0],paz_sts[0],pre_filt=pre_filt,water_level=600,kind='polozeros')
 
         else:
             raise ValueError('no such option for rm_resp! please double check!')
@@ -233,5 +591,8 @@ def preprocess_raw(st,inv,prepro_para,date_info):
     # trim a continous segment into user-defined sequences
     ntr = st[0].trim(starttime=date_info['starttime'],endtime=date_info['endtime'],pad=True,fill_value=0)
     
+    # remove_response works in double precision, return the requested precision
+    if dtype is not None:
+        ntr.data = ntr.data.astype(dtype,copy=False)
 
     return ntr
@@ -0,0 +1,284 @@
+import os
+import csv
+import json
+import time
+import pstats
+import cProfile
+import resource
+import threading
+import functools
+from contextlib import contextmanager
+import numpy as np
+
+
+'''
+    This script measures where the time goes in a run:
+    1) the stages download, check_sample_gaps, preprocess_raw, normalisation_filtering and freq_time_normalisation are
+       wrapped with the instrument decorator, which records wall time, CPU time, bytes processed and memory of
+       every call, labelled with the current task (station-day)
+    2) run a station-day inside task(label) to group its stages; with cprofile=True the task is also profiled with
+       cProfile and the profiles of the slowest tasks are kept
+    3) write the records and a per-stage summary to JSON or CSV, and the kept profiles to .prof files
+
+    The memory of a stage is measured with the peak resident set size of the process, which only ever grows over
+    the life of a process: peak_rss_bytes is that high-water mark at the end of the stage (so it includes the peaks
+    of the earlier stages), and rss_growth_bytes is how much the stage raised it, i.e. the extra memory of the
+    stage above everything the process had needed before (0 if the stage fits in memory that was already used).
+
+    Profiling is off by default: an instrumented function then only checks one flag before running.
+
+    Functions: enable, disable, is_enabled, settings, instrument, stage, task, records, add_records, take_records,
+               add_profiles, take_profiles, summary, write_json, write_csv, dump_profiles, reset.
+'''
+
+
+class _State(threading.local):
+    '''the task label of the current thread'''
+    task = None
+
+
+_enabled = False
+_cprofile = False
+_slowest = 5
+_records = []
+_profiles = []      # (wall time, task label, pstats.Stats) of the slowest tasks
+_lock = threading.Lock()
+_local = _State()
+
+
+def enable(cprofile=False, slowest=5):
+    '''
+    This function switches the recording on.
+    PARAMETERS:
+    ----------------
+    cprofile: whether to profile every task with cProfile. Default is False.
+    slowest: the number of the slowest task profiles to keep. Default is 5.
+    '''
+    global _enabled, _cprofile, _slowest
+    _enabled = True
+    _cprofile = cprofile
+    _slowest = slowest
+
+
+def disable():
+    '''This function switches the recording off, the records are kept.'''
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def settings():
+    '''This function returns the keyword arguments of enable of the current settings, e.g. to enable a worker alike.'''
+    return {'cprofile':_cprofile, 'slowest':_slowest}
+
+
+def reset():
+    '''This function removes all records and profiles.'''
+    with _lock:
+        del _records[:]
+        del _profiles[:]
+
+
+def _nbytes(obj):
+    '''bytes of the data of an array, trace, stream or a list of them (0 for anything else)'''
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    data = getattr(obj, 'data', None)
+    if isinstance(data, np.ndarray):
+        return data.nbytes
+    if isinstance(obj, (list, tuple)) or hasattr(obj, 'traces'):
+        return sum(_nbytes(item) for item in obj)
+    return 0
+
+
+def _peak_rss():
+    '''peak resident set size of this process in bytes over its lifetime (the high-water mark, never reset)'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+
+@contextmanager
+def stage(name, nbytes=0):
+    '''
+    This function records a block of code as a stage.
+    PARAMETERS:
+    ----------------
+    name: a string of the name of the stage
+    nbytes: the bytes processed by the stage, if known
+    '''
+    if not _enabled:
+        yield
+        return
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    peak = _peak_rss()
+    try:
+        yield
+    finally:
+        peak_rss = _peak_rss()
+        record = {'stage':name,
+                  'task':_local.task,
+                  'wall_s':time.perf_counter()-wall,
+                  'cpu_s':time.process_time()-cpu,
+                  'bytes':int(nbytes),
+                  'peak_rss_bytes':peak_rss,
+                  'rss_growth_bytes':peak_rss-peak,
+                  'pid':os.getpid()}
+        with _lock:
+            _records.append(record)
+
+
+def instrument(name):
+    '''
+    This function is a decorator that records every call of a function as the stage name. The bytes processed are
+    taken from the data of the arrays, traces and streams among the positional arguments.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with stage(name, sum(_nbytes(arg) for arg in args)):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def task(label):
+    '''
+    This function labels the stages run inside it with label (e.g. 'QRZ 2021_11_01_00_00_00') and records the whole
+    block as the stage 'task'. With cprofile=True the block is profiled and kept if it is among the slowest tasks.
+    '''
+    if not _enabled:
+        yield
+        return
+    previous = _local.task
+    _local.task = label
+    profiler = cProfile.Profile() if _cprofile else None
+    wall = time.perf_counter()
+    try:
+        if profiler is not None:
+            profiler.enable()
+        with stage('task'):
+            yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            _keep_profiles([(time.perf_counter()-wall, label, pstats.Stats(profiler))])
+        _local.task = previous
+
+
+def records():
+    '''This function returns a copy of the list of records (dicts with keys stage, task, wall_s, cpu_s, bytes,
+       peak_rss_bytes, rss_growth_bytes and pid).'''
+    with _lock:
+        return list(_records)
+
+
+def add_records(new):
+    '''This function adds records from another process (e.g. a worker of pipeline.run_pipeline).'''
+    with _lock:
+        _records.extend(new)
+
+
+def take_records():
+    '''This function returns the records and removes them, e.g. to send them from a worker to the main process.'''
+    with _lock:
+        taken = list(_records)
+        del _records[:]
+    return taken
+
+
+class _StatsData(object):
+    '''the statistics of a cProfile profile sent from another process, in the form read by pstats.Stats'''
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def _keep_profiles(new):
+    '''add (wall time, task label, pstats.Stats) of tasks and keep the slowest ones'''
+    with _lock:
+        _profiles.extend(new)
+        _profiles.sort(key=lambda item: -item[0])
+        del _profiles[_slowest:]
+
+
+def add_profiles(new):
+    '''This function adds the task profiles of another process, as returned by take_profiles there.'''
+    _keep_profiles([(elapsed, label, pstats.Stats(_StatsData(stats))) for elapsed, label, stats in new])
+
+
+def take_profiles():
+    '''
+    This function returns the kept task profiles as (wall time, task label, statistics) and removes them, e.g. to send
+    them from a worker to the main process (the statistics are the picklable dict of pstats.Stats.stats).
+    '''
+    with _lock:
+        taken = [(elapsed, label, stats.stats) for elapsed, label, stats in _profiles]
+        del _profiles[:]
+    return taken
+
+
+def summary():
+    '''
+    This function aggregates the records per stage.
+    RETURNS:
+    ----------------
+    rows: a list of dicts with keys stage, calls, wall_s, cpu_s, bytes, max_wall_s, peak_rss_bytes (the largest
+          high-water mark of the processes) and max_rss_growth_bytes (the largest growth of one call), the slowest
+          stage (by total wall time) first
+    '''
+    rows = {}
+    for record in records():
+        row = rows.setdefault(record['stage'], {'stage':record['stage'], 'calls':0, 'wall_s':0., 'cpu_s':0., 'bytes':0,
+                                                'max_wall_s':0., 'peak_rss_bytes':0, 'max_rss_growth_bytes':0})
+        row['calls'] += 1
+        row['wall_s'] += record['wall_s']
+        row['cpu_s'] += record['cpu_s']
+        row['bytes'] += record['bytes']
+        row['max_wall_s'] = max(row['max_wall_s'], record['wall_s'])
+        row['peak_rss_bytes'] = max(row['peak_rss_bytes'], record['peak_rss_bytes'])
+        row['max_rss_growth_bytes'] = max(row['max_rss_growth_bytes'], record['rss_growth_bytes'])
+    return sorted(rows.values(), key=lambda row: -row['wall_s'])
+
+
+def write_json(path):
+    '''This function writes the per-stage summary and all records to a JSON file.'''
+    with open(path, 'w') as fp:
+        json.dump({'summary':summary(), 'records':records()}, fp, indent=1)
+
+
+def write_csv(path, per_record=False):
+    '''This function writes the per-stage summary (or every record with per_record=True) to a CSV file.'''
+    rows = records() if per_record else summary()
+    fields = ['stage', 'task', 'wall_s', 'cpu_s', 'bytes', 'peak_rss_bytes', 'rss_growth_bytes', 'pid'] if per_record else \
+             ['stage', 'calls', 'wall_s', 'cpu_s', 'bytes', 'max_wall_s', 'peak_rss_bytes', 'max_rss_growth_bytes']
+    with open(path, 'w', newline='') as fp:
+        writer = csv.DictWriter(fp, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def dump_profiles(outdir):
+    '''
+    This function writes the cProfile statistics of the slowest tasks to outdir (open them with pstats or snakeviz).
+    RETURNS:
+    ----------------
+    files: a list of the written .prof files, the slowest task first
+    '''
+    files = []
+    with _lock:
+        profiles = list(_profiles)
+    for irank, (elapsed, label, stats) in enumerate(profiles):
+        name = '%02d_%s.prof' % (irank, ''.join(c if c.isalnum() else '_' for c in str(label)))
+        ff = os.path.join(outdir, name)
+        stats.dump_stats(ff)
+        files.append(ff)
+    return files
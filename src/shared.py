@@ -0,0 +1,156 @@
+import os
+import json
+import obspy
+import numpy as np
+
+
+'''
+    This script keeps the waveforms of many stations over the same time chunk in one memory-mapped array file, so
+    that worker processes share them instead of pickling and copying obspy traces:
+    1) a .npy file of shape (n_sta, npts), one row per station, with a small JSON sidecar (.json) of the station ids,
+       the start time, the sampling rate and the rows that hold data
+    2) every worker maps the file and writes or reads its own rows in place; the pages are shared by all the
+       processes through the page cache, so the resident memory is one copy of the chunk whatever the number of
+       workers, and reading a row copies nothing
+    3) the whole (n_sta, npts) array is an input of e.g. correlation.correlate without any copy
+
+    Put the file on a memory file system (e.g. /dev/shm) to keep it off the disk.
+
+    Classes: TraceArray.
+'''
+
+
+def _sidecar(path):
+    return os.path.splitext(path)[0]+'.json'
+
+
+class TraceArray(object):
+    '''
+    This class maps a (station, sample) array file written by TraceArray.create.
+    PARAMETERS:
+    ----------------
+    path: a string of the .npy file
+    mode: 'r' (default) to map read-only, 'r+' to write rows in place
+    ATTRIBUTES:
+    ----------------
+    data: the memory-mapped 2D array (n_sta, npts)
+    ids: the list of station ids of the rows
+    starttime: obspy UTCDateTime of the first sample
+    sampling_rate: sampling frequency
+    filled: a list of whether every row holds data, as recorded by mark_filled
+    '''
+
+    def __init__(self,path,mode='r'):
+        if mode not in ['r','r+']:
+            raise ValueError('no such option for mode! please double check!')
+        self.path = path
+        with open(_sidecar(path)) as fp:
+            meta = json.load(fp)
+        self.ids = meta['ids']
+        self.starttime = obspy.UTCDateTime(meta['starttime'])
+        self.sampling_rate = meta['sampling_rate']
+        self.filled = meta['filled']
+        self.data = np.load(path,mmap_mode=mode)
+        self._rows = {seed_id:irow for irow,seed_id in enumerate(self.ids)}
+
+    @classmethod
+    def create(cls,path,ids,starttime,sampling_rate,npts,dtype=np.float32):
+        '''
+        This function creates an array file of zeros and its sidecar, and maps it for writing.
+        PARAMETERS:
+        ----------------
+        path: a string of the .npy file
+        ids: a list of unique station ids (e.g. NET.STA.LOC.CHAN), one per row
+        starttime: obspy UTCDateTime of the first sample
+        sampling_rate: sampling frequency
+        npts: the number of points of every row
+        dtype: the data type. Default is np.float32, the precision of the SAC files.
+        '''
+        if len(ids) < 1 or len(set(ids)) != len(ids):
+            raise ValueError('station ids should be unique and not empty! please double check!')
+        # a file of zeros, only the written rows take disk space
+        data = np.lib.format.open_memmap(path,mode='w+',dtype=dtype,shape=(len(ids),int(npts)))
+        del data
+        _write_meta(path,{'ids':list(ids),
+                          'starttime':str(obspy.UTCDateTime(starttime)),
+                          'sampling_rate':float(sampling_rate),
+                          'filled':[False]*len(ids)})
+        return cls(path,mode='r+')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def npts(self):
+        return self.data.shape[1]
+
+    def close(self):
+        '''This function writes the changed rows to the file and unmaps it.'''
+        if self.data is not None and self.data.mode == 'r+':
+            self.data.flush()
+        self.data = None
+
+    def row(self,seed_id):
+        '''return the row of a station id'''
+        if seed_id not in self._rows:
+            raise ValueError('no such station %s in %s! please double check!' % (seed_id,self.path))
+        return self._rows[seed_id]
+
+    def write(self,seed_id,trace):
+        '''
+        This function writes a trace into the row of a station, aligned on the start time of the array. The
+        samples outside the time window of the array are dropped, and the samples not covered by the trace are zero.
+        PARAMETERS:
+        ----------------
+        seed_id: the station id of the row
+        trace: obspy trace with the sampling rate of the array
+        RETURNS:
+        ----------------
+        irow: the row of the station
+        '''
+        if self.data.mode != 'r+':
+            raise ValueError('the array is mapped read-only! please double check!')
+        if abs(trace.stats.sampling_rate-self.sampling_rate) > 1e-6*self.sampling_rate:
+            raise ValueError('sampling rate of %s does not match the array! please double check!' % seed_id)
+        irow = self.row(seed_id)
+        offset = int(round((trace.stats.starttime-self.starttime)*self.sampling_rate))
+        i0 = max(offset,0)
+        i1 = min(offset+trace.stats.npts,self.npts)
+        row = self.data[irow]
+        row[:] = 0
+        if i1 > i0:
+            row[i0:i1] = trace.data[i0-offset:i1-offset]
+        return irow
+
+    def trace(self,seed_id):
+        '''return the row of a station as an obspy trace, whose data is a view of the mapped file (no copy)'''
+        net,sta,location,chan = (seed_id.split('.')+['','','',''])[:4]
+        header = {'network':net,'station':sta,'location':location.replace('*',''),'channel':chan,
+                  'sampling_rate':self.sampling_rate,'starttime':self.starttime}
+        return obspy.Trace(self.data[self.row(seed_id)],header=header)
+
+    def mark_filled(self,seed_ids):
+        '''
+        This function records in the sidecar that the rows of seed_ids hold data. Call it from one process only
+        (e.g. the main process of pipeline.run_pipeline once the workers have written the rows).
+        '''
+        for seed_id in seed_ids:
+            self.filled[self.row(seed_id)] = True
+        _write_meta(self.path,{'ids':self.ids,
+                               'starttime':str(self.starttime),
+                               'sampling_rate':self.sampling_rate,
+                               'filled':self.filled})
+
+
+def _write_meta(path,meta):
+    '''write the sidecar at once, so that a reader never sees a partial file'''
+    tmp = _sidecar(path)+'.tmp'
+    with open(tmp,'w') as fp:
+        json.dump(meta,fp,indent=1)
+    os.replace(tmp,_sidecar(path))
@@ -0,0 +1,144 @@
+import os
+import numpy as np
+from scipy.signal import hilbert
+
+
+'''
+    This script stacks the cross-correlation functions of many days into Green's functions:
+    1) keep a running linear sum of the correlation functions of every station pair
+    2) optionally keep a running sum of their instantaneous phase (unit phasors of the analytic signal from hilbert)
+       for the phase-weighted stack (Schimmel and Paulssen, 1997)
+    3) checkpoint the running sums to disk, so that a long campaign can be extended one day at a time
+
+    Memory is one correlation function (two with the phase-weighted stack) per station pair, whatever the number of
+    days.
+
+    Functions: stack_day.
+    Classes: CorrelationStack.
+'''
+
+
+class CorrelationStack:
+    '''
+    This class is the running stack of the correlation functions of many station pairs.
+    PARAMETERS:
+    ----------------
+    pairs: a list of (i, j) station pairs of the rows of the correlation functions, see correlation.correlate
+    lags: a 1D array of the lags in seconds
+    pws: whether to keep the phase stack for the phase-weighted stack. Default is False.
+    power: the power of the phase coherence in the phase-weighted stack. Default is 2.
+    ATTRIBUTES:
+    ----------------
+    pws: whether the stack keeps the phase stack
+    count: the number of days in the stack
+    days: the list of labels of the days in the stack
+    '''
+
+    def __init__(self, pairs, lags, pws=False, power=2):
+        self.pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+        self.lags = np.asarray(lags, dtype=np.float64)
+        self.pws = bool(pws)
+        self.power = power
+        self.linear_sum = np.zeros((len(self.pairs), len(self.lags)), dtype=np.float64)
+        self.phase_sum = np.zeros(self.linear_sum.shape, dtype=np.complex128) if pws else None
+        self.count = 0
+        self.days = []
+
+    def add(self, ccf, day=None):
+        '''
+        This function adds the correlation functions of one day to the stack.
+        PARAMETERS:
+        ----------------
+        ccf: a 2D array (n_pairs, n_lags) of the correlation functions of the day
+        day: an optional label of the day (e.g. '2021_11_01'). A day that is already in the stack is not added again.
+        RETURNS:
+        ----------------
+        added: whether the day was added
+        '''
+        ccf = np.asarray(ccf)
+        if ccf.shape != self.linear_sum.shape:
+            raise ValueError('correlation functions do not match the pairs and lags of the stack! please double check!')
+        if day is not None:
+            if str(day) in self.days:
+                return False
+            self.days.append(str(day))
+
+        self.linear_sum += ccf
+        if self.phase_sum is not None:
+            analytic = hilbert(ccf, axis=-1)
+            amplitude = np.abs(analytic)
+            # unit phasors, zero where the correlation function vanishes
+            self.phase_sum += np.divide(analytic, amplitude, out=np.zeros_like(analytic), where=amplitude > 0)
+        self.count += 1
+        return True
+
+    def linear(self):
+        '''return the linear stack (n_pairs, n_lags), the mean of the correlation functions'''
+        if self.count == 0:
+            raise ValueError('the stack is empty! please double check!')
+        return self.linear_sum/self.count
+
+    def phase_weighted(self):
+        '''return the phase-weighted stack (n_pairs, n_lags), the linear stack weighted by the phase coherence'''
+        if self.phase_sum is None:
+            raise ValueError('the stack has no phase stack, create it with pws=True! please double check!')
+        return self.linear()*np.abs(self.phase_sum/self.count)**self.power
+
+    def save(self, path):
+        '''
+        This function writes the stack to a npz checkpoint. The file is replaced at once, so an interrupted save
+        leaves the previous checkpoint intact.
+        '''
+        arrays = {'pairs':self.pairs, 'lags':self.lags, 'pws':self.pws, 'power':self.power, 'linear_sum':self.linear_sum,
+                  'count':self.count, 'days':np.array(self.days, dtype=str)}
+        if self.phase_sum is not None:
+            arrays['phase_sum'] = self.phase_sum
+        tmp = path+'.tmp.npz'
+        np.savez(tmp, **arrays)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        '''This function reads a stack from a npz checkpoint written by save.'''
+        with np.load(path, allow_pickle=False) as ff:
+            # checkpoints without the pws flag have a phase stack if they were created with pws
+            pws = bool(ff['pws']) if 'pws' in ff.files else 'phase_sum' in ff.files
+            stack = cls(ff['pairs'], ff['lags'], pws=pws, power=ff['power'].item())
+            stack.linear_sum = ff['linear_sum']
+            if stack.phase_sum is not None:
+                stack.phase_sum = ff['phase_sum']
+            stack.count = int(ff['count'])
+            stack.days = ff['days'].tolist()
+        return stack
+
+
+def stack_day(path, ccf, pairs, lags, day, pws=False, power=2):
+    '''
+    This function adds the correlation functions of one day to the stack checkpointed in path, creating the
+    checkpoint on the first day. Days that are already in the checkpoint are skipped, so a rerun does not count a day
+    twice.
+    PARAMETERS:
+    ----------------
+    path: a string of the npz checkpoint
+    ccf: a 2D array (n_pairs, n_lags) of the correlation functions of the day
+    pairs, lags: the station pairs and lags of ccf, see correlation.correlate
+    day: a label of the day (e.g. '2021_11_01')
+    pws, power: the phase-weighted stack options, see CorrelationStack. They should match the checkpoint, which
+                records them when it is created.
+    RETURNS:
+    ----------------
+    stack: the updated CorrelationStack
+    '''
+    if os.path.isfile(path):
+        stack = CorrelationStack.load(path)
+        lags = np.asarray(lags, dtype=np.float64)
+        if not np.array_equal(stack.pairs, np.asarray(pairs).reshape(-1, 2)) or stack.lags.shape != lags.shape \
+                or not np.allclose(stack.lags, lags):
+            raise ValueError('pairs or lags do not match the stack in %s! please double check!' % path)
+        if stack.pws != bool(pws) or (pws and stack.power != power):
+            raise ValueError('pws or power does not match the stack in %s! please double check!' % path)
+    else:
+        stack = CorrelationStack(pairs, lags, pws=pws, power=power)
+    if stack.add(ccf, day):
+        stack.save(path)
+    return stack
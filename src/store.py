@@ -0,0 +1,186 @@
+import h5py
+import obspy
+import numpy as np
+
+
+'''
+    This script stores the pre-processed and frequency-time normalised waveforms on disk, so that the later steps
+    (e.g. cross-correlation) do not need to recompute them:
+    1) one HDF5 group per channel (NET.STA.LOC.CHAN) with one row per station-day of the summed normalised waveform
+    2) optionally the normalised waveform of every frequency window of the station-day
+    3) rows are appended one at a time into chunked, compressed and resizable datasets, so memory stays flat over
+       long runs, and every row is split into chunks of at most CHUNK_NPTS samples (1 MiB of float32), which can
+       be sliced without reading the rest of the file
+
+    Classes: FTNStore.
+'''
+
+# maximum number of samples along the time axis of a chunk, so that a day at 100 Hz is not one 35 MB chunk
+CHUNK_NPTS = 2**18
+
+
+class FTNStore(object):
+    '''
+    This class appends frequency-time normalised waveforms into an HDF5 file. The layout is:
+        /NET.STA.LOC.CHAN/data        float32 (n_days, npts), the summed normalised waveforms
+        /NET.STA.LOC.CHAN/starttime   float64 (n_days,), POSIX timestamps of the first samples
+        /NET.STA.LOC.CHAN/windows     float32 (n_days, n_win, npts), optional normalised waveform of every window
+    with the sampling_rate and npts (and the frequency windows) as attributes of the group.
+    PARAMETERS:
+    ----------------
+    path: a string of the HDF5 file
+    mode: 'a' (default) to create or extend the file, 'r' to read only, 'w' to overwrite
+    compression: the compression filter of the datasets, 'gzip' (default), 'lzf' or None
+    '''
+
+    def __init__(self,path,mode='a',compression='gzip'):
+        if mode not in ['a','r','w']:
+            raise ValueError('no such option for mode! please double check!')
+        self.path = path
+        self.compression = compression
+        self.file = h5py.File(path,mode)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    def __contains__(self,seed_id):
+        return seed_id in self.file
+
+    def close(self):
+        self.file.close()
+
+    def ids(self):
+        '''return the list of NET.STA.LOC.CHAN in the store'''
+        return sorted(self.file.keys())
+
+    def _group(self,seed_id,sampling_rate,npts,n_win=None,target_frequency_window=None):
+        '''return the group of a channel, creating its datasets on first use'''
+        if seed_id in self.file:
+            group = self.file[seed_id]
+            if group.attrs['sampling_rate'] != sampling_rate or group.attrs['npts'] != npts:
+                raise ValueError('sampling rate or length of %s does not match the store! please double check!' % seed_id)
+        else:
+            group = self.file.create_group(seed_id)
+            group.attrs['sampling_rate'] = sampling_rate
+            group.attrs['npts'] = npts
+            options = {'compression':self.compression,'shuffle':self.compression is not None}
+            group.create_dataset('data',shape=(0,npts),maxshape=(None,npts),chunks=(1,min(npts,CHUNK_NPTS)),dtype=np.float32,**options)
+            group.create_dataset('starttime',shape=(0,),maxshape=(None,),chunks=(1024,),dtype=np.float64)
+
+        if n_win is not None and 'windows' in group and group['windows'].shape[1] != n_win:
+            raise ValueError('number of frequency windows of %s does not match the store! please double check!' % seed_id)
+        if n_win is not None and 'windows' not in group:
+            options = {'compression':self.compression,'shuffle':self.compression is not None}
+            group.create_dataset('windows',shape=(group['data'].shape[0],n_win,npts),maxshape=(None,n_win,npts),
+                                 chunks=(1,1,min(npts,CHUNK_NPTS)),dtype=np.float32,**options)
+            if target_frequency_window is not None:
+                group.attrs['target_frequency_window'] = np.asarray(target_frequency_window,dtype=np.float64)
+        return group
+
+    def append(self,trace,windows=None,target_frequency_window=None):
+        '''
+        This function writes the summed normalised waveform of one station-day. A station-day that is already in the
+        store is overwritten, so a rerun does not add duplicate rows.
+        PARAMETERS:
+        ----------------
+        trace: obspy trace of the summed normalised waveform (e.g. from normalisation.freq_time_normalise_sum)
+        windows: an optional 2D array (n_win, npts) of the normalised waveform of every frequency window
+                 (e.g. from normalisation.freq_time_normalisation)
+        target_frequency_window: the list of frequency windows of windows, stored as an attribute
+        RETURNS:
+        ----------------
+        irow: the row of the station-day in the datasets of the channel
+        '''
+        stats = trace.stats
+        n_win = None if windows is None else len(windows)
+        if windows is not None and np.shape(windows) != (n_win,stats.npts):
+            raise ValueError('windows should be of shape (n_win, npts) of the trace! please double check!')
+        group = self._group(trace.id,stats.sampling_rate,stats.npts,n_win,target_frequency_window)
+
+        times = group['starttime']
+        timestamp = stats.starttime.timestamp
+        irow = np.flatnonzero(times[:] == timestamp)
+        if len(irow) > 0:
+            irow = int(irow[0])
+        else:
+            irow = times.shape[0]
+            times.resize((irow+1,))
+            group['data'].resize((irow+1,stats.npts))
+            if 'windows' in group:
+                group['windows'].resize(irow+1,axis=0)
+            times[irow] = timestamp
+
+        group['data'][irow] = np.asarray(trace.data,dtype=np.float32)
+        if windows is not None:
+            group['windows'][irow] = np.asarray(windows,dtype=np.float32)
+        return irow
+
+    def starttimes(self,seed_id):
+        '''return the list of obspy UTCDateTime of the station-days of a channel'''
+        return [obspy.UTCDateTime(t) for t in self.file[seed_id]['starttime'][:]]
+
+    def get(self,seed_id,starttime,windows=False):
+        '''
+        This function reads one station-day.
+        PARAMETERS:
+        ----------------
+        seed_id: a string of NET.STA.LOC.CHAN
+        starttime: obspy UTCDateTime of the first sample
+        windows: whether to return the normalised waveform of every window as well. Default is False.
+        RETURNS:
+        ----------------
+        tr: obspy trace of the summed normalised waveform
+        (win: a 2D array (n_win, npts) of the normalised waveform of every window, if windows is True)
+        '''
+        group = self.file[seed_id]
+        irow = self._row(group,starttime)
+        net,sta,location,chan = seed_id.split('.')
+        header = {'network':net,'station':sta,'location':location,'channel':chan,
+                  'sampling_rate':group.attrs['sampling_rate'],'starttime':obspy.UTCDateTime(starttime)}
+        tr = obspy.Trace(group['data'][irow],header=header)
+        if windows:
+            return tr, group['windows'][irow]
+        return tr
+
+    def read(self,starttime,ids=None):
+        '''
+        This function reads the station-day starting at starttime of many channels into one array, e.g. as input of
+        the cross-correlation. Channels without this station-day are left out.
+        PARAMETERS:
+        ----------------
+        starttime: obspy UTCDateTime of the first sample
+        ids: a list of NET.STA.LOC.CHAN. Default is None (all channels in the store).
+        RETURNS:
+        ----------------
+        ids: the list of NET.STA.LOC.CHAN of the rows of data
+        data: a 2D float32 array (n_sta, npts)
+        '''
+        if ids is None:
+            ids = self.ids()
+        found = []
+        rows = []
+        for seed_id in ids:
+            group = self.file[seed_id]
+            try:
+                irow = self._row(group,starttime)
+            except ValueError:
+                continue
+            found.append(seed_id)
+            rows.append(group['data'][irow])
+        if len(rows) == 0:
+            raise ValueError('no station-day starting at %s in the store! please double check!' % starttime)
+        npts = set(len(row) for row in rows)
+        if len(npts) > 1:
+            lengths = ', '.join('%s: %d' % (seed_id,len(row)) for seed_id,row in zip(found,rows))
+            raise ValueError('channels of different lengths (%s) cannot be read into one array! please double check!' % lengths)
+        return found, np.vstack(rows)
+
+    @staticmethod
+    def _row(group,starttime):
+        irow = np.flatnonzero(group['starttime'][:] == obspy.UTCDateTime(starttime).timestamp)
+        if len(irow) == 0:
+            raise ValueError('no station-day starting at %s in the store! please double check!' % starttime)
+        return int(irow[0])
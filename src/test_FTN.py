@@ -1,8 +1,23 @@
+import sys
+import json
+import pstats
+import fnmatch
 import pytest
+import subprocess
+from obspy.clients.fdsn.header import FDSNNoDataException
 from dependencies import *
 import download_raw_data
 import processing
 import normalisation
+import pipeline
+import archive
+import store
+import correlation
+import stacking
+import bench_FTN
+import profiling
+import ftn
+import shared
 
 def test_event_list(): 
     
@@ -278,11 +293,13 @@ def test_target_frequency():
        1) the existence of the function
        2) the input and output types of the function
        3) the accuracy of the output
+       4) if exception is raised for an unknown type of instrument
        
        ASSERTION: 
        If 1) false: raise exception that the function does not exist.
        If 2) false: Type error: the outputs should be the corresponding types described in the error message. 
        If 3) false: the function does not return the correct result.
+       If 4) false: Value error is not successfully raised.
        
     '''   
     
@@ -305,9 +322,9 @@ def test_target_frequency():
     assert type(output1) == tuple, "TypeError, the output should be a tuple of min&max targeted filtering frequency range."
     
     #test if exception is raised
-    #chan_except = 'NHZ'
-    #with pytest.raises(NameError):
-        #normalisation.target_frequency(chan_except, freqmin, freqmax)
+    chan_except = 'NHZ'
+    with pytest.raises(ValueError):
+        normalisation.target_frequency(chan_except, freqmin, freqmax)
     
     #test the accuracy of the output frequency range
     freqmin1 = 0.00150
@@ -457,4 +474,1237 @@ def test_normalisation ():
         
         
     
-        
\ No newline at end of file
+        
+
+def test_normalisation_batched():
+    '''This function tests
+    
+       1) the shape of the batched output
+       2) the accuracy of the batched output against the per-window butter_bandpass_filter + hilbert path
+       
+       ASSERTION: 
+       If 1) false: the output should be a 2-D array with one row per frequency window.
+       If 2) false: the batched engine does not reproduce the per-window result.
+    '''
+    #test case: synthetic noise
+    rng = np.random.default_rng(42)
+    ntr = rng.standard_normal(4000)
+    samp_freq = 1
+    target_frequency_window = normalisation.target_frequency_window('BHZ', 0.02, 0.07)
+    
+    output1 = normalisation.freq_time_normalisation(target_frequency_window, samp_freq, ntr)
+    assert output1.shape == (len(target_frequency_window), len(ntr)), "ValueError, the output shape is not correct."
+    
+    #reference: one filter and one Hilbert transform per frequency window
+    for iwin, (lowcut, highcut) in enumerate(target_frequency_window):
+        filt = normalisation.butter_bandpass_filter(ntr, lowcut, highcut, samp_freq)
+        reference = filt/np.abs(hilbert(filt))
+        assert np.allclose(output1[iwin], reference), "ValueError, the batched output is not correct."
+
+
+def test_normalisation_fft():
+    '''This function tests
+    
+       1) the accuracy of the frequency-domain engine against the default time-domain engine
+       2) if the exception is raised for an unknown engine
+       
+       ASSERTION: 
+       If 1) false: the 'fft' engine does not reproduce the 'iir' engine away from the ends of the trace.
+       If 2) false: Value error is not successfully raised.
+    '''
+    #test case: synthetic noise
+    rng = np.random.default_rng(42)
+    ntr = rng.standard_normal(20000)
+    samp_freq = 1
+    target_frequency_window = normalisation.target_frequency_window('BHZ', 0.02, 0.07)
+    
+    output1 = normalisation.freq_time_normalisation(target_frequency_window, samp_freq, ntr)
+    output2 = normalisation.freq_time_normalisation(target_frequency_window, samp_freq, ntr, method='fft')
+    assert output2.shape == output1.shape, "ValueError, the output shape is not correct."
+    
+    #compare away from the start-up of the causal filter and the wrap-around of the FFT
+    interior = slice(4000, 16000)
+    rms = np.sqrt(np.mean((output2[:, interior]-output1[:, interior])**2))
+    assert rms < 1e-3, "ValueError, the 'fft' engine does not agree with the 'iir' engine."
+    
+    with pytest.raises(ValueError):
+        normalisation.freq_time_normalisation(target_frequency_window, samp_freq, ntr, method='spectrum')
+
+
+def test_freq_time_normalise_sum():
+    '''This function tests
+    
+       1) the accuracy of the streamed sum against summing the output of freq_time_normalisation
+       2) whether the result is written into a caller-supplied output buffer
+       3) if the exception is raised for empty input
+       
+       ASSERTION: 
+       If 1) false: the streamed sum is not correct.
+       If 2) false: the output buffer is not used.
+       If 3) false: Value error is not successfully raised.
+    '''
+    #test case: synthetic noise
+    rng = np.random.default_rng(42)
+    ntr = rng.standard_normal(4000)
+    samp_freq = 1
+    target_frequency_window = normalisation.target_frequency_window('BHZ', 0.02, 0.07)
+    
+    for method in ['iir', 'fft']:
+        reference = np.sum(normalisation.freq_time_normalisation(target_frequency_window, samp_freq, ntr, method=method), axis=0)
+        output1 = normalisation.freq_time_normalise_sum(target_frequency_window, samp_freq, ntr, method=method, block_size=3)
+        assert output1.dtype == np.float32, "TypeError, the output should be a float32 array."
+        assert np.allclose(output1, reference, atol=1e-4), "ValueError, the streamed sum is not correct."
+    
+    out = np.full(len(ntr), np.nan, dtype=np.float32)
+    output2 = normalisation.freq_time_normalise_sum(target_frequency_window, samp_freq, ntr, method='fft', out=out)
+    assert output2 is out, "ValueError, the result should be written into the output buffer."
+    assert np.allclose(out, reference, atol=1e-4), "ValueError, the streamed sum is not correct."
+    
+    with pytest.raises(ValueError):
+        normalisation.freq_time_normalise_sum(target_frequency_window, samp_freq, [])
+
+
+def test_filter_bank():
+    '''This function tests
+    
+       1) the accuracy of the second-order-section filters against butter_bandpass_filter
+       2) whether filter banks are reused from the cache, using its hit/miss counters
+       3) if the exception is raised for an empty list of frequency windows
+       
+       ASSERTION: 
+       If 1) false: the filter bank does not reproduce butter_bandpass_filter.
+       If 2) false: the filter bank is designed again for identical parameters.
+       If 3) false: Value error is not successfully raised.
+    '''
+    #test case: synthetic noise
+    rng = np.random.default_rng(42)
+    ntr = rng.standard_normal(4000)
+    samp_freq = 1
+    target_frequency_window = normalisation.target_frequency_window('BHZ', 0.02, 0.07)
+    
+    normalisation.clear_filter_bank_cache()
+    bank = normalisation.filter_bank('BHZ', 0.02, 0.07, samp_freq)
+    assert len(bank) == len(target_frequency_window), "ValueError, the filter bank should have one filter per frequency window."
+    
+    filtered = bank.filter(ntr)
+    for iwin, (lowcut, highcut) in enumerate(target_frequency_window):
+        reference = normalisation.butter_bandpass_filter(ntr, lowcut, highcut, samp_freq)
+        assert np.allclose(filtered[iwin], reference), "ValueError, the filter bank output is not correct."
+    
+    #the same windows and sampling frequency reuse the cached filter bank
+    normalisation.freq_time_normalisation(target_frequency_window, samp_freq, ntr)
+    normalisation.freq_time_normalise_sum(target_frequency_window, samp_freq, ntr)
+    assert normalisation.get_filter_bank(target_frequency_window, samp_freq) is bank, "ValueError, the filter bank is not reused."
+    cache_info = normalisation.filter_bank_cache_info()
+    assert cache_info.misses == 1 and cache_info.hits == 3, "ValueError, the cache counters are not correct."
+    
+    with pytest.raises(ValueError):
+        normalisation.get_filter_bank([], samp_freq)
+
+
+def test_freq_time_normalise_batch():
+    '''This function tests
+    
+       1) the accuracy of the multi-station batch against normalising each station on its own
+       2) whether the outputs keep the order of the input traces when several channel groups are mixed
+       3) if the exception is raised for an empty list of traces
+       
+       ASSERTION: 
+       If 1) or 2) false: the batch does not reproduce freq_time_normalise_sum for each station.
+       If 3) false: Value error is not successfully raised.
+    '''
+    #test case: synthetic noise on two types of instrument
+    rng = np.random.default_rng(42)
+    freqmin = 0.02
+    freqmax = 0.07
+    traces = []
+    for chan in ['BHZ', 'HHZ', 'BHZ', 'BHZ']:
+        traces.append(obspy.Trace(rng.standard_normal(3000), header={'channel':chan, 'sampling_rate':1.0}))
+    
+    for method in ['iir', 'fft']:
+        output1 = normalisation.freq_time_normalise_batch(traces, freqmin, freqmax, method=method)
+        assert len(output1) == len(traces), "ValueError, there should be one output per trace."
+        for tr, sum_FTN in zip(traces, output1):
+            target_frequency_window = normalisation.target_frequency_window(tr.stats.channel, freqmin, freqmax)
+            reference = normalisation.freq_time_normalise_sum(target_frequency_window, 1.0, tr.data, method=method)
+            assert np.allclose(sum_FTN, reference, atol=1e-4), "ValueError, the batch output is not correct."
+    
+    with pytest.raises(ValueError):
+        normalisation.freq_time_normalise_batch([], freqmin, freqmax)
+
+
+def test_freq_time_normalise_sum_chunked():
+    '''This function tests
+    
+       1) whether filtering chunk by chunk with the carried filter state reproduces filtering the whole record
+       2) the accuracy of the chunked normalisation against the monolithic one away from the record ends
+       
+       ASSERTION: 
+       If 1) false: the filter state is not carried across chunk boundaries.
+       If 2) false: the chunked output does not match the monolithic output.
+    '''
+    #test case: two "days" of synthetic noise at 1 Hz
+    rng = np.random.default_rng(42)
+    ntr = rng.standard_normal(20000)
+    samp_freq = 1
+    target_frequency_window = normalisation.target_frequency_window('BHZ', 0.02, 0.07)
+    bank = normalisation.get_filter_bank(target_frequency_window, samp_freq)
+    
+    zi = bank.initial_state()
+    filtered = np.concatenate([bank.filter(ntr[i:i+3000], zi=zi) for i in range(0, len(ntr), 3000)], axis=1)
+    assert np.allclose(filtered, bank.filter(ntr)), "ValueError, the chunked filtering is not correct."
+    
+    reference = normalisation.freq_time_normalise_sum(target_frequency_window, samp_freq, ntr)
+    output1 = normalisation.freq_time_normalise_sum_chunked(target_frequency_window, samp_freq, ntr, chunk_npts=3000)
+    assert output1.shape == reference.shape, "ValueError, the output shape is not correct."
+    
+    #away from the record ends
+    interior = slice(2000, -2000)
+    rms = np.sqrt(np.mean((output1[interior]-reference[interior])**2))
+    assert rms < 0.01*np.std(reference[interior]), "ValueError, the chunked output does not match the monolithic output."
+
+
+def test_normalisation_float32():
+    '''This function tests
+    
+       1) whether the single precision path keeps float32 (complex64) arrays
+       2) the precision of the single precision path against the double precision path
+       
+       ASSERTION: 
+       If 1) false: Type error: the outputs should be float32/complex64 arrays.
+       If 2) false: the single precision output is not accurate enough.
+    '''
+    #test case: synthetic noise
+    rng = np.random.default_rng(42)
+    ntr = rng.standard_normal(4000)
+    samp_freq = 1
+    target_frequency_window = normalisation.target_frequency_window('BHZ', 0.02, 0.07)
+    
+    assert normalisation.butter_bandpass_filter(ntr, 0.02, 0.03, samp_freq, dtype=np.float32).dtype == np.float32, "TypeError"
+    assert normalisation.analytic_filtering_fft(target_frequency_window, samp_freq, ntr, dtype=np.float32).dtype == np.complex64, "TypeError"
+    
+    for method in ['iir', 'fft']:
+        output1 = normalisation.freq_time_normalisation(target_frequency_window, samp_freq, ntr, method=method, dtype=np.float32)
+        assert output1.dtype == np.float32, "TypeError, the output should be a float32 array."
+        reference = normalisation.freq_time_normalisation(target_frequency_window, samp_freq, ntr, method=method)
+        assert np.allclose(output1[:, 100:], reference[:, 100:], atol=1e-3), "ValueError, the float32 output is not accurate enough."
+        
+        output2 = normalisation.freq_time_normalise_sum(target_frequency_window, samp_freq, ntr, method=method, dtype=np.float32)
+        assert np.allclose(output2[100:], np.sum(reference, axis=0)[100:], atol=1e-3), "ValueError, the float32 output is not accurate enough."
+
+
+
+class FakeClient:
+    '''A stand-in for obspy Client that returns one hour of synthetic 1 Hz noise for any station, so that the 
+       pipeline can be tested offline.'''
+    
+    station_requests = 0
+    waveform_requests = 0
+    
+    @staticmethod
+    def _inventory(network, station, channel):
+        #one channel epoch over 2021
+        cha = Channel(code=channel, location_code='', latitude=0, longitude=0, elevation=0, depth=0, 
+                      start_date=obspy.UTCDateTime(2021, 1, 1), end_date=obspy.UTCDateTime(2022, 1, 1))
+        sta = Station(code=station, latitude=0, longitude=0, elevation=0, channels=[cha])
+        return obspy.Inventory(networks=[Network(code=network, stations=[sta])], source='synthetic')
+    
+    def get_stations(self, network, station, location, starttime, endtime, level, channel='BHZ'):
+        self.station_requests += 1
+        return self._inventory(network, station, channel)
+    
+    def get_waveforms(self, network, station, channel, location, starttime, endtime):
+        self.waveform_requests += 1
+        rng = np.random.default_rng(sum(map(ord, station)))
+        npts = int(endtime-starttime)+1
+        header = {'network':network, 'station':station, 'channel':channel, 'sampling_rate':1.0, 'starttime':starttime}
+        return obspy.Stream([obspy.Trace(rng.standard_normal(npts), header=header)])
+    
+    def get_stations_bulk(self, bulk, level):
+        self.station_requests += 1
+        inv = obspy.Inventory(networks=[], source='synthetic')
+        for network, station, location, channel, starttime, endtime in bulk:
+            inv += self._inventory(network, station, channel)
+        return inv
+    
+    def get_waveforms_bulk(self, bulk):
+        st = obspy.Stream()
+        for network, station, location, channel, starttime, endtime in bulk:
+            st += self.get_waveforms(network, station, channel, location, starttime, endtime)
+        return st
+
+
+class FlakyClient(FakeClient):
+    '''A FakeClient whose every first request fails, to test retries.'''
+    
+    def __init__(self):
+        self.calls = 0
+    
+    def get_waveforms(self, *args, **kwargs):
+        self.calls += 1
+        if self.calls == 1:
+            raise ConnectionError('synthetic network failure')
+        return FakeClient.get_waveforms(self, *args, **kwargs)
+
+
+class ResponseClient(FakeClient):
+    '''A FakeClient whose inventories have an instrument response, to test the response removal.'''
+    
+    @staticmethod
+    def _inventory(network, station, channel):
+        from obspy.core.inventory.response import Response
+        inv = FakeClient._inventory(network, station, channel)
+        cha = inv[0][0][0]
+        cha.sample_rate = 1.0
+        cha.response = Response.from_paz(zeros=[0j, 0j], poles=[-0.037+0.037j, -0.037-0.037j, -251+0j], stage_gain=1500., 
+                                         input_units='M/S', output_units='COUNTS')
+        return inv
+
+
+class NoDataClient(FakeClient):
+    '''A FakeClient without data for station LHI, which raises FDSNNoDataException like a data centre.'''
+    
+    def get_waveforms(self, network, station, channel, location, starttime, endtime):
+        if station == 'LHI':
+            raise FDSNNoDataException('No data available for request.')
+        return FakeClient.get_waveforms(self, network, station, channel, location, starttime, endtime)
+    
+    def get_waveforms_bulk(self, bulk):
+        #the missing stations are left out, and no data at all is an exception
+        st = FakeClient.get_waveforms_bulk(self, [item for item in bulk if item[1] != 'LHI'])
+        if len(st) == 0:
+            raise FDSNNoDataException('No data available for request.')
+        return st
+
+
+def test_run_pipeline(tmp_path):
+    '''This function tests
+    
+       1) the output of the task list
+       2) whether the serial and the parallel runs write the same normalised waveforms
+       3) if the exception is raised for an unknown backend
+       4) whether the normalised waveforms are appended to the HDF5 store
+       
+       ASSERTION: 
+       If 1) false: there should be one task per station and time chunk.
+       If 2) false: the parallel pipeline does not reproduce the serial pipeline.
+       If 3) false: Value error is not successfully raised.
+       If 4) false: the store does not hold one row per task.
+    '''
+    all_chunk = ['2021_11_01_11_00_00', '2021_11_01_12_00_00', '2021_11_01_13_00_00']
+    tasks = pipeline.get_task_list(all_chunk, ['NZ', 'AU'], ['QRZ', 'LHI'], ['*', '*'], ['BHZ', 'BHZ'])
+    assert len(tasks) == 4, "ValueError, there should be one task per station and time chunk."
+    
+    prepro_para = {'rm_resp':'no', 'respdir':None, 'freqmin':0.005, 'freqmax':0.1, 'samp_freq':1}
+    serial = tmp_path/'serial'
+    parallel = tmp_path/'parallel'
+    serial.mkdir()
+    parallel.mkdir()
+    output1 = pipeline.run_pipeline(tasks, FakeClient(), prepro_para, str(serial))
+    output2 = pipeline.run_pipeline(tasks, FakeClient(), prepro_para, str(parallel), workers=2)
+    
+    assert len(output1) == len(tasks), "ValueError, there should be one result per task."
+    for ff1, ff2 in zip(output1, output2):
+        assert ff1 is not None and ff2 is not None, "ValueError, a task failed."
+        assert os.path.basename(ff1) == os.path.basename(ff2), "ValueError, the results are not in task order."
+        assert np.allclose(obspy.read(ff1)[0].data, obspy.read(ff2)[0].data), "ValueError, the parallel output is not correct."
+    
+    with pytest.raises(ValueError):
+        pipeline.run_pipeline(tasks, FakeClient(), prepro_para, str(serial), backend='threads')
+    
+    ff = str(tmp_path/'FTN.h5')
+    pipeline.run_pipeline(tasks, FakeClient(), prepro_para, str(parallel), workers=2, store=ff)
+    with store.FTNStore(ff, mode='r') as ftn_store:
+        assert len(ftn_store.ids()) == 2, "ValueError, there should be one group per channel."
+        for ff1 in output1:
+            tr = obspy.read(ff1)[0]
+            assert np.allclose(ftn_store.get(tr.id, tr.stats.starttime).data, tr.data), "ValueError, the stored waveform is not correct."
+
+
+
+def test_download_concurrent(tmp_path):
+    '''This function tests
+    
+       1) whether the concurrent download returns the same waveforms in the same order as download, 
+          with and without the bulk requests
+       2) whether a failed request is retried
+       3) whether a station without data is skipped
+       
+       ASSERTION: 
+       If 1) false: the concurrent download does not reproduce download.
+       If 2) false: the failed request is not retried.
+       If 3) false: the missing data aborts the download or the station is not skipped.
+    '''
+    all_chunk = ['2021_11_01_11_00_00', '2021_11_01_12_00_00', '2021_11_01_13_00_00']
+    nsta = 2
+    net = ['NZ', 'AU']
+    sta = ['QRZ', 'LHI']
+    location = ['*', '*']
+    chan = ['HHZ', 'BHZ']
+    direc = str(tmp_path)
+    
+    tr_list, inv_list, date_info = download_raw_data.download(all_chunk, nsta, net, sta, location, direc, chan, FakeClient(), 1)
+    for bulk in [True, False]:
+        output1 = download_raw_data.download_concurrent(all_chunk, nsta, net, sta, location, direc, chan, FakeClient(), 1, 
+                                                        max_workers=3, bulk=bulk)
+        assert len(output1[0]) == len(tr_list) and len(output1[1]) == len(inv_list), "ValueError, the output length is not correct."
+        for st1, st2 in zip(output1[0], tr_list):
+            assert st1[0].id == st2[0].id and st1[0].stats.starttime == st2[0].stats.starttime, "ValueError, the order is not correct."
+            assert np.allclose(st1[0].data, st2[0].data), "ValueError, the waveform is not correct."
+        assert output1[2] == date_info, "ValueError, the date_info is not correct."
+    
+    client = FlakyClient()
+    output2 = download_raw_data.download_concurrent(all_chunk, nsta, net, sta, location, direc, chan, client, 1, 
+                                                    max_workers=1, backoff=0, bulk=False, resume=False)
+    assert len(output2[0]) == len(tr_list), "ValueError, the failed request is not retried."
+    assert client.calls == len(tr_list)+1, "ValueError, the failed request is not retried."
+    
+    #a station without data is skipped, and a chunk without data for any station does not raise FDSNNoDataException
+    for bulk in [True, False]:
+        output3 = download_raw_data.download_concurrent(all_chunk, nsta, net, sta, location, direc, chan, NoDataClient(), 1, 
+                                                        backoff=0, bulk=bulk, resume=False)
+        assert [st[0].stats.station for st in output3[0]] == ['QRZ', 'QRZ'], "ValueError, the station without data is not skipped."
+        assert all(len(inv.select(station='QRZ')) == 1 for inv in output3[1]), "ValueError, the inventory is not correct."
+        with pytest.raises(ValueError):
+            download_raw_data.download_concurrent(all_chunk, 1, net[1:], sta[1:], location[1:], direc, chan[1:], NoDataClient(), 1, 
+                                                  backoff=0, bulk=bulk, resume=False)
+
+
+
+def test_inventory_cache(tmp_path):
+    '''This function tests
+    
+       1) whether the inventory of a station is downloaded once and reused for the chunks its epoch covers
+       2) whether the cached StationXML files are reused by a new cache on the same folder
+       3) whether an inventory is downloaded again for a chunk outside the cached epoch
+       
+       ASSERTION: 
+       If 1), 2) or 3) false: the hit/miss counters or the number of requests are not correct.
+    '''
+    all_chunk = ['2021_11_01_11_00_00', '2021_11_01_12_00_00', '2021_11_01_13_00_00', '2021_11_01_14_00_00']
+    nsta = 2
+    net = ['NZ', 'AU']
+    sta = ['QRZ', 'LHI']
+    location = ['*', '*']
+    chan = ['HHZ', 'BHZ']
+    direc = str(tmp_path)
+    
+    client = FakeClient()
+    inv_cache = download_raw_data.InventoryCache(direc)
+    tr_list, inv_list, date_info = download_raw_data.download(all_chunk, nsta, net, sta, location, direc, chan, client, 1, 
+                                                              inv_cache=inv_cache)
+    assert len(inv_list) == len(tr_list), "ValueError, there should be one inventory per waveform."
+    assert client.station_requests == nsta, "ValueError, the inventory should be downloaded once per station."
+    assert (inv_cache.hits, inv_cache.misses) == (4, 2), "ValueError, the cache counters are not correct."
+    
+    #a new cache reads the StationXML files
+    client = FakeClient()
+    inv_cache = download_raw_data.InventoryCache(direc)
+    download_raw_data.download_concurrent(all_chunk, nsta, net, sta, location, direc, chan, client, 1, inv_cache=inv_cache)
+    assert client.station_requests == 0, "ValueError, the cached StationXML files are not reused."
+    
+    #outside of the cached epoch
+    inv = inv_cache.get(client, 'NZ', 'QRZ', '*', 'HHZ', obspy.UTCDateTime(2022, 3, 1), obspy.UTCDateTime(2022, 3, 2))
+    assert client.station_requests == 1, "ValueError, the inventory should be downloaded outside of the cached epoch."
+    assert len(inv.get_contents()['channels']) == 2, "ValueError, the new epoch should be merged into the cache."
+
+
+
+def test_download_resume(tmp_path):
+    '''This function tests
+    
+       1) whether a rerun of download and download_concurrent reads the completed chunks and their inventories 
+          from disk without any request and returns the same waveforms
+       2) whether a missing or corrupted file is downloaded again
+       
+       ASSERTION: 
+       If 1) false: the manifest is not used or the waveforms read from disk are not correct.
+       If 2) false: the missing or corrupted file is not detected.
+    '''
+    all_chunk = ['2021_11_01_11_00_00', '2021_11_01_12_00_00', '2021_11_01_13_00_00']
+    nsta = 2
+    net = ['NZ', 'AU']
+    sta = ['QRZ', 'LHI']
+    location = ['*', '*']
+    chan = ['HHZ', 'BHZ']
+    direc = str(tmp_path)
+    
+    client = FakeClient()
+    tr_list, inv_list, date_info = download_raw_data.download(all_chunk, nsta, net, sta, location, direc, chan, client, 1)
+    assert client.waveform_requests == 4, "ValueError, every chunk should be downloaded once."
+    assert len(download_raw_data.load_manifest(direc)) == 4, "ValueError, every chunk should be in the manifest."
+    
+    client = FakeClient()
+    output0 = download_raw_data.download(all_chunk, nsta, net, sta, location, direc, chan, client, 1)
+    assert client.waveform_requests == 0 and client.station_requests == 0, "ValueError, the completed chunks are downloaded again."
+    assert [inv.get_contents()['channels'] for inv in output0[1]] == [inv.get_contents()['channels'] for inv in inv_list], "ValueError, the inventory is not correct."
+    for bulk in [True, False]:
+        client = FakeClient()
+        output1 = download_raw_data.download_concurrent(all_chunk, nsta, net, sta, location, direc, chan, client, 1, bulk=bulk)
+        assert client.waveform_requests == 0 and client.station_requests == 0, "ValueError, the completed chunks are downloaded again."
+        for st1, st2 in zip(output1[0], tr_list):
+            assert st1[0].id == st2[0].id and np.allclose(st1[0].data, st2[0].data), "ValueError, the waveform is not correct."
+    
+    #remove one file and corrupt another one
+    os.remove(os.path.join(direc, '2021_11_01_11_00_00T2021_11_01_12_00_00.QRZ.HHZ.sac'))
+    with open(os.path.join(direc, '2021_11_01_12_00_00T2021_11_01_13_00_00.LHI.BHZ.sac'), 'r+b') as fp:
+        fp.seek(1000)
+        fp.write(b'xxxx')
+    client = FakeClient()
+    output2 = download_raw_data.download(all_chunk, nsta, net, sta, location, direc, chan, client, 1)
+    assert client.waveform_requests == 2 and client.station_requests == 2, "ValueError, the missing and corrupted files are not downloaded again."
+    assert len(output2[0]) == len(tr_list), "ValueError, the output length is not correct."
+
+
+
+def test_waveform_archive(tmp_path):
+    '''This function tests
+    
+       1) whether the SAC files written by download are indexed, looked up like a scan of the index and read back for 
+          a window across two files
+       2) whether load reproduces the output of download
+       3) whether the same window is read from an SDS tree and from an ASDF file
+       
+       ASSERTION: 
+       If 1), 2) or 3) false: the waveform read from the archive is not correct.
+    '''
+    all_chunk = ['2021_11_01_11_00_00', '2021_11_01_12_00_00', '2021_11_01_13_00_00']
+    nsta = 2
+    net = ['NZ', 'AU']
+    sta = ['QRZ', 'LHI']
+    location = ['', '']
+    chan = ['HHZ', 'BHZ']
+    direc = str(tmp_path)
+    
+    client = FakeClient()
+    tr_list, inv_list, date_info = download_raw_data.download(all_chunk, nsta, net, sta, location, direc, chan, client, 1)
+    
+    arch = archive.WaveformArchive(direc)
+    assert len(arch) == 4, "ValueError, every SAC file should be indexed."
+    
+    #window across the two files
+    t1 = obspy.UTCDateTime(2021, 11, 1, 11, 30)
+    t2 = obspy.UTCDateTime(2021, 11, 1, 12, 30)
+    st = arch.get_waveforms('NZ', 'QRZ', '*', 'HHZ', t1, t2)
+    ref = np.concatenate([tr_list[0][0].data[1800:], tr_list[2][0].data[1:1801]])
+    assert len(st) == 1 and st[0].stats.starttime == t1 and st[0].stats.endtime == t2, "ValueError, the window is not correct."
+    assert np.allclose(st[0].data, ref), "ValueError, the waveform is not correct."
+    
+    #the indexed lookup finds the same files as a scan of the whole index
+    for codes in [('NZ', 'QRZ', '', 'HHZ'), ('*', '*', '*', '*'), ('AU', 'L?I', '*', 'BHZ'), ('NZ', 'QRZ', '', 'BHZ')]:
+        for window in [(t1, t2), (t1-7200, t1-3700), (t2, t2), (t2+3600, t2+7200)]:
+            scan = [entry for entry in arch.index if all(fnmatch.fnmatch(entry[key], code) for key, code in zip(['net', 'sta', 'location', 'chan'], codes))
+                    and entry['endtime'] >= window[0] and entry['starttime'] <= window[1]]
+            assert arch.select(*codes, *window) == sorted(scan, key=lambda entry: entry['starttime']), "ValueError, the selected files are not correct."
+    
+    output = arch.load(all_chunk, nsta, net, sta, location, chan)
+    assert len(output[0]) == len(tr_list) and output[2] == date_info, "ValueError, the output is not correct."
+    for st1, st2 in zip(output[0], tr_list):
+        assert st1[0].id == st2[0].id and np.allclose(st1[0].data[1:3600], st2[0].data[1:3600]), "ValueError, the waveform is not correct."
+    
+    #SDS tree of day files
+    sds = os.path.join(direc, 'sds')
+    st_day = arch.get_waveforms('NZ', 'QRZ', '', 'HHZ', obspy.UTCDateTime(2021, 11, 1), obspy.UTCDateTime(2021, 11, 2))
+    folder = os.path.join(sds, '2021', 'NZ', 'QRZ', 'HHZ.D')
+    os.makedirs(folder)
+    st_day.write(os.path.join(folder, 'NZ.QRZ..HHZ.D.2021.305'), format='MSEED')
+    st = archive.WaveformArchive(sds, format='SDS').get_waveforms('NZ', 'QRZ', '', 'HHZ', t1, t2)
+    assert np.allclose(st[0].data, ref), "ValueError, the SDS waveform is not correct."
+    
+    #ASDF file with the inventory
+    ff = os.path.join(direc, 'archive.h5')
+    with pyasdf.ASDFDataSet(ff, mode='w') as ds:
+        ds.add_waveforms(st_day, tag='raw')
+        ds.add_stationxml(client.get_stations('NZ', 'QRZ', '', t1, t2, 'response', channel='HHZ'))
+    arch = archive.WaveformArchive(ff, format='ASDF')
+    st = arch.get_waveforms('NZ', 'QRZ', '', 'HHZ', t1, t2)
+    assert np.allclose(st[0].data, ref), "ValueError, the ASDF waveform is not correct."
+    assert arch.get_stations('NZ', 'QRZ', '', t1, t2)[0].code == 'NZ', "ValueError, the ASDF inventory is not correct."
+
+
+
+def test_ftn_store(tmp_path):
+    '''This function tests
+    
+       1) whether the station-days are appended and read back with the per-window normalised waveforms
+       2) whether a station-day written again replaces its row instead of adding one
+       3) whether the station-days of one time are read into one array
+       4) if the exception is raised for a missing station-day, a different length or a different number of windows,
+          and for channels of different lengths read into one array
+       5) whether the chunks of a long station-day are capped along the time axis
+       
+       ASSERTION: 
+       If 1), 2) or 3) false: the waveforms read from the store are not correct.
+       If 4) false: Value error is not successfully raised.
+       If 5) false: the chunks of the store are not correct.
+    '''
+    ff = str(tmp_path/'FTN.h5')
+    rng = np.random.default_rng(0)
+    t0 = obspy.UTCDateTime(2021, 11, 1)
+    target_freq_window = [(0.01, 0.02), (0.02, 0.04), (0.04, 0.08)]
+    
+    traces = []
+    with store.FTNStore(ff) as ftn_store:
+        for iday in range(3):
+            for station in ['QRZ', 'LHI']:
+                header = {'network':'NZ', 'station':station, 'channel':'BHZ', 'sampling_rate':1.0, 'starttime':t0+iday*86400}
+                tr = obspy.Trace(rng.standard_normal(3600).astype(np.float32), header=header)
+                windows = rng.standard_normal((3, 3600))
+                ftn_store.append(tr, windows=windows, target_frequency_window=target_freq_window)
+                traces.append((tr, windows))
+        irow = ftn_store.append(traces[0][0], windows=traces[0][1])
+        assert irow == 0, "ValueError, the station-day should replace its row."
+    
+    with store.FTNStore(ff, mode='r') as ftn_store:
+        assert ftn_store.ids() == ['NZ.LHI..BHZ', 'NZ.QRZ..BHZ'], "ValueError, the channels are not correct."
+        assert len(ftn_store.starttimes('NZ.QRZ..BHZ')) == 3, "ValueError, there should be one row per day."
+        for tr, windows in traces:
+            tr2, win2 = ftn_store.get(tr.id, tr.stats.starttime, windows=True)
+            assert tr2.id == tr.id and np.allclose(tr2.data, tr.data), "ValueError, the waveform is not correct."
+            assert np.allclose(win2, windows.astype(np.float32)), "ValueError, the window waveforms are not correct."
+        
+        ids, data = ftn_store.read(t0+86400)
+        assert ids == ['NZ.LHI..BHZ', 'NZ.QRZ..BHZ'] and data.shape == (2, 3600), "ValueError, the array is not correct."
+        assert np.allclose(data[1], traces[2][0].data), "ValueError, the array is not correct."
+        
+        with pytest.raises(ValueError):
+            ftn_store.get('NZ.QRZ..BHZ', t0+10*86400)
+    
+    with store.FTNStore(ff) as ftn_store:
+        with pytest.raises(ValueError):
+            ftn_store.append(traces[0][0].slice(t0, t0+100))
+        with pytest.raises(ValueError, match='frequency windows'):
+            ftn_store.append(traces[0][0], windows=rng.standard_normal((4, 3600)))
+        with pytest.raises(ValueError, match='shape'):
+            ftn_store.append(traces[0][0], windows=rng.standard_normal((3, 3000)))
+        ftn_store.append(obspy.Trace(np.zeros(3000, dtype=np.float32), header={'network':'AU', 'station':'LHI', 'channel':'BHZ', 'starttime':t0}))
+        with pytest.raises(ValueError, match='different lengths'):
+            ftn_store.read(t0)
+        
+        long = obspy.Trace(np.zeros(store.CHUNK_NPTS+10, dtype=np.float32), header={'network':'AU', 'station':'MTN', 'channel':'HHZ', 'starttime':t0})
+        ftn_store.append(long, windows=np.zeros((2, long.stats.npts)))
+        assert ftn_store.file[long.id]['data'].chunks == (1, store.CHUNK_NPTS), "ValueError, the chunks are not capped."
+        assert ftn_store.file[long.id]['windows'].chunks == (1, 1, store.CHUNK_NPTS), "ValueError, the chunks are not capped."
+        assert np.allclose(ftn_store.get(long.id, t0).data, long.data), "ValueError, the waveform is not correct."
+
+
+
+def test_correlation():
+    '''This function tests
+    
+       1) whether the correlation of every pair matches the direct time-domain correlation
+       2) whether the lag of a delayed copy of a waveform is found at the delay
+       3) whether the segment-averaged correlation matches the average of the correlations of the segments
+       4) if the exception is raised for traces of different length and for a lag longer than the segments
+       
+       ASSERTION: 
+       If 1), 2) or 3) false: the correlation functions are not correct.
+       If 4) false: Value error is not successfully raised.
+    '''
+    rng = np.random.default_rng(0)
+    samp_freq = 1.0
+    data = rng.standard_normal((4, 1000))
+    #station 3 records station 0 with a delay of 25 samples
+    data[3, 25:] = data[0, :-25]
+    maxlag = 100
+    
+    pairs, lags, ccf = correlation.correlate(data, maxlag, samp_freq=samp_freq)
+    assert len(pairs) == 6 and ccf.shape == (6, 201) and lags[0] == -100 and lags[-1] == 100, "ValueError, the output shape is not correct."
+    for (i, j), cc in zip(pairs, ccf):
+        ref = scipy.signal.correlate(data[j], data[i], mode='full')[999-maxlag:999+maxlag+1]
+        assert np.allclose(cc, ref), "ValueError, the correlation is not correct."
+    assert lags[np.argmax(ccf[pairs.index((0, 3))])] == 25, "ValueError, the delay is not found."
+    
+    #segments of 200 s with 50% overlap, and traces in single precision
+    traces = [obspy.Trace(d.astype(np.float32), header={'station':'S%d' % i, 'sampling_rate':samp_freq}) for i, d in enumerate(data)]
+    pairs, lags, ccf = correlation.correlate(traces, 50, cc_len=200, step=100, auto=True, block_size=3)
+    assert len(pairs) == 10 and ccf.dtype == np.float32, "ValueError, the output is not correct."
+    for (i, j), cc in zip(pairs, ccf):
+        ref = np.mean([scipy.signal.correlate(data[j, k:k+200], data[i, k:k+200], mode='full')[149:250] for k in range(0, 801, 100)], axis=0)
+        assert np.allclose(cc, ref, atol=1e-3), "ValueError, the segment-averaged correlation is not correct."
+    
+    with pytest.raises(ValueError):
+        correlation.correlate([traces[0], traces[1].slice(traces[1].stats.starttime, traces[1].stats.starttime+100)], 50)
+    with pytest.raises(ValueError):
+        correlation.correlate(data, 500, samp_freq=samp_freq, cc_len=200)
+
+
+
+def test_stacking(tmp_path):
+    '''This function tests
+    
+       1) whether the stack extended one day at a time through the checkpoint matches the linear and phase-weighted
+          stacks of all days at once
+       2) whether a day added again is skipped
+       3) if the exception is raised for correlation functions of a different shape, or lags or stacking options
+          that do not match the checkpoint
+       
+       ASSERTION: 
+       If 1) false: the stacks are not correct.
+       If 2) false: the day is counted twice.
+       If 3) false: Value error is not successfully raised.
+    '''
+    rng = np.random.default_rng(0)
+    pairs = [(0, 1), (0, 2), (1, 2)]
+    lags = np.arange(-50, 51)
+    days = ['2021_11_0%d' % iday for iday in range(1, 6)]
+    ccfs = rng.standard_normal((5, 3, 101))
+    ff = str(tmp_path/'stack.npz')
+    
+    for day, ccf in zip(days, ccfs):
+        stack = stacking.stack_day(ff, ccf, pairs, lags, day, pws=True)
+    stack = stacking.stack_day(ff, ccfs[0], pairs, lags, days[0], pws=True)
+    assert stack.count == 5 and stack.days == days, "ValueError, the day is counted twice."
+    with pytest.raises(ValueError):
+        stacking.stack_day(ff, ccfs[0], pairs, lags, '2021_11_06')
+    with pytest.raises(ValueError):
+        stacking.stack_day(ff, ccfs[0], pairs, lags, '2021_11_06', pws=True, power=3)
+    with pytest.raises(ValueError, match='lags'):
+        stacking.stack_day(ff, ccfs[0], pairs, lags*0.5, '2021_11_06', pws=True)
+    with pytest.raises(ValueError, match='lags'):
+        stacking.stack_day(ff, ccfs[0][:, :-1], pairs, lags[:-1], '2021_11_06', pws=True)
+    
+    stack = stacking.CorrelationStack.load(ff)
+    phase = scipy.signal.hilbert(ccfs, axis=-1)
+    phase = np.abs(np.mean(phase/np.abs(phase), axis=0))**2
+    assert np.allclose(stack.linear(), ccfs.mean(axis=0)), "ValueError, the linear stack is not correct."
+    assert np.allclose(stack.phase_weighted(), ccfs.mean(axis=0)*phase), "ValueError, the phase-weighted stack is not correct."
+    
+    with pytest.raises(ValueError):
+        stack.add(ccfs[0, :2])
+    with pytest.raises(ValueError):
+        stacking.CorrelationStack(pairs, lags).phase_weighted()
+
+
+
+def test_gap_report():
+    '''This function tests
+    
+       1) whether a stream of more than 100 fragments is kept
+       2) whether the gaps, overlaps, traces of a different sampling rate and short traces are found
+       3) whether check_sample_gaps removes the traces of a different sampling rate and the short traces only
+       4) if the exception is raised for a stream with big gaps
+       
+       ASSERTION: 
+       If 1) or 3) false: the output stream is not correct.
+       If 2) false: the gap report is not correct.
+       If 4) false: Value error is not successfully raised.
+    '''
+    t0 = obspy.UTCDateTime(2021, 11, 1)
+    date_info = {'starttime':t0, 'endtime':t0+20000}
+    #200 contiguous fragments of 100 s at 1 Hz
+    st = obspy.Stream([obspy.Trace(np.zeros(100), header={'sampling_rate':1.0, 'starttime':t0+100*i}) for i in range(200)])
+    #a gap of 50 s, an overlap of 20 s, a trace at 2 Hz and a short trace
+    for tr in st[100:]:
+        tr.stats.starttime += 50
+    for tr in st[150:]:
+        tr.stats.starttime -= 20
+    st.append(obspy.Trace(np.zeros(100), header={'sampling_rate':2.0, 'starttime':t0}))
+    st.append(obspy.Trace(np.zeros(5), header={'sampling_rate':1.0, 'starttime':t0+5}))
+    
+    report = processing.gap_report(st, date_info)
+    assert report['ntraces'] == 202 and report['sampling_rate'] == 2, "ValueError, the report is not correct."
+    assert len(report['gaps']) == 1 and report['gaps'][0]['duration'] == 50, "ValueError, the gap is not found."
+    assert report['gaps'][0]['starttime'] == (t0+10000).timestamp, "ValueError, the gap is not found."
+    assert report['rate_mismatch'].sum() == 201 and np.flatnonzero(report['short']).tolist() == [201], "ValueError, the screening is not correct."
+    report = processing.gap_report(st[:200], date_info)
+    assert np.isclose(report['gap_fraction'], 50/20000) and np.isclose(report['overlap_fraction'], 20/20000), "ValueError, the fractions are not correct."
+    
+    #without the 2 Hz trace, only the short trace is removed
+    st.remove(st[200])
+    output1, report = processing.check_sample_gaps(st, date_info, return_report=True)
+    assert len(output1) == 200 and not report['rate_mismatch'].any(), "ValueError, the output stream is not correct."
+    assert type(processing.portion_gaps(st, date_info)) == float, "TypeError, output of portion_gaps should be a float number."
+    
+    with pytest.raises(ValueError):
+        processing.check_sample_gaps(st[:10]+st[190:], date_info)
+
+
+
+def test_clean_trace():
+    '''This function tests
+    
+       1) whether the fused cleanup kernel matches the nan/inf removal, detrend and obspy taper it replaces, also 
+          below 1 Hz
+       2) whether preprocess_raw cleans and tapers a stream of several fragments
+       
+       ASSERTION: 
+       If 1) false: the cleaned trace is not correct.
+       If 2) false: the pre-processed trace is not correct.
+    '''
+    rng = np.random.default_rng(0)
+    data = (rng.standard_normal(5000)+np.linspace(0, 10, 5000)+3).astype(np.float32)
+    data[[10, 2000]] = np.nan
+    data[3000] = np.inf
+    
+    #including sampling rates below 1 Hz, where the taper is shorter than max_length seconds
+    for samp_freq in [10.0, 1.0, 0.5, 0.1]:
+        tr = obspy.Trace(data.copy(), header={'sampling_rate':samp_freq})
+        tr.data[~np.isfinite(tr.data)] = 0
+        tr.data = np.float32(scipy.signal.detrend(tr.data, type='linear'))
+        tr.taper(max_percentage=0.05, max_length=50)
+        output = data.copy()
+        processing.clean_trace(output, *processing.taper_sides(5000, samp_freq))
+        assert output.dtype == np.float32 and np.allclose(output, tr.data, atol=1e-5), "ValueError, the cleaned trace is not correct."
+    
+    #preprocess_raw tapers a 0.5 Hz channel as well
+    t0 = obspy.UTCDateTime(2021, 11, 1)
+    tr = obspy.Trace(rng.standard_normal(1000), header={'sampling_rate':0.5, 'starttime':t0})
+    prepro_para = {'rm_resp':'no', 'respdir':None, 'freqmin':0.01, 'freqmax':0.1, 'samp_freq':0.5}
+    ntr = processing.preprocess_raw(obspy.Stream([tr.copy()]), None, prepro_para, {'starttime':t0, 'endtime':t0+1998})
+    tr.data = np.float32(scipy.signal.detrend(tr.data, type='linear'))
+    tr.taper(max_percentage=0.05, max_length=50)
+    ref = bandpass(tr.data, 0.009, 0.11, df=0.5, corners=4, zerophase=True)
+    assert np.allclose(ntr.data, ref, atol=1e-4), "ValueError, the 0.5 Hz trace is not tapered."
+    
+    #two fragments with a gap
+    st = obspy.Stream([obspy.Trace(rng.standard_normal(3000)+5, header={'sampling_rate':1.0, 'starttime':t0}), 
+                       obspy.Trace(rng.standard_normal(3000)-5, header={'sampling_rate':1.0, 'starttime':t0+3100})])
+    prepro_para = {'rm_resp':'no', 'respdir':None, 'freqmin':0.01, 'freqmax':0.1, 'samp_freq':1}
+    ntr = processing.preprocess_raw(st.copy(), None, prepro_para, {'starttime':t0, 'endtime':t0+6099})
+    
+    #reference: separate detrend, merge, obspy taper and bandpass
+    for tr in st:
+        tr.data = np.float32(scipy.signal.detrend(tr.data, type='linear'))
+    st.merge(method=1, fill_value=0)
+    st[0].taper(max_percentage=0.05, max_length=50)
+    ref = bandpass(st[0].data, 0.009, 0.11, df=1, corners=4, zerophase=True)
+    assert ntr.stats.npts == 6100 and ntr.data.dtype == np.float32, "ValueError, the pre-processed trace is not correct."
+    assert np.allclose(ntr.data, ref, atol=1e-4), "ValueError, the pre-processed trace is not correct."
+
+
+
+def test_remove_response_cached(tmp_path, monkeypatch):
+    '''This function tests
+    
+       1) whether the cached response removal matches obspy remove_response for an inventory
+       2) whether the operator is computed once for station-days of the same instrument and length, also in the 
+          pipeline with more stations than the cache holds
+       3) whether the cached removal with a SAC pole-zero file matches obspy simulate with SAC tapers
+       4) if the exception is raised for an unknown kind
+       5) whether a RESP file is parsed once for station-days of the same instrument
+       
+       ASSERTION: 
+       If 1) or 3) false: the corrected waveform is not correct.
+       If 2) or 5) false: the cache counters are not correct.
+       If 4) false: Value error is not successfully raised.
+    '''
+    from obspy.core.inventory.response import Response
+    from obspy.io.sac import attach_paz
+    poles = [-0.037+0.037j, -0.037-0.037j, -251+0j]
+    response = Response.from_paz(zeros=[0j, 0j], poles=poles, stage_gain=1500., input_units='M/S', output_units='COUNTS')
+    cha = Channel(code='BHZ', location_code='', latitude=0, longitude=0, elevation=0, depth=0, sample_rate=1.0, 
+                  start_date=obspy.UTCDateTime(2021, 1, 1), response=response)
+    inv = obspy.Inventory(networks=[Network(code='NZ', stations=[Station(code='QRZ', latitude=0, longitude=0, elevation=0, channels=[cha])])], source='synthetic')
+    
+    rng = np.random.default_rng(0)
+    pre_filt = [0.004, 0.005, 0.4, 0.45]
+    processing.clear_response_cache()
+    for iday in range(3):
+        header = {'network':'NZ', 'station':'QRZ', 'channel':'BHZ', 'sampling_rate':1.0, 'starttime':obspy.UTCDateTime(2021, 11, 1+iday)}
+        tr = obspy.Trace(rng.standard_normal(3601), header=header)
+        ref = tr.copy()
+        ref.attach_response(inv)
+        ref.remove_response(output='VEL', pre_filt=pre_filt, water_level=60)
+        processing.remove_response_cached(tr, inv, pre_filt=pre_filt, water_level=60, output='VEL')
+        assert np.allclose(tr.data, ref.data, rtol=1e-10, atol=1e-10*np.abs(ref.data).max()), "ValueError, the corrected waveform is not correct."
+    assert processing.response_cache_info() == (2, 1, 1), "ValueError, the operator should be computed once."
+    
+    #SAC pole-zero file
+    ff = str(tmp_path/'SAC_PZs_NZ_QRZ_BHZ')
+    with open(ff, 'w') as fp:
+        fp.write('ZEROS 2\nPOLES 3\n-0.037 0.037\n-0.037 -0.037\n-251 0\nCONSTANT 3.0e9\n')
+    paz_tr = obspy.Trace()
+    attach_paz(paz_tr, ff)
+    ref = tr.copy()
+    ref.simulate(paz_remove=dict(paz_tr.stats.paz), pre_filt=pre_filt, water_level=600, sacsim=True, pitsasim=False)
+    processing.remove_response_cached(tr, ff, pre_filt=pre_filt, water_level=600, kind='polozeros')
+    assert np.allclose(tr.data, ref.data, rtol=1e-10, atol=1e-10*np.abs(ref.data).max()), "ValueError, the corrected waveform is not correct."
+    
+    with pytest.raises(ValueError):
+        processing.remove_response_cached(tr, inv, kind='paz')
+    
+    #a RESP file is parsed once and its operator computed once
+    ff = str(tmp_path/'RESP.NZ.QRZ..BHZ')
+    open(ff, 'w').close()
+    parsed = []
+    monkeypatch.setattr(obspy, 'read_inventory', lambda *args, **kwargs: parsed.append(args) or inv)
+    processing.clear_response_cache()
+    for iday in range(3):
+        tr = obspy.Trace(rng.standard_normal(3601), header=dict(header, starttime=obspy.UTCDateTime(2021, 11, 1+iday)))
+        processing.remove_response_cached(tr, ff, pre_filt=pre_filt, water_level=60, output='VEL', kind='RESP')
+    assert len(parsed) == 1 and processing.response_cache_info() == (2, 1, 1), "ValueError, the RESP file should be parsed once."
+    monkeypatch.undo()
+    
+    #the pipeline reuses the operator of every station over its station-days, also with more stations than the cache
+    sta = ['S%02d' % ista for ista in range(10)]
+    all_chunk = ['2021_11_01_11_00_00', '2021_11_01_12_00_00', '2021_11_01_13_00_00', '2021_11_01_14_00_00']
+    tasks = pipeline.get_task_list(all_chunk, ['NZ']*len(sta), sta, ['*']*len(sta), ['BHZ']*len(sta))
+    prepro_para = {'rm_resp':'inv', 'respdir':None, 'freqmin':0.005, 'freqmax':0.1, 'samp_freq':1}
+    processing.clear_response_cache()
+    output = pipeline.run_pipeline(tasks, ResponseClient(), prepro_para, str(tmp_path))
+    assert all(ff is not None for ff in output), "ValueError, a task failed."
+    assert processing.response_cache_info()[:2] == (2*len(sta), len(sta)), "ValueError, the operator of a station should be computed once."
+
+
+
+def test_decimate_trace():
+    '''This function tests
+    
+       1) whether an integer decimation factor is split into stages of at most 10
+       2) whether decimation keeps a signal below the new Nyquist frequency and removes a signal above it
+       3) whether preprocess_raw returns the trace at samp_freq
+       4) whether the normalisation uses the sampling rate of a trace
+       5) whether a trace below samp_freq is kept at its own sampling rate with a warning, also by preprocess_raw
+       
+       ASSERTION: 
+       If 1) false: the stages are not correct.
+       If 2), 3) or 4) false: the resampled or normalised trace is not correct.
+       If 5) false: the trace is changed or the warning is not raised.
+    '''
+    assert processing.decimation_stages(100) == [10, 10] and processing.decimation_stages(40) == [10, 4], "ValueError, the stages are not correct."
+    assert processing.decimation_stages(22) == [11, 2], "ValueError, the stages are not correct."
+    
+    t0 = obspy.UTCDateTime(2021, 11, 1)
+    t = np.arange(360000)/100.
+    signal = np.sin(2*np.pi*0.05*t)
+    tr = obspy.Trace((signal+np.sin(2*np.pi*30*t)).astype(np.float32), header={'sampling_rate':100.0, 'starttime':t0})
+    processing.decimate_trace(tr, 1)
+    assert tr.stats.sampling_rate == 1 and tr.stats.npts == 3600 and tr.data.dtype == np.float32, "ValueError, the resampled trace is not correct."
+    assert np.allclose(tr.data[100:-100], signal[::100][100:-100], atol=1e-3), "ValueError, the resampled trace is not correct."
+    
+    #rational ratio
+    tr = obspy.Trace(signal[:30000].copy(), header={'sampling_rate':100.0, 'starttime':t0})
+    processing.decimate_trace(tr, 40)
+    assert tr.stats.sampling_rate == 40 and tr.stats.npts == 12000, "ValueError, the resampled trace is not correct."
+    
+    prepro_para = {'rm_resp':'no', 'respdir':None, 'freqmin':0.01, 'freqmax':0.1, 'samp_freq':1}
+    st = obspy.Stream([obspy.Trace(np.random.default_rng(0).standard_normal(360000), header={'sampling_rate':100.0, 'starttime':t0})])
+    ntr = processing.preprocess_raw(st, None, prepro_para, {'starttime':t0, 'endtime':t0+3599})
+    assert ntr.stats.sampling_rate == 1 and ntr.stats.npts == 3600, "ValueError, the pre-processed trace is not correct."
+    
+    windows = normalisation.target_frequency_window('BHZ', 0.01, 0.1)
+    output1 = normalisation.freq_time_normalisation(windows, 100, ntr)
+    output2 = normalisation.freq_time_normalisation(windows, 1, ntr.data)
+    assert np.allclose(output1, output2), "ValueError, the sampling rate of the trace is not used."
+    
+    data = tr.data.copy()
+    with pytest.warns(UserWarning):
+        processing.decimate_trace(tr, 100)
+    assert tr.stats.sampling_rate == 40 and np.array_equal(tr.data, data), "ValueError, the trace should not be upsampled."
+    
+    #a 1 Hz LHZ channel with samp_freq=20
+    st = obspy.Stream([obspy.Trace(np.random.default_rng(0).standard_normal(3600), header={'sampling_rate':1.0, 'starttime':t0})])
+    with pytest.warns(UserWarning):
+        ntr = processing.preprocess_raw(st, None, dict(prepro_para, samp_freq=20), {'starttime':t0, 'endtime':t0+3599})
+    assert ntr.stats.sampling_rate == 1 and ntr.stats.npts == 3600, "ValueError, the pre-processed trace is not correct."
+
+
+
+def test_bench_suite(tmp_path):
+    '''This function tests
+    
+       1) whether the synthetic stream has the requested gaps and fragments at a wrong sampling rate
+       2) whether the benchmark suite times every stage and case and writes the results to JSON
+       3) whether a run compared with itself shows no regression
+       
+       ASSERTION: 
+       If 1) false: the synthetic stream is not correct.
+       If 2) or 3) false: the benchmark results are not correct.
+    '''
+    st = bench_FTN.synthetic_stream(10000, 1., ngaps=4, gap_len=10, rate_mismatch=2)
+    t0 = st[0].stats.starttime
+    report = processing.gap_report(st[:5], {'starttime':t0, 'endtime':t0+9999})
+    assert len(st) == 7 and len(report['gaps']) == 4 and np.allclose(report['gaps']['duration'], 10), "ValueError, the gaps are not correct."
+    assert report['rate_mismatch'].sum() == 0 and processing.gap_report(st, {'starttime':t0, 'endtime':t0+9999})['rate_mismatch'].sum() == 2, "ValueError, the fragments are not correct."
+    
+    suite = bench_FTN.run_suite(npts_grid=(2000,), nwin_grid=(2, 4), ngaps=3, repeat=1)
+    assert len(suite['results']) == 6, "ValueError, every stage and case should be timed."
+    for res in suite['results']:
+        assert res['time_s'] > 0 and res['samples_per_s'] > 0 and res['peak_mem_bytes'] >= 0, "ValueError, the results are not correct."
+    
+    ff = str(tmp_path/'bench.json')
+    bench_FTN.save_results(suite, ff)
+    rows = bench_FTN.compare_results(ff, suite)
+    assert len(rows) == 6 and not any(row['regression'] for row in rows), "ValueError, a run should not regress against itself."
+
+
+
+def test_profiling(tmp_path):
+    '''This function tests
+    
+       1) whether the instrumented stages are recorded with the task label when profiling is enabled
+       2) whether nothing is recorded when profiling is disabled
+       3) whether the summary is written to JSON and CSV and the slowest task profiles to .prof files
+       4) whether the records and cProfile profiles of the worker processes of the pipeline are gathered in the 
+          main process
+       5) whether the concurrent download is recorded
+       
+       ASSERTION: 
+       If 1) or 2) false: the records are not correct.
+       If 3) false: the profiling output is not correct.
+       If 4) or 5) false: the records of the pipeline or of the download are not correct.
+    '''
+    ntr = obspy.Trace(np.random.default_rng(0).standard_normal(3600), header={'sampling_rate':1.0})
+    windows = normalisation.target_frequency_window('BHZ', 0.01, 0.1)
+    
+    profiling.reset()
+    normalisation.freq_time_normalise_sum(windows, 100, ntr)
+    assert profiling.records() == [], "ValueError, nothing should be recorded when profiling is disabled."
+    
+    try:
+        profiling.enable(cprofile=True, slowest=1)
+        for label in ['QRZ day 1', 'QRZ day 2']:
+            with profiling.task(label):
+                normalisation.freq_time_normalisation(windows, 100, ntr)
+                normalisation.freq_time_normalise_sum(windows, 100, ntr)
+        records = profiling.records()
+        summary = {row['stage']:row for row in profiling.summary()}
+        
+        ff = str(tmp_path/'profile.json')
+        profiling.write_json(ff)
+        with open(ff) as fp:
+            saved = json.load(fp)
+        profiling.write_csv(str(tmp_path/'profile.csv'))
+        with open(str(tmp_path/'profile.csv')) as fp:
+            rows = fp.read().splitlines()
+        files = profiling.dump_profiles(str(tmp_path))
+    finally:
+        profiling.disable()
+        profiling.reset()
+    
+    assert summary['task']['calls'] == 2 and summary['freq_time_normalise_sum']['calls'] == 2, "ValueError, every call should be recorded."
+    assert summary['freq_time_normalisation']['calls'] == 2 and len(records) == 6, "ValueError, every stage should be recorded once per call."
+    assert set(record['task'] for record in records) == {'QRZ day 1', 'QRZ day 2'}, "ValueError, the records should carry the task label."
+    assert summary['freq_time_normalise_sum']['bytes'] == 2*ntr.data.nbytes, "ValueError, the bytes processed are not correct."
+    assert summary['task']['wall_s'] >= summary['freq_time_normalise_sum']['wall_s']+summary['freq_time_normalisation']['wall_s'], "ValueError, the task should include its stages."
+    
+    assert len(saved['records']) == len(records) and len(saved['summary']) == len(summary), "ValueError, the JSON output is not correct."
+    assert rows[0].startswith('stage,calls') and len(rows) == len(summary)+1, "ValueError, the CSV output is not correct."
+    assert len(files) == 1 and os.path.isfile(files[0]) and pstats.Stats(files[0]).total_calls > 0, "ValueError, the slowest profile is not written."
+    
+    all_chunk = ['2021_11_01_11_00_00', '2021_11_01_12_00_00', '2021_11_01_13_00_00']
+    tasks = pipeline.get_task_list(all_chunk, ['NZ', 'AU'], ['QRZ', 'LHI'], ['*', '*'], ['BHZ', 'BHZ'])
+    prepro_para = {'rm_resp':'no', 'respdir':None, 'freqmin':0.005, 'freqmax':0.1, 'samp_freq':1}
+    try:
+        profiling.enable(cprofile=True, slowest=3)
+        pipeline.run_pipeline(tasks, FakeClient(), prepro_para, str(tmp_path), workers=2)
+        summary = {row['stage']:row for row in profiling.summary()}
+        records = profiling.records()
+        files = profiling.dump_profiles(str(tmp_path))
+        profiling.reset()
+        download_raw_data.download_concurrent(all_chunk, 2, ['NZ', 'AU'], ['QRZ', 'LHI'], ['*', '*'], str(tmp_path), ['BHZ', 'BHZ'], 
+                                              FakeClient(), 1, resume=False)
+        download_summary = {row['stage']:row for row in profiling.summary()}
+    finally:
+        profiling.disable()
+        profiling.reset()
+    for name in ['task', 'download', 'check_sample_gaps', 'preprocess_raw', 'freq_time_normalise_sum']:
+        assert summary[name]['calls'] == len(tasks), "ValueError, every stage of every task should be recorded once."
+    assert len(files) == 3 and all(pstats.Stats(ff).total_calls > 0 for ff in files), "ValueError, the profiles of the workers are not gathered."
+    assert all(0 <= record['rss_growth_bytes'] <= record['peak_rss_bytes'] for record in records), "ValueError, the memory of the stages is not correct."
+    assert download_summary['download']['calls'] == 1 and download_summary['download_chunk']['calls'] == 2, "ValueError, the concurrent download is not recorded."
+
+
+
+def test_import_cost():
+    '''This function tests
+    
+       1) whether importing normalisation, processing and download_raw_data leaves out the heavy optional backends
+       2) whether numba is only imported by the first call of the cleanup kernel
+       3) whether the import time of normalisation is within the budget
+       4) if the exception is raised for a module without import time
+       
+       ASSERTION: 
+       If 1) or 2) false: a module imports a package it does not need at import time.
+       If 3) false: the import of normalisation is too slow.
+       If 4) false: Value error is not successfully raised.
+    '''
+    heavy = ['numba', 'pandas', 'pycwt', 'pyasdf', 'obspy.clients.fdsn']
+    for module in ['normalisation', 'processing', 'download_raw_data']:
+        seconds, loaded = bench_FTN.import_time(module, repeat=1)
+        assert not set(heavy) & set(loaded), "ValueError, %s imports %s." % (module, sorted(set(heavy) & set(loaded)))
+    
+    code = ('import sys, numpy, processing; loaded = "numba" in sys.modules; '
+            'processing.clean_trace(numpy.ones(10, dtype=numpy.float32)); print(loaded, "numba" in sys.modules)')
+    out = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)), 
+                         capture_output=True, text=True, check=True).stdout.split()
+    assert out == ['False', 'True'], "ValueError, numba should be imported by the first call of the kernel."
+    
+    seconds, loaded = bench_FTN.import_time('normalisation', repeat=3)
+    assert seconds < bench_FTN.IMPORT_BUDGET['normalisation'], "ValueError, importing normalisation takes %.2f s." % seconds
+    
+    #sys is loaded at startup, so it has no import time
+    with pytest.raises(ValueError):
+        bench_FTN.import_time('sys', repeat=1)
+
+
+
+def test_ftn_cli(tmp_path, monkeypatch):
+    '''This function tests
+    
+       1) the plan of a run from a TOML config and a station list, and that a dry run writes nothing
+       2) whether the preprocess and normalise stages run separately on the downloaded data reproduce the pipeline 
+          run in one go, also with the archive opened by the worker processes from its arguments
+       3) whether a finished task is not run again
+       4) if the exception is raised for an unknown parameter or non-consecutive stages
+       5) whether the download stage skips the stations and chunks without data
+       6) whether the dtype of the config is used by the normalisation
+       
+       ASSERTION: 
+       If 1) or 3) false: the plan is not correct.
+       If 2) or 5) false: the command-line run is not correct.
+       If 4) false: Value error is not successfully raised.
+       If 6) false: the normalisation does not run with the dtype of the config.
+    '''
+    with open(str(tmp_path/'stations.txt'), 'w') as fp:
+        fp.write('network,station,channel,latitude,longitude,elevation\nNZ,QRZ,BHZ,-40.8,172.5,263.0\nAU,LHI,BHZ,-31.5,159.1,73.7\n')
+    cfg = str(tmp_path/'config.toml')
+    with open(cfg, 'w') as fp:
+        fp.write("direc = 'raw'\ndlist = 'stations.txt'\noutdir = 'out'\nrm_resp = 'no'\nsamp_freq = 1\n"
+                 "start_date = '2021_11_01_11_0_0'\nend_date = '2021_11_01_13_0_0'\ninc_hours = 1\n")
+    config = ftn.load_config(cfg)
+    run_plan = ftn.plan(config)
+    assert config['stages'] == ('download', 'preprocess', 'normalise') and config['outdir'] == str(tmp_path/'out'), "ValueError, the config is not correct."
+    assert len(run_plan['tasks']) == 4 and len(run_plan['todo']) == 4 and run_plan['npts'] == 3600, "ValueError, the plan is not correct."
+    assert ftn.main([cfg, '--dry-run']) == 0 and not os.path.exists(config['direc']) and not os.path.exists(config['outdir']), "ValueError, a dry run should not write anything."
+    
+    # the download stage with an offline client, where a station or a whole chunk without data is skipped
+    os.makedirs(os.path.join(config['direc'], 'inventory'))
+    nodata = dict(config, direc=str(tmp_path/'nodata'))
+    os.makedirs(os.path.join(nodata['direc'], 'inventory'))
+    ftn._download(nodata, run_plan, NoDataClient())
+    assert len(download_raw_data.load_manifest(nodata['direc'])) == 2, "ValueError, the station without data is not skipped."
+    ftn._download(nodata, dict(run_plan, net=['AU'], sta=['LHI'], location=['*'], chan=['BHZ']), NoDataClient())
+    ftn._download(config, run_plan, FakeClient())
+    assert len(download_raw_data.load_manifest(config['direc'])) == 4, "ValueError, the download stage is not correct."
+    assert ftn.main([cfg, '--stages', 'preprocess']) == 0, "ValueError, the preprocess stage failed."
+    assert ftn.main([cfg, '--stages', 'normalise', '--workers', '2']) == 0, "ValueError, the normalise stage failed."
+    
+    reference = tmp_path/'reference'
+    reference.mkdir()
+    source = archive.WaveformArchive(config['direc'], inventory=os.path.join(config['direc'], 'inventory', '*.xml'))
+    output = pipeline.run_pipeline(run_plan['tasks'], source, ftn._prepro_para(config), str(reference))
+    parallel = tmp_path/'parallel'
+    parallel.mkdir()
+    args = (config['direc'], 'SAC', os.path.join(config['direc'], 'inventory', '*.xml'))
+    output2 = pipeline.run_pipeline(run_plan['tasks'], args, ftn._prepro_para(config), str(parallel), workers=2)
+    for task, ff, ff2 in zip(run_plan['tasks'], output, output2):
+        tr = obspy.read(pipeline.task_output(task, config['outdir']))[0]
+        assert np.allclose(tr.data, obspy.read(ff)[0].data), "ValueError, the command-line output is not correct."
+        assert np.allclose(tr.data, obspy.read(ff2)[0].data), "ValueError, the archive opened by the workers is not correct."
+    assert len(ftn.plan(config)['todo']) == 0, "ValueError, finished tasks should not be run again."
+    
+    # the dtype of the config is also the precision of the normalisation
+    dtypes = []
+    freq_time_normalise_sum = normalisation.freq_time_normalise_sum
+    monkeypatch.setattr(normalisation, 'freq_time_normalise_sum', 
+                        lambda *args, **kwargs: dtypes.append(kwargs['dtype']) or freq_time_normalise_sum(*args, **kwargs))
+    config32 = ftn.check_config(dict(config, dtype='float32'))
+    pipeline.run_pipeline(run_plan['tasks'][:1], source, ftn._prepro_para(config32), str(reference))
+    assert dtypes == [np.float32], "ValueError, the dtype of the config does not reach the normalisation."
+    
+    with pytest.raises(ValueError):
+        ftn.check_config(dict(config, samp_freqs=1))
+    with pytest.raises(ValueError):
+        ftn.check_config(dict(config, stages='download,normalise'))
+
+
+
+def test_shared_array(tmp_path):
+    '''This function tests
+    
+       1) whether a trace written into a shared array is aligned on its start time and read back as a view of the file
+       2) if the exception is raised for a wrong sampling rate, an unknown station or a read-only array
+       3) whether the pipeline with shared arrays reproduces the SAC files, with the stages run separately by 
+          parallel workers
+       4) whether the written rows are recorded in the sidecar and the array is an input of the cross-correlation
+       
+       ASSERTION: 
+       If 1) false: the shared array is not correct.
+       If 2) false: Value error is not successfully raised.
+       If 3) or 4) false: the pipeline with shared arrays is not correct.
+    '''
+    t0 = obspy.UTCDateTime(2021, 11, 1)
+    ff = str(tmp_path/'chunk.npy')
+    with shared.TraceArray.create(ff, ['NZ.QRZ..BHZ', 'AU.LHI..BHZ'], t0, 1.0, 100) as arr:
+        tr = obspy.Trace(np.arange(50, dtype=np.float32), header={'sampling_rate':1.0, 'starttime':t0+60})
+        assert arr.write('AU.LHI..BHZ', tr) == 1, "ValueError, the row is not correct."
+        with pytest.raises(ValueError):
+            arr.write('AU.LHI..BHZ', obspy.Trace(np.zeros(10), header={'sampling_rate':2.0}))
+        with pytest.raises(ValueError):
+            arr.write('NZ.QRZ..HHZ', tr)
+        arr.mark_filled(['AU.LHI..BHZ'])
+    
+    arr = shared.TraceArray(ff)
+    tr = arr.trace('AU.LHI..BHZ')
+    assert arr.filled == [False, True] and arr.data.shape == (2, 100), "ValueError, the sidecar is not correct."
+    assert np.array_equal(tr.data[60:], np.arange(40)) and not tr.data[:60].any(), "ValueError, the trace is not aligned on its start time."
+    assert np.shares_memory(tr.data, arr.data) and tr.id == 'AU.LHI..BHZ' and tr.stats.starttime == t0, "ValueError, the trace should be a view of the array."
+    with pytest.raises(ValueError):
+        arr.write('AU.LHI..BHZ', tr)
+    
+    all_chunk = ['2021_11_01_11_00_00', '2021_11_01_12_00_00', '2021_11_01_13_00_00']
+    tasks = pipeline.get_task_list(all_chunk, ['NZ', 'AU'], ['QRZ', 'LHI'], ['*', '*'], ['BHZ', 'BHZ'])
+    prepro_para = {'rm_resp':'no', 'respdir':None, 'freqmin':0.005, 'freqmax':0.1, 'samp_freq':1}
+    sac = tmp_path/'sac'
+    mapped = tmp_path/'shared'
+    sac.mkdir()
+    mapped.mkdir()
+    output1 = pipeline.run_pipeline(tasks, FakeClient(), prepro_para, str(sac))
+    pipeline.run_pipeline(tasks, FakeClient(), prepro_para, str(mapped), stages=('preprocess',), shared=True)
+    output2 = pipeline.run_pipeline(tasks, None, prepro_para, str(mapped), workers=2, stages=('normalise',), shared=True)
+    
+    assert len(set(output2)) == 2 and len(glob.glob(str(mapped/'*.npy'))) == 4, "ValueError, there should be one array per chunk and stage."
+    for task, ff1, ff2 in zip(tasks, output1, output2):
+        arr = shared.TraceArray(ff2)
+        tr = arr.trace(pipeline.task_id(task))
+        assert all(arr.filled) and tr.stats.starttime == obspy.UTCDateTime(task['starttime']), "ValueError, the rows are not recorded."
+        assert np.allclose(tr.data, obspy.read(ff1)[0].data, atol=1e-5), "ValueError, the shared output is not correct."
+    
+    pairs, lags, ccf = correlation.correlate(arr.data, 10, samp_freq=arr.sampling_rate)
+    assert pairs == [(0, 1)] and ccf.shape == (1, 21), "ValueError, the shared array should be an input of the cross-correlation."
+
+
+
+def test_window_plan():
+    '''This function tests
+    
+       1) whether the linear windows are the windows of width freq_low/4 from freq_low up to freq_high
+       2) whether the constant-q and log windows are contiguous, start at the first linear window and need fewer windows
+       3) whether the plan is computed once per channel and frequency range
+       4) if the exception is raised for an unknown spacing or windows above the Nyquist frequency
+       
+       ASSERTION: 
+       If 1) or 2) false: the frequency windows are not correct.
+       If 3) false: the plan is not cached.
+       If 4) false: Value error is not successfully raised.
+    '''
+    for chan, freqmin, freqmax in [('HHZ', 0.001, 0.1), ('BHZ', 0.005, 0.1), ('LHZ', 0.0071, 0.0512), ('HHZ', 0.0015, 0.0020875)]:
+        freq_low, freq_high = normalisation.target_frequency(chan, freqmin, freqmax)
+        df = freq_low/4
+        reference = []
+        while freq_low+(len(reference)+1)*df <= freq_high*(1+1e-12):
+            reference.append((freq_low+len(reference)*df, freq_low+(len(reference)+1)*df))
+        windows = normalisation.target_frequency_window(chan, freqmin, freqmax)
+        assert len(windows) == len(reference) and np.allclose(windows, reference, rtol=1e-12, atol=0), "ValueError, the linear windows are not correct."
+    
+    #the window ending at freq_high is kept (the accumulated rounding of a while-loop used to drop it)
+    assert normalisation.target_frequency_window('BHZ', 0.005, 0.1)[-1] == (0.06875, 0.07), "ValueError, the last window is not correct."
+    
+    linear = normalisation.window_plan('HHZ', 0.001, 0.1)
+    constant_q = normalisation.window_plan('HHZ', 0.001, 0.1, spacing='constant-q')
+    log = normalisation.window_plan('HHZ', 0.001, 0.1, spacing='log')
+    assert len(linear) == 163 and len(constant_q) == 16 and len(log) == 17, "ValueError, the number of windows is not correct."
+    assert np.allclose(constant_q[:, 1]/constant_q[:, 0], 1.25) and np.array_equal(constant_q[1:, 0], constant_q[:-1, 1]), "ValueError, the constant-q windows are not correct."
+    assert np.allclose(constant_q[0], linear[0]) and np.isclose(log[0, 0], linear[0, 0]) and np.isclose(log[-1, 1], 0.07), "ValueError, the windows do not cover the band."
+    assert np.array_equal(log[1:, 0], log[:-1, 1]) and np.allclose(np.diff(np.log(log[:, 0])), np.log(log[0, 1]/log[0, 0])), "ValueError, the log windows are not correct."
+    
+    info = normalisation.window_plan_cache_info()
+    assert normalisation.window_plan('HHZ', 0.001, 0.1, spacing='constant-q') is constant_q, "ValueError, the plan should be shared."
+    assert normalisation.window_plan_cache_info().hits == info.hits+1 and not constant_q.flags.writeable, "ValueError, the plan is not cached."
+    
+    with pytest.raises(ValueError):
+        normalisation.window_plan('HHZ', 0.001, 0.1, spacing='octave')
+    with pytest.raises(ValueError):
+        normalisation.window_plan('HHZ', 0.001, 0.1, samp_freq=0.1)